@@ -1,3 +1,5 @@
-from .co_visitation_matrix import CoVisitationMatrix
+from .co_visitation_matrix import CoVisitationMatrix, make_co_visitation_matrixes
 from .predicting import get_predictions_df
+from .top_k_index import TopKIndex
+from .weights import WeightSpec, TypeWeight, RecencyWeight, TimeGapWeight, PositionWeight
 
@@ -0,0 +1,189 @@
+import numpy as np
+import pandas as pd
+import warnings
+from .. import data as _data_module
+from . import pair_generation as _pair_generation
+
+
+# only the most recent events of each session are paired
+n_recent_events = 30
+
+
+def _decode_chunk(chunk_df, types_to_use):
+    """
+    A chunk of data.CompactTidyData as the DataFrame of the logical dtypes the pairs are generated in,
+    where the events of the other types are dropped before decoding. A DataFrame is returned as it is.
+    """
+    if not isinstance(chunk_df, _data_module.CompactTidyData):
+        return chunk_df
+    if types_to_use is not None:
+        chunk_df = chunk_df.get_events(np.isin(chunk_df["type"].to_numpy(), types_to_use))
+    return chunk_df.to_pandas()
+
+
+class PandasBackend:
+    """CPU backend. cuDF mirrors the pandas API, so the same frame operations are shared with CuDFBackend."""
+    name = "pandas"
+
+    def from_pandas(self, df):
+        return df
+
+    def to_pandas(self, df):
+        return df
+
+    def get_candidate_pair_df(
+            self, chunk_df, types_to_use, aid_x_range, max_timedelta: np.timedelta64, with_position: bool = False
+    ):
+        """
+        The pairs before drop_duplicates, in the order of the self-join.
+        With with_position, position_x and position_y are the positions in the session from the most recent event.
+        chunk_df may be a chunk of data.CompactTidyData, which is decoded here.
+        """
+        chunk_xdf = self.from_pandas(_decode_chunk(chunk_df, types_to_use))
+        if types_to_use is not None:
+            chunk_xdf = chunk_xdf.loc[chunk_xdf["type"].isin(types_to_use)]
+
+        if True:
+            warnings.warn("* n < 30")
+            chunk_xdf = chunk_xdf.sort_values(['session', 'ts'], ascending=[True, False])
+            chunk_xdf = chunk_xdf.reset_index(drop=True)
+            chunk_xdf['n'] = chunk_xdf.groupby('session').cumcount()
+            chunk_xdf = chunk_xdf.loc[chunk_xdf["n"] < n_recent_events]
+            if with_position:
+                chunk_xdf = chunk_xdf.rename(columns={"n": "position"})
+            else:
+                chunk_xdf = chunk_xdf.drop('n', axis=1)
+
+        chunk_xdf = chunk_xdf.merge(chunk_xdf, on="session")
+        aid_x_min, aid_x_max = aid_x_range
+        chunk_xdf = chunk_xdf.query(
+            "@aid_x_min <= aid_x < @aid_x_max"
+        )
+        return chunk_xdf.query(
+            "-@max_timedelta < ts_x - ts_y < @max_timedelta"
+        )
+
+    def get_pair_df(
+            self, chunk_df, types_to_use, aid_x_range, max_timedelta: np.timedelta64, with_position: bool = False
+    ):
+        return self.get_candidate_pair_df(
+            chunk_df, types_to_use, aid_x_range, max_timedelta, with_position
+        ).drop_duplicates(["session", "aid_x", "aid_y"])
+
+    def add(self, total_weight, chunk_total_weight):
+        if total_weight is None:
+            return chunk_total_weight
+        return total_weight.add(chunk_total_weight, fill_value=0).astype(chunk_total_weight.dtype)
+
+
+class NumpyBackend(PandasBackend):
+    """CPU backend generating only the pairs within max_timedelta and the aid_x range, without the self-join."""
+    name = "numpy"
+
+    @staticmethod
+    def _get_pair_indices(chunk_df, aid_x_range, max_timedelta: np.timedelta64):
+        session = chunk_df["session"].to_numpy()
+        ts = chunk_df["ts"].to_numpy()
+        if np.issubdtype(ts.dtype, np.datetime64):
+            ts_unit, _ = np.datetime_data(ts.dtype)
+            ts = ts.view(np.int64)
+            max_timedelta = max_timedelta.astype(f"m8[{ts_unit}]").astype(np.int64)
+        else:
+            max_timedelta = max_timedelta.astype(np.int64)
+        ts = ts.astype(np.int64)
+
+        # the same order as sort_values(['session', 'ts'], ascending=[True, False])
+        order = np.lexsort((-ts, session))
+
+        positions = _pair_generation.get_positions_in_session(session[order])
+        if True:
+            warnings.warn("* n < 30")
+            is_recent = positions < n_recent_events
+            order = order[is_recent]
+            positions = positions[is_recent]
+
+        idx_x, idx_y = _pair_generation.get_pair_indices(
+            session[order], ts[order], chunk_df["aid"].to_numpy()[order], aid_x_range, max_timedelta
+        )
+        # idx_x/idx_y are the positions in the sorted chunk, i.e. the order of the self-join
+        return order, positions, idx_x, idx_y
+
+    @staticmethod
+    def _to_pair_df(chunk_df, idx_x, idx_y, position_x=None, position_y=None):
+        pair_df = pd.DataFrame({"session": chunk_df["session"].to_numpy()[idx_x]})
+        for col in ("aid", "ts", "type"):
+            values = chunk_df[col].to_numpy()
+            pair_df[f"{col}_x"] = values[idx_x]
+            pair_df[f"{col}_y"] = values[idx_y]
+        if position_x is None:
+            return pair_df[["session", "aid_x", "ts_x", "type_x", "aid_y", "ts_y", "type_y"]]
+        pair_df["position_x"] = position_x
+        pair_df["position_y"] = position_y
+        return pair_df[["session", "aid_x", "ts_x", "type_x", "position_x", "aid_y", "ts_y", "type_y", "position_y"]]
+
+    def get_candidate_pair_df(
+            self, chunk_df, types_to_use, aid_x_range, max_timedelta: np.timedelta64, with_position: bool = False
+    ):
+        chunk_df = _decode_chunk(chunk_df, types_to_use)
+        if types_to_use is not None:
+            chunk_df = chunk_df.loc[chunk_df["type"].isin(types_to_use)]
+
+        order, positions, idx_x, idx_y = self._get_pair_indices(chunk_df, aid_x_range, max_timedelta)
+        pair_order = np.lexsort((idx_y, idx_x))
+        idx_x = idx_x[pair_order]
+        idx_y = idx_y[pair_order]
+        if with_position:
+            return self._to_pair_df(chunk_df, order[idx_x], order[idx_y], positions[idx_x], positions[idx_y])
+        return self._to_pair_df(chunk_df, order[idx_x], order[idx_y])
+
+    def get_pair_df(
+            self, chunk_df, types_to_use, aid_x_range, max_timedelta: np.timedelta64, with_position: bool = False
+    ):
+        chunk_df = _decode_chunk(chunk_df, types_to_use)
+        if types_to_use is not None:
+            chunk_df = chunk_df.loc[chunk_df["type"].isin(types_to_use)]
+
+        order, positions, idx_x, idx_y = self._get_pair_indices(chunk_df, aid_x_range, max_timedelta)
+
+        # drop_duplicates(["session", "aid_x", "aid_y"]) keeping the first pair in the order of the self-join
+        session = chunk_df["session"].to_numpy()[order]
+        aid = chunk_df["aid"].to_numpy()[order]
+        pair_order = np.lexsort((idx_y, idx_x, aid[idx_y], aid[idx_x], session[idx_x]))
+        idx_x = idx_x[pair_order]
+        idx_y = idx_y[pair_order]
+        is_first = np.ones(len(idx_x), dtype=bool)
+        is_first[1:] = (
+            (session[idx_x[1:]] != session[idx_x[:-1]])
+            | (aid[idx_x[1:]] != aid[idx_x[:-1]])
+            | (aid[idx_y[1:]] != aid[idx_y[:-1]])
+        )
+        idx_x = idx_x[is_first]
+        idx_y = idx_y[is_first]
+        if with_position:
+            return self._to_pair_df(chunk_df, order[idx_x], order[idx_y], positions[idx_x], positions[idx_y])
+        return self._to_pair_df(chunk_df, order[idx_x], order[idx_y])
+
+
+class CuDFBackend(PandasBackend):
+    name = "cudf"
+
+    def __init__(self):
+        import cudf
+        self._cudf = cudf
+
+    def from_pandas(self, df):
+        return self._cudf.from_pandas(df)
+
+    def to_pandas(self, df):
+        return df.to_pandas()
+
+
+def get_backend(name: str):
+    if name == "cudf":
+        return CuDFBackend()
+    elif name == "pandas":
+        return PandasBackend()
+    elif name == "numpy":
+        return NumpyBackend()
+    else:
+        raise ValueError(f"backend must be 'cudf', 'pandas' or 'numpy': {name}")
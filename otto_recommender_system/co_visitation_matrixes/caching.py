@@ -0,0 +1,210 @@
+"""
+Content-addressed cache of the co-visitation artifacts.
+Each entry is a directory store_dir_path/key[:16] with a manifest.json recording the full key, the parameters
+it was built with and the last time it was used, which is the order of the LRU eviction.
+"""
+import functools
+import hashlib
+import json
+import pathlib
+import shutil
+import time
+import types
+import uuid
+import numpy as np
+import pandas as pd
+from .. import data as _data_module
+from . import weights as _weights
+
+
+manifest_file_name = "manifest.json"
+
+
+def _hash_bytes(h, array):
+    array = np.ascontiguousarray(array)
+    if array.dtype.hasobject:
+        # the hashes of the values instead of the pointers
+        array = pd.util.hash_array(array.reshape(-1))
+    h.update(str(array.dtype).encode())
+    h.update(memoryview(array.view(np.uint8).reshape(-1)))
+
+
+def get_data_fingerprint(data) -> str:
+    """
+    Hash of the contents of a DataFrame or data.CompactTidyData, or of the cached files of data.TidyDataChunks.
+    It is not memoized, since a DataFrame may be modified in place after it is hashed.
+    """
+    if isinstance(data, _data_module.TidyDataChunks):
+        h = hashlib.blake2b(digest_size=16)
+        h.update(json.dumps([data.manifest, data.columns, data.types]).encode())
+        for fn in sorted(data.npy_tidy_data_path.glob("*.npy")):
+            h.update(fn.name.encode())
+            _hash_bytes(h, np.load(fn, mmap_mode="r"))
+        return h.hexdigest()
+
+    if isinstance(data, _data_module.CompactTidyData):
+        h = hashlib.blake2b(digest_size=16)
+        h.update(json.dumps([data.columns, data.ts_epoch_ms, data.ts_unit]).encode())
+        for name, array in [("session_ids", data.session_ids), ("offsets", data.offsets), *data.arrays.items()]:
+            h.update(name.encode())
+            _hash_bytes(h, array)
+        return h.hexdigest()
+
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(len(data)).encode())
+    for col in data.columns:
+        h.update(str(col).encode())
+        _hash_bytes(h, data[col].to_numpy())
+    return h.hexdigest()
+
+
+def _get_array_fingerprint(array) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(array.shape).encode())
+    _hash_bytes(h, array)
+    return h.hexdigest()
+
+
+def _get_global_names(code) -> set:
+    """The names in code and its nested code objects, some of which are the globals used"""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _get_global_names(const)
+    return names
+
+
+def _get_object_fingerprint(obj, seen):
+    if obj is None or isinstance(obj, (bool, int, float, str, bytes, np.generic, np.dtype, np.timedelta64)):
+        return repr(obj)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        items = [_get_object_fingerprint(item, seen) for item in obj]
+        return f"{type(obj).__name__}({', '.join(sorted(items) if isinstance(obj, (set, frozenset)) else items)})"
+    elif isinstance(obj, dict):
+        return "{" + ", ".join(sorted(
+            f"{_get_object_fingerprint(k, seen)}: {_get_object_fingerprint(v, seen)}" for k, v in obj.items()
+        )) + "}"
+    elif isinstance(obj, types.CodeType):
+        return (
+            f"code({obj.co_code.hex()}, {_get_object_fingerprint(obj.co_consts, seen)}, "
+            f"{obj.co_names}, {obj.co_varnames})"
+        )
+    elif isinstance(obj, (types.FunctionType, functools.partial, types.MethodType, _weights.WeightSpec)):
+        return _get_function_fingerprint(obj, seen)
+    elif isinstance(obj, np.ndarray):
+        return f"ndarray({_get_array_fingerprint(obj)})"
+    elif isinstance(obj, pd.Series):
+        return (
+            f"Series({obj.name!r}, {_get_array_fingerprint(obj.index.to_numpy())}, "
+            f"{_get_array_fingerprint(obj.to_numpy())})"
+        )
+    elif isinstance(obj, pd.DataFrame):
+        return f"DataFrame({_get_array_fingerprint(obj.index.to_numpy())}, {get_data_fingerprint(obj)})"
+    elif isinstance(obj, (types.ModuleType, type, types.BuiltinFunctionType, np.ufunc)):
+        # the library code is identified by its name
+        return f"{type(obj).__name__}({getattr(obj, '__module__', None)}.{getattr(obj, '__qualname__', obj.__name__)})"
+    else:
+        # unknown to be the same as another object, so that it is never reused
+        return f"{type(obj).__qualname__}({uuid.uuid4().hex})"
+
+
+def _get_function_fingerprint(func, seen):
+    if isinstance(func, _weights.WeightSpec):
+        # the parameters as they are instead of repr, which abbreviates large arrays
+        return f"{type(func).__qualname__}({_get_object_fingerprint(vars(func), seen)})"
+    elif isinstance(func, functools.partial):
+        return (
+            f"partial({_get_function_fingerprint(func.func, seen)}, {_get_object_fingerprint(func.args, seen)}, "
+            f"{_get_object_fingerprint(func.keywords, seen)})"
+        )
+    elif isinstance(func, types.MethodType):
+        return (
+            f"method({_get_function_fingerprint(func.__func__, seen)}, "
+            f"{_get_object_fingerprint(func.__self__, seen)})"
+        )
+    elif not isinstance(func, types.FunctionType):
+        return _get_object_fingerprint(func, seen)
+    if id(func) in seen:
+        # a recursive reference, whose contents are already in the fingerprint
+        return f"function({func.__qualname__})"
+    seen = seen | {id(func)}
+
+    closure = [] if func.__closure__ is None else [cell.cell_contents for cell in func.__closure__]
+    global_values = {
+        name: func.__globals__[name] for name in _get_global_names(func.__code__) if name in func.__globals__
+    }
+    return hashlib.blake2b(
+        "|".join([
+            _get_object_fingerprint(func.__code__, seen),
+            _get_object_fingerprint(func.__defaults__, seen),
+            _get_object_fingerprint(func.__kwdefaults__, seen),
+            _get_object_fingerprint(closure, seen),
+            _get_object_fingerprint(global_values, seen),
+        ]).encode(),
+        digest_size=16
+    ).hexdigest()
+
+
+def get_function_fingerprint(func) -> str:
+    """
+    Hash of the bytecode, the constants, the defaults, the closure values and the globals used by func,
+    where arrays and DataFrames are hashed by their contents and functools.partial by its function and arguments.
+    An object which cannot be fingerprinted, e.g. an instance of an arbitrary class, gets a unique fingerprint
+    so that the build with it is never reused.
+    """
+    if func is None:
+        return "None"
+    return _get_function_fingerprint(func, frozenset())
+
+
+def get_key(params: dict) -> str:
+    return hashlib.blake2b(
+        json.dumps(params, sort_keys=True, default=str).encode(), digest_size=32
+    ).hexdigest()
+
+
+def open_entry(store_dir_path, key: str, params: dict) -> pathlib.Path:
+    """The directory of the entry of key, created if not yet, marked as used now"""
+    entry_dir_path = pathlib.Path(store_dir_path) / key[:16]
+    manifest_path = entry_dir_path / manifest_file_name
+    if manifest_path.exists():
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest["key"] != key:
+            raise RuntimeError(f"key collision at {entry_dir_path}")
+    else:
+        entry_dir_path.mkdir(parents=True, exist_ok=True)
+        manifest = {"key": key, "params": params, "created": time.time()}
+    manifest["last_used"] = time.time()
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2, default=str)
+    return entry_dir_path
+
+
+def get_size(dir_path) -> int:
+    return sum(fn.stat().st_size for fn in pathlib.Path(dir_path).rglob("*") if fn.is_file())
+
+
+def evict(store_dir_path, max_cache_gb, keep=()):
+    """Removes the least recently used entries until the store fits in max_cache_gb, except those in keep"""
+    store_dir_path = pathlib.Path(store_dir_path)
+    if max_cache_gb is None or not store_dir_path.exists():
+        return
+
+    entries = []
+    for manifest_path in store_dir_path.glob(f"*/{manifest_file_name}"):
+        with open(manifest_path) as f:
+            last_used = json.load(f)["last_used"]
+        entries.append((last_used, manifest_path.parent))
+    entries.sort()
+
+    keep = {pathlib.Path(dir_path).resolve() for dir_path in keep}
+    sizes = {entry_dir_path: get_size(entry_dir_path) for _, entry_dir_path in entries}
+    total_size = sum(sizes.values())
+    for _, entry_dir_path in entries:
+        if total_size <= max_cache_gb * 1e9:
+            break
+        if entry_dir_path.resolve() in keep:
+            continue
+        shutil.rmtree(entry_dir_path)
+        total_size -= sizes[entry_dir_path]
@@ -1,12 +1,21 @@
 import pathlib
-import cudf
+import concurrent.futures
+import copy
+import multiprocessing
 from .. import data as _data_module
+from . import backends as _backends
+from . import caching as _caching
+from . import weights as _weights
+from .top_k_index import TopKIndex, get_top_k_indices
 import numpy as np
-from typing import Optional, List, Union, Dict, Callable
+from typing import Optional, List, Union, Dict, Callable, Sequence, TYPE_CHECKING
 import tqdm
 import pandas as pd
 import json
-import warnings
+import shutil
+
+if TYPE_CHECKING:
+    import cudf
 
 
 class CoVisitationMatrix:
@@ -15,12 +24,53 @@ class CoVisitationMatrix:
             max_memory_gb_for_each_split_aid: Union[float, int] = 1,
             n_seperated_aid=8,
             types_to_use: Optional[List[Union[int, str]]] = None,
-            weight_func: Optional[Callable[[cudf.DataFrame], Dict[Union[int, str], Union[int, float]]]] = None
+            weight_func: Optional[Union[
+                _weights.WeightSpec,
+                Callable[["pd.DataFrame | cudf.DataFrame"], Dict[Union[int, str], Union[int, float]]]
+            ]] = None,
+            backend: str = "cudf",
+            session_offsets: Optional[np.ndarray] = None,
+            store_dir_path=None,
+            max_cache_gb: Optional[Union[float, int]] = None
     ):
-        all_sessions, indices_in_all_sessions = np.unique(all_train_df["session"], return_index=True)
+        """
+        all_train_df may be data.TidyDataChunks, whose chunks are then read one by one instead of df_list,
+        and each of them is divided further by the same estimate of the pair memory as df_list.
+        It may also be data.CompactTidyData, which is divided by its session index and decoded chunk by chunk.
+        session_offsets is the offsets of data.get_session_index to skip deriving the session boundaries.
+        weight_func may be a declarative weights.WeightSpec, e.g. TypeWeight({"carts": 6}) * TimeGapWeight("1h"),
+        which is evaluated as column expressions instead of a Python callable over the data.
+        The float totals of the pair weights are rounded to int32 for a WeightSpec, but truncated for a Python callable
+        so that the matrixes of the existing callables stay the same.
+
+        make builds the matrix in an entry of the content-addressed cache at store_dir_path (cache_dir_path/store
+        by default), keyed by the fingerprint of all_train_df and of all the build parameters including weight_func.
+        A build with the same key is reused by any matrix sharing the store, and a different one never collides.
+        The least recently used entries are evicted when the store exceeds max_cache_gb.
+        Until make is called, dirname is the legacy location cache_dir_path/dirname/n-seperated-aid_N.
+        """
+        is_chunked = isinstance(all_train_df, _data_module.TidyDataChunks)
+        if is_chunked:
+            indices_in_all_sessions = None
+        elif session_offsets is None:
+            indices_in_all_sessions = _get_session_starts(all_train_df)
+        else:
+            assert session_offsets[-1] == len(all_train_df)
+            indices_in_all_sessions = np.asarray(session_offsets[:-1])
 
+        self.name = f"{dirname}/n-seperated-aid_{n_seperated_aid}"
         self.dirname = pathlib.Path(cache_dir_path) / dirname / f"n-seperated-aid_{n_seperated_aid}"
-        self.dirname.mkdir(exist_ok=True, parents=True)
+        self.store_dir_path = (
+            pathlib.Path(cache_dir_path) / "store" if store_dir_path is None else pathlib.Path(store_dir_path)
+        )
+        self.max_cache_gb = max_cache_gb
+        self.cache_key = None
+        self.weight_func_fingerprint = _caching.get_function_fingerprint(weight_func)
+        self.tops = None
+        self.keep_full_weight = True
+        self.uses_position = isinstance(weight_func, _weights.WeightSpec) and weight_func.uses_position
+        # the totals of a WeightSpec are rounded, while those of a Python callable are truncated as they always were
+        self.rounds_weight = isinstance(weight_func, _weights.WeightSpec)
 
         def _validate_type_as_int(type_):
             return _data_module.all_types.index(type_) if isinstance(type_, str) else int(type_)
@@ -40,64 +90,121 @@ class CoVisitationMatrix:
         else:
             self.weight_func = lambda _: 1
 
-        all_aid = np.unique(all_train_df["aid"])
+        if is_chunked or isinstance(all_train_df, _data_module.CompactTidyData):
+            max_aid = all_train_df.get_max_aid()
+        else:
+            max_aid = np.unique(all_train_df["aid"])[-1]
         # assert all_aid.min() == 0
         # assert all_aid.max() == len(all_aid) - 1
-        n_unique_aid = len(all_aid)
-        self.aid_edges = np.linspace(0, n_unique_aid, n_seperated_aid).astype(np.int32)
-        self.total_weight_cudf: Optional[cudf.DataFrame] = None
+        # n_seperated_aid buckets need n_seperated_aid + 1 edges, and the last edge must cover the largest aid
+        self.aid_edges = np.linspace(0, max_aid + 1, n_seperated_aid + 1).astype(np.int32)
         self.n_seperated_aid = n_seperated_aid
+        self.max_memory_gb_for_each_split_aid = max_memory_gb_for_each_split_aid
+
+        self.backend = _backends.get_backend(backend)
+        self.total_weight = None
 
-        dtype_itemsize = sum(dtype.itemsize for dtype in all_train_df.dtypes)
+        self.all_train_df = all_train_df
+        self.indices_in_all_sessions = indices_in_all_sessions
+        if is_chunked:
+            self.df_list = all_train_df
+            return
+        self.dtype_itemsize = _get_dtype_itemsize(all_train_df)
+
+        self.df_list = self._divide(all_train_df, max_memory_gb_for_each_split_aid, indices_in_all_sessions)
+
+    def _divide(self, df, max_memory_gb, indices_in_all_sessions):
+        indices_to_divide = self._get_indices_to_divide(max_memory_gb, indices_in_all_sessions, len(df))
+        df_list = [
+            df.get_rows(f, l) if isinstance(df, _data_module.CompactTidyData) else df.iloc[f:l]
+            for f, l in zip(indices_to_divide, [*indices_to_divide[1:], len(df)])
+        ]
+        assert len(df) == sum(map(len, df_list))
+        return df_list
+
+    def _iter_chunks(self, df_list, max_memory_gb):
+        """
+        df_list as it is if it is divided by _divide already,
+        otherwise (data.TidyDataChunks) each of the chunks divided by _divide so that the pairs fit in max_memory_gb
+        """
+        if not isinstance(df_list, _data_module.TidyDataChunks):
+            yield from df_list
+            return
+        for chunk_df in df_list:
+            if len(chunk_df) == 0:
+                continue
+            self.dtype_itemsize = _get_dtype_itemsize(chunk_df)
+            yield from self._divide(chunk_df, max_memory_gb, _get_session_starts(chunk_df))
 
+    def _get_indices_to_divide(self, max_memory_gb, indices_in_all_sessions=None, n_events=None):
+        if indices_in_all_sessions is None:
+            indices_in_all_sessions = self.indices_in_all_sessions
+            n_events = len(self.all_train_df)
         # indices_to_divide = indices[np.unique(indices // n_iters, return_index=True)[1]]
-        indices_to_divide = indices_in_all_sessions[
+        # the size of each session including the last one, which starts a new piece if it exceeds the budget
+        return indices_in_all_sessions[
             np.unique(
-                dtype_itemsize
+                self.dtype_itemsize
                 *
-                np.cumsum((indices_in_all_sessions[1:] - indices_in_all_sessions[:-1]) ** 2)
+                np.cumsum(np.diff(np.r_[indices_in_all_sessions, n_events]) ** 2)
                 //
-                (max_memory_gb_for_each_split_aid * 1e9),
+                (max_memory_gb * 1e9),
                 return_index=True
             )[1]
         ]
 
-        self.df_list = [
-            all_train_df.iloc[f:l]
-            for f, l in zip(indices_to_divide, [*indices_to_divide[1:], len(all_train_df)])
-        ]
-        assert len(all_train_df) == sum(map(len, self.df_list))
+    def _check_made(self):
+        # before make, dirname is the legacy location, which exists only if it was made by an older version
+        if not self.dirname.exists():
+            raise FileNotFoundError(f"{self.name} is not made yet at {self.dirname}; call make first")
 
     def get_df(self, i_seperated_aid):
         if not (0 <= i_seperated_aid < self.n_seperated_aid):
             raise IndexError("list index out of range")
+        self._check_made()
         target_fn = self.dirname / f"{i_seperated_aid}.parquet"
         if not target_fn.exists():
             raise FileNotFoundError(target_fn)
         return pd.read_parquet(target_fn)
 
     def get_top_df(self, i_seperated_aid, top=20):
+        self._check_made()
         target_fn = self.dirname / f"top{top}" / f"{i_seperated_aid}.parquet"
         if target_fn.exists():
             return pd.read_parquet(target_fn)
 
         target_fn.parent.mkdir(exist_ok=True)
 
-        df = self.get_df(i_seperated_aid)
-        df = df.sort_values(["aid_x", "weight"], ascending=[True, False])
-        df["i_top_weight"] = df.groupby("aid_x")["aid_y"].cumcount()
-        df = df.loc[df["i_top_weight"] < top].drop(columns=["i_top_weight"])
+        df = self._select_top(self.get_df(i_seperated_aid), top)
         df.to_parquet(target_fn)
         return df
 
+    @staticmethod
+    def _select_top(df, top):
+        return df.iloc[get_top_k_indices(df["aid_x"].to_numpy(), df["weight"].to_numpy(), [top])[top]]
+
+    def _save_total_weight(self, i_seperated_aid, total_weight_df):
+        """Saves the top-k of each k in self.tops and then the full weight table unless keep_full_weight is False"""
+        if self.tops is not None:
+            indices = get_top_k_indices(
+                total_weight_df["aid_x"].to_numpy(), total_weight_df["weight"].to_numpy(), self.tops
+            )
+            for top in self.tops:
+                target_fn = self.dirname / f"top{top}" / f"{i_seperated_aid}.parquet"
+                target_fn.parent.mkdir(exist_ok=True)
+                total_weight_df.iloc[indices[top]].to_parquet(target_fn)
+        if self.keep_full_weight:
+            total_weight_df.to_parquet(self.dirname / f"{i_seperated_aid}.parquet")
+
     def get_dict(self, top=20):
+        self._check_made()
         target_fn = self.dirname / f"top{top}" / "top.json"
         if target_fn.exists():
             with open(target_fn, "r") as f:
                 return {int(k): v for k, v in json.load(f).items()}
 
         top_20_dict = {}
-        for i in tqdm.trange(self.n_seperated_aid, desc=f"get_dict at {self.dirname.name}"):
+        for i in tqdm.trange(self.n_seperated_aid, desc=f"get_dict at {self.name}"):
             top_20_df = self.get_top_df(i, top)
             top_20_dict.update(top_20_df.groupby("aid_x")["aid_y"].apply(tuple).to_dict())
 
@@ -106,54 +213,523 @@ class CoVisitationMatrix:
 
         return top_20_dict
 
-    def make(self, max_timedelta: np.timedelta64):
+    def get_index(self, top=20) -> TopKIndex:
+        """The same lookup as get_dict in CSR arrays, loaded memory-mapped from top{top}/index/"""
+        self._check_made()
+        target_dir_path = self.dirname / f"top{top}" / "index"
+        if all((target_dir_path / f"{fn}.npy").exists() for fn in TopKIndex.file_names):
+            return TopKIndex.load(target_dir_path)
+
+        top_df = pd.concat([
+            self.get_top_df(i, top)
+            for i in tqdm.trange(self.n_seperated_aid, desc=f"get_index at {self.name}")
+        ])
+        TopKIndex.from_top_df(top_df, n_aids=int(self.aid_edges[-1])).save(target_dir_path)
+        return TopKIndex.load(target_dir_path)
+
+    def _get_cache_params(self, max_timedelta: np.timedelta64, data_fingerprint: Optional[str] = None):
+        params = {
+            "data": _caching.get_data_fingerprint(self.all_train_df) if data_fingerprint is None else data_fingerprint,
+            "n_seperated_aid": self.n_seperated_aid,
+            "aid_edges": self.aid_edges.tolist(),
+            "types_to_use": self.types_to_use,
+            "weight_func": self.weight_func_fingerprint,
+            "max_timedelta": str(max_timedelta.astype("m8[ms]")),
+            "n_recent_events": _backends.n_recent_events,
+        }
+        if self.rounds_weight:
+            # not to reuse the entries built before the WeightSpec totals were rounded
+            params["weight_rounding"] = "round"
+        return params
+
+    def _open_cache_entry(self, max_timedelta: np.timedelta64, data_fingerprint: Optional[str] = None):
+        params = self._get_cache_params(max_timedelta, data_fingerprint)
+        self.cache_key = _caching.get_key(params)
+        self.dirname = _caching.open_entry(self.store_dir_path, self.cache_key, params)
+
+    def _evict_cache(self):
+        _caching.evict(self.store_dir_path, self.max_cache_gb, keep=[self.dirname])
+
+    def _set_tops(self, tops: Optional[Sequence[int]], keep_full_weight: bool):
+        if not keep_full_weight and not tops:
+            raise ValueError("tops must be given when keep_full_weight is False")
+        self.tops = None if not tops else sorted(set(tops))
+        self.keep_full_weight = keep_full_weight
+
+    def make(
+            self, max_timedelta: np.timedelta64, single_pass: bool = False,
+            n_jobs: int = 1, max_memory_gb_per_worker: Optional[Union[float, int]] = None,
+            tops: Optional[Sequence[int]] = None, keep_full_weight: bool = True
+    ):
+        """
+        tops are the k of get_top_df(i, k) selected right after each bucket is aggregated, without reading
+        and sorting the full weight table again. The full weight table is not saved if keep_full_weight is False,
+        in which case only the given tops are available.
+        """
+        self._set_tops(tops, keep_full_weight)
+        self._open_cache_entry(max_timedelta)
+        self._make(max_timedelta, single_pass, n_jobs, max_memory_gb_per_worker)
+        self._evict_cache()
+
+    def _make(
+            self, max_timedelta: np.timedelta64, single_pass: bool,
+            n_jobs: int, max_memory_gb_per_worker: Optional[Union[float, int]]
+    ):
+        if n_jobs > 1:
+            if single_pass:
+                raise ValueError("single_pass can not be used with n_jobs > 1")
+            self._make_in_parallel(max_timedelta, n_jobs, max_memory_gb_per_worker)
+            return
+
+        if single_pass:
+            self._make_in_single_pass(max_timedelta)
+            return
+
+        missing_i_seperated_aids = self._get_missing_i_seperated_aids()
         for i_seperated_aid in range(self.n_seperated_aid):
-            print(f"({i_seperated_aid + 1}/{self.n_seperated_aid}) split aid at {'/'.join(self.dirname.parts[-2:])}")
-            target_fn = self.dirname / f"{i_seperated_aid}.parquet"
-            if target_fn.exists():
+            print(f"({i_seperated_aid + 1}/{self.n_seperated_aid}) split aid at {self.name}")
+            if i_seperated_aid not in missing_i_seperated_aids:
                 continue
 
-            self.total_weight_cudf: Optional[cudf.DataFrame] = None
-            for df in tqdm.tqdm(self.df_list, desc="iter over split df"):
+            self.total_weight = None
+            for df in tqdm.tqdm(
+                    self._iter_chunks(self.df_list, self.max_memory_gb_for_each_split_aid), desc="iter over split df"
+            ):
                 self.each_step(df, i_seperated_aid, max_timedelta)
-            total_weight_df = self.total_weight_cudf.to_pandas()
-            total_weight_df.reset_index().to_parquet(target_fn)
+            total_weight_df = self.backend.to_pandas(self.total_weight)
+            self._save_total_weight(i_seperated_aid, total_weight_df.reset_index())
+
+    def _make_in_single_pass(self, max_timedelta: np.timedelta64):
+        """
+        Generates the pairs of every aid bucket at once for each chunk and scatters them into per-bucket
+        accumulators, so the data is scanned once regardless of n_seperated_aid.
+        The accumulators share max_memory_gb_for_each_split_aid as one budget,
+        and the largest of them spills to disk whenever their total exceeds it.
+        """
+        accumulators = self._get_accumulators()
+        if len(accumulators) == 0:
+            return
+        print(f"split aid {list(accumulators.keys())} in single pass at {self.name}")
+
+        aid_x_range = (self.aid_edges[min(accumulators.keys())], self.aid_edges[max(accumulators.keys()) + 1])
+        for df in tqdm.tqdm(
+                self._iter_chunks(self.df_list, self.max_memory_gb_for_each_split_aid), desc="iter over split df"
+        ):
+            self._scatter(self._get_chunk_total_weight(df, aid_x_range, max_timedelta), accumulators)
+        self._save_accumulators(accumulators)
+
+    def _get_missing_i_seperated_aids(self):
+        def _is_made(i_seperated_aid):
+            if (self.dirname / f"{i_seperated_aid}.parquet").exists():
+                return True
+            return not self.keep_full_weight and all(
+                (self.dirname / f"top{top}" / f"{i_seperated_aid}.parquet").exists() for top in self.tops
+            )
+
+        return [
+            i_seperated_aid
+            for i_seperated_aid in range(self.n_seperated_aid)
+            if not _is_made(i_seperated_aid)
+        ]
+
+    def _get_accumulators(self):
+        spill_dir_path = self.dirname / "spill"
+        if spill_dir_path.exists():
+            shutil.rmtree(spill_dir_path)
+        budget = _MemoryBudget(self.max_memory_gb_for_each_split_aid)
+        return {
+            i_seperated_aid: _WeightAccumulator(spill_dir_path / f"{i_seperated_aid}", budget)
+            for i_seperated_aid in self._get_missing_i_seperated_aids()
+        }
+
+    def _scatter(self, chunk_total_weight_xdf, accumulators):
+        chunk_total_weight_df = self.backend.to_pandas(chunk_total_weight_xdf).reset_index()
+        i_seperated_aid_of_each_pair = np.searchsorted(
+            self.aid_edges, chunk_total_weight_df["aid_x"].to_numpy(), side="right"
+        ) - 1
+        order = np.argsort(i_seperated_aid_of_each_pair, kind="stable")
+        edges = np.searchsorted(i_seperated_aid_of_each_pair[order], np.arange(self.n_seperated_aid + 1))
+        for i_seperated_aid, accumulator in accumulators.items():
+            accumulator.add(chunk_total_weight_df.iloc[order[edges[i_seperated_aid]:edges[i_seperated_aid + 1]]])
+
+    def _save_accumulators(self, accumulators):
+        for i_seperated_aid, accumulator in accumulators.items():
+            self._save_total_weight(i_seperated_aid, accumulator.get_total_weight().reset_index())
+        shutil.rmtree(self.dirname / "spill", ignore_errors=True)
+
+    def _make_in_parallel(
+            self, max_timedelta: np.timedelta64, n_jobs: int, max_memory_gb_per_worker: Optional[Union[float, int]]
+    ):
+        """
+        Builds the aid buckets concurrently in n_jobs worker processes.
+        The workers read the training data through memory-mapped .npy files instead of receiving df_list,
+        and each worker splits it into chunks by max_memory_gb_per_worker
+        (max_memory_gb_for_each_split_aid / n_jobs by default).
+        """
+        if isinstance(self.backend, _backends.CuDFBackend):
+            raise ValueError("n_jobs > 1 is only supported by the CPU backends")
+        if max_memory_gb_per_worker is None:
+            max_memory_gb_per_worker = self.max_memory_gb_for_each_split_aid / n_jobs
+
+        i_seperated_aids = self._get_missing_i_seperated_aids()
+        if len(i_seperated_aids) == 0:
+            return
+
+        # fork so that weight_func (often a lambda or a closure) does not have to be pickled
+        worker_cv_matrix = copy.copy(self)
+        if isinstance(self.all_train_df, _data_module.TidyDataChunks):
+            # the workers read the chunks from the on-disk cache by themselves
+            shared_arrays_dir_path = indices_to_divide = None
+        elif isinstance(self.all_train_df, _data_module.CompactTidyData):
+            # the forked workers share the compact arrays, and decode the chunks by themselves
+            shared_arrays_dir_path = indices_to_divide = None
+            worker_cv_matrix.df_list = self._divide(
+                self.all_train_df, max_memory_gb_per_worker, self.indices_in_all_sessions
+            )
+        else:
+            shared_arrays_dir_path = self.dirname / "shared-arrays"
+        try:
+            if shared_arrays_dir_path is not None:
+                shared_arrays_dir_path.mkdir(exist_ok=True)
+                for col in self.all_train_df.columns:
+                    np.save(shared_arrays_dir_path / f"{col}.npy", self.all_train_df[col].to_numpy())
+                indices_to_divide = self._get_indices_to_divide(max_memory_gb_per_worker)
+                worker_cv_matrix.all_train_df = worker_cv_matrix.df_list = None
+            with concurrent.futures.ProcessPoolExecutor(
+                    n_jobs, mp_context=multiprocessing.get_context("fork"),
+                    initializer=_init_worker,
+                    initargs=(
+                        worker_cv_matrix, shared_arrays_dir_path, indices_to_divide, max_timedelta,
+                        max_memory_gb_per_worker
+                    )
+            ) as executor:
+                for _ in tqdm.tqdm(
+                        executor.map(_make_split_aid_in_worker, i_seperated_aids), total=len(i_seperated_aids),
+                        desc=f"split aid with {n_jobs} workers at {self.name}"
+                ):
+                    pass
+        finally:
+            # not to leave the copy of the training data in the cache entry even if a worker fails
+            if shared_arrays_dir_path is not None:
+                shutil.rmtree(shared_arrays_dir_path, ignore_errors=True)
+
+    def update(self, new_sessions_df, max_timedelta: np.timedelta64, decay: Optional[float] = None):
+        """
+        Adds the pairs of new_sessions_df (a DataFrame, data.TidyDataChunks or data.CompactTidyData)
+        to the buckets made by make,
+        after multiplying the existing weights by decay if given.
+        The sessions in new_sessions_df are assumed not to be in the data the buckets were made from.
+        The cached top-k files, dicts and indexes are refreshed only for the aid_x whose pairs changed
+        (the other weights are just multiplied by decay).
+        The updated matrix is a new entry of the cache keyed by the original entry and the update,
+        so the original is left as it is and the same update is reused.
+        """
+        if not all((self.dirname / f"{i}.parquet").exists() for i in range(self.n_seperated_aid)):
+            raise ValueError("update needs all the full buckets made by make with keep_full_weight=True")
+
+        if isinstance(new_sessions_df, _data_module.TidyDataChunks):
+            max_aid = new_sessions_df.get_max_aid()
+            df_list = new_sessions_df
+        else:
+            max_aid = int(new_sessions_df["aid"].max()) if len(new_sessions_df) > 0 else -1
+            self.dtype_itemsize = _get_dtype_itemsize(new_sessions_df)
+            df_list = self._divide(
+                new_sessions_df, self.max_memory_gb_for_each_split_aid, _get_session_starts(new_sessions_df)
+            )
+        if max_aid >= self.aid_edges[-1]:
+            raise ValueError(f"new aid {max_aid} is out of the buckets (< {self.aid_edges[-1]}). Remake the matrix")
+
+        params = {
+            "base": str(self.dirname) if self.cache_key is None else self.cache_key,
+            "new_data": _caching.get_data_fingerprint(new_sessions_df),
+            "max_timedelta": str(max_timedelta.astype("m8[ms]")),
+            "decay": decay,
+            "n_recent_events": _backends.n_recent_events,
+        }
+        base_dir_path = self.dirname
+        self.cache_key = _caching.get_key(params)
+        self.dirname = _caching.open_entry(self.store_dir_path, self.cache_key, params)
+        if len(self._get_missing_i_seperated_aids()) == 0:
+            print(f"reuse the update at {self.name}")
+            self._evict_cache()
+            return
+        shutil.copytree(
+            base_dir_path, self.dirname, dirs_exist_ok=True,
+            ignore=shutil.ignore_patterns(_caching.manifest_file_name, "update-spill")
+        )
+
+        print(f"update at {self.name}")
+        spill_dir_path = self.dirname / "update-spill"
+        if spill_dir_path.exists():
+            shutil.rmtree(spill_dir_path)
+        budget = _MemoryBudget(self.max_memory_gb_for_each_split_aid)
+        accumulators = {
+            i_seperated_aid: _WeightAccumulator(spill_dir_path / f"{i_seperated_aid}", budget)
+            for i_seperated_aid in range(self.n_seperated_aid)
+        }
+        aid_x_range = (self.aid_edges[0], self.aid_edges[-1])
+        for df in tqdm.tqdm(
+                self._iter_chunks(df_list, self.max_memory_gb_for_each_split_aid), desc="iter over split df"
+        ):
+            self._scatter(self._get_chunk_total_weight(df, aid_x_range, max_timedelta), accumulators)
+
+        top_dir_paths = sorted(self.dirname.glob("top*"))
+        changed_aids_list = []
+        for i_seperated_aid, accumulator in accumulators.items():
+            new_total_weight = accumulator.get_total_weight()
+            total_weight = self.get_df(i_seperated_aid).set_index(["aid_x", "aid_y"])["weight"]
+            if decay is not None:
+                total_weight = _decay(total_weight, decay)
+            total_weight = total_weight.add(new_total_weight, fill_value=0).astype(np.int32)
+            total_weight_df = total_weight.reset_index()
+            total_weight_df.to_parquet(self.dirname / f"{i_seperated_aid}.parquet")
+
+            changed_aids = new_total_weight.index.get_level_values("aid_x").unique().to_numpy()
+            changed_aids_list.append(changed_aids)
+            for top_dir_path in top_dir_paths:
+                target_fn = top_dir_path / f"{i_seperated_aid}.parquet"
+                if not target_fn.exists():
+                    continue
+                top_df = pd.read_parquet(target_fn)
+                if decay is not None:
+                    top_df["weight"] = _decay(top_df["weight"], decay)
+                pd.concat([
+                    top_df.loc[~top_df["aid_x"].isin(changed_aids)],
+                    self._select_top(
+                        total_weight_df.loc[total_weight_df["aid_x"].isin(changed_aids)], int(top_dir_path.name[3:])
+                    )
+                ]).sort_values("aid_x", kind="stable").reset_index(drop=True).to_parquet(target_fn)
+        shutil.rmtree(spill_dir_path, ignore_errors=True)
+
+        changed_aids = np.concatenate(changed_aids_list)
+        for top_dir_path in top_dir_paths:
+            top = int(top_dir_path.name[3:])
+            changed_top_df = pd.concat([
+                self.get_top_df(i_seperated_aid, top).pipe(lambda df: df.loc[df["aid_x"].isin(changed_aids)])
+                for i_seperated_aid in range(self.n_seperated_aid)
+            ])
+            if (top_dir_path / "top.json").exists():
+                top_dict = self.get_dict(top)
+                top_dict.update(changed_top_df.groupby("aid_x")["aid_y"].apply(tuple).to_dict())
+                with open(top_dir_path / "top.json", "w") as f:
+                    json.dump(top_dict, f)
+            index_dir_path = top_dir_path / "index"
+            if all((index_dir_path / f"{fn}.npy").exists() for fn in TopKIndex.file_names):
+                index = TopKIndex.load(index_dir_path, mmap_mode=None)
+                if decay is not None:
+                    index.weights = _decay(index.weights, decay)
+                index.replace(changed_aids, changed_top_df).save(index_dir_path)
+        self._evict_cache()
 
     def each_step(self, chunk_df, i_seperated_aid: int, max_timedelta: np.timedelta64):
         assert isinstance(i_seperated_aid, int)
         assert isinstance(max_timedelta, np.timedelta64)
 
-        chunk_cudf = cudf.from_pandas(chunk_df)
-        if self.types_to_use is not None:
-            chunk_cudf = chunk_cudf.loc[chunk_cudf["type"].isin(self.types_to_use)]
-
-        if True:
-            warnings.warn("* n < 30")
-            chunk_cudf = chunk_cudf.sort_values(['session', 'ts'], ascending=[True, False])
-            chunk_cudf = chunk_cudf.reset_index(drop=True)
-            chunk_cudf['n'] = chunk_cudf.groupby('session').cumcount()
-            chunk_cudf = chunk_cudf.loc[chunk_cudf["n"] < 30].drop('n', axis=1)
-
-        chunk_cudf = chunk_cudf.merge(chunk_cudf, on="session")
-        aid_edges = self.aid_edges
-        chunk_cudf = chunk_cudf.query(
-            "@aid_edges[@i_seperated_aid] <= aid_x < @aid_edges[@i_seperated_aid + 1]"
+        chunk_total_weight_xdf = self._get_chunk_total_weight(
+            chunk_df, self.aid_edges[i_seperated_aid:i_seperated_aid + 2], max_timedelta
         )
-        chunk_cudf = chunk_cudf.query(
-            "-@max_timedelta < ts_x - ts_y < @max_timedelta"
+        self.total_weight = self.backend.add(self.total_weight, chunk_total_weight_xdf)
+        del chunk_total_weight_xdf
+
+    def _get_chunk_total_weight(self, chunk_df, aid_x_range, max_timedelta: np.timedelta64):
+        return self._get_total_weight_of_pairs(
+            self.backend.get_pair_df(
+                chunk_df, self.types_to_use, aid_x_range, max_timedelta, with_position=self.uses_position
+            )
         )
-        chunk_cudf.drop_duplicates(["session", "aid_x", "aid_y"], inplace=True)
 
-        ret = self.weight_func(chunk_cudf)
+    def _get_total_weight_of_pairs(self, pair_xdf):
+        ret = self.weight_func(pair_xdf)
         if isinstance(ret, dict):
-            chunk_cudf["weight"] = chunk_cudf["type_y"].map(ret)
+            pair_xdf["weight"] = pair_xdf["type_y"].map(ret)
         else:
-            chunk_cudf["weight"] = ret
+            pair_xdf["weight"] = ret
 
-        chunk_total_weight_cudf = chunk_cudf.groupby(["aid_x", "aid_y"])["weight"].sum().astype(np.int32)
+        total_weight = pair_xdf.groupby(["aid_x", "aid_y"])["weight"].sum()
+        if self.rounds_weight:
+            # the float weights of a WeightSpec are rounded to the nearest int as _decay
+            total_weight = total_weight.round()
+        return total_weight.astype(np.int32)
 
-        if self.total_weight_cudf is None:
-            self.total_weight_cudf = chunk_total_weight_cudf
-        else:
-            self.total_weight_cudf = self.total_weight_cudf.add(chunk_total_weight_cudf, fill_value=0)
-        del chunk_total_weight_cudf
+
+def _get_session_starts(df):
+    """The indices at which the sessions of df start"""
+    if isinstance(df, _data_module.CompactTidyData):
+        return np.asarray(df.offsets[:-1])
+    _, indices_in_all_sessions = np.unique(df["session"], return_index=True)
+    return indices_in_all_sessions
+
+
+def _get_dtype_itemsize(df):
+    """The bytes per event by which the memory of the pairs is estimated, in the dtypes the pairs are generated in"""
+    if isinstance(df, _data_module.CompactTidyData):
+        return sum(_data_module.tidy_data_dtype[name].itemsize for name in df.columns)
+    return sum(dtype.itemsize for dtype in df.dtypes)
+
+
+def _decay(weight, decay: float):
+    return (weight * decay).round().astype(np.int32)
+
+
+def make_co_visitation_matrixes(
+        cv_matrixes: List[CoVisitationMatrix], max_timedeltas: List[np.timedelta64],
+        tops: Optional[Sequence[int]] = None, keep_full_weight: bool = True
+):
+    """
+    Equivalent to cv_matrix.make(max_timedelta, single_pass=True, tops=tops, keep_full_weight=keep_full_weight)
+    for each pair of the given arguments,
+    but the candidate pairs are generated once per chunk at the widest max_timedelta
+    and shared by every matrix with the same types_to_use.
+    Each matrix then only filters the shared pairs by its own max_timedelta before drop_duplicates and weight_func.
+    The matrixes with different types_to_use, e.g. buy2buy ([1, 2]) and the ones of all the types (None),
+    still get a pass each: only the backends.n_recent_events most recent events of the used types are paired,
+    so filtering the pairs of all the types by type_x/type_y would drop the pairs of the older carts and orders
+    (and shift the positions) instead of giving the same matrix.
+    The accumulators of each matrix share its max_memory_gb_for_each_split_aid as in make(single_pass=True).
+
+    The matrixes must be made from the same all_train_df.
+    """
+    if len(cv_matrixes) != len(max_timedeltas):
+        raise ValueError("cv_matrixes and max_timedeltas must have the same length")
+    if any(cv_matrix.all_train_df is not cv_matrixes[0].all_train_df for cv_matrix in cv_matrixes):
+        raise ValueError("all the given cv_matrixes must be made from the same all_train_df")
+
+    # the data is hashed once for all the matrixes
+    data_fingerprint = None if len(cv_matrixes) == 0 else _caching.get_data_fingerprint(cv_matrixes[0].all_train_df)
+    for cv_matrix, max_timedelta in zip(cv_matrixes, max_timedeltas):
+        cv_matrix._set_tops(tops, keep_full_weight)
+        cv_matrix._open_cache_entry(max_timedelta, data_fingerprint)
+
+    # the 30-event truncation is done after filtering types_to_use, so the pairs can be shared only among them
+    groups = {}
+    for cv_matrix, max_timedelta in zip(cv_matrixes, max_timedeltas):
+        types_to_use = None if cv_matrix.types_to_use is None else tuple(sorted(cv_matrix.types_to_use))
+        groups.setdefault(types_to_use, []).append((cv_matrix, max_timedelta))
+
+    for types_to_use, cv_matrix_and_max_timedelta_list in groups.items():
+        cv_matrix_and_accumulators_list = [
+            (cv_matrix, max_timedelta, cv_matrix._get_accumulators())
+            for cv_matrix, max_timedelta in cv_matrix_and_max_timedelta_list
+        ]
+        cv_matrix_and_accumulators_list = [
+            (cv_matrix, max_timedelta, accumulators)
+            for cv_matrix, max_timedelta, accumulators in cv_matrix_and_accumulators_list
+            if len(accumulators) > 0
+        ]
+        if len(cv_matrix_and_accumulators_list) == 0:
+            continue
+
+        print(
+            "split aid in single pass shared by " +
+            ", ".join(
+                cv_matrix.name
+                for cv_matrix, _, _ in cv_matrix_and_accumulators_list
+            )
+        )
+        first_cv_matrix, _, _ = cv_matrix_and_accumulators_list[0]
+        widest_max_timedelta = max(max_timedelta for _, max_timedelta, _ in cv_matrix_and_accumulators_list)
+        aid_x_range = (
+            min(cv_matrix.aid_edges[0] for cv_matrix, _, _ in cv_matrix_and_accumulators_list),
+            max(cv_matrix.aid_edges[-1] for cv_matrix, _, _ in cv_matrix_and_accumulators_list)
+        )
+
+        for df in tqdm.tqdm(
+                first_cv_matrix._iter_chunks(
+                    first_cv_matrix.df_list, first_cv_matrix.max_memory_gb_for_each_split_aid
+                ),
+                desc="iter over split df"
+        ):
+            candidate_pair_xdf = first_cv_matrix.backend.get_candidate_pair_df(
+                df, types_to_use, aid_x_range, widest_max_timedelta,
+                with_position=any(cv_matrix.uses_position for cv_matrix, _, _ in cv_matrix_and_accumulators_list)
+            )
+            for cv_matrix, max_timedelta, accumulators in cv_matrix_and_accumulators_list:
+                pair_xdf = candidate_pair_xdf
+                if max_timedelta < widest_max_timedelta:
+                    pair_xdf = pair_xdf.query("-@max_timedelta < ts_x - ts_y < @max_timedelta")
+                pair_xdf = pair_xdf.drop_duplicates(["session", "aid_x", "aid_y"])
+                cv_matrix._scatter(cv_matrix._get_total_weight_of_pairs(pair_xdf), accumulators)
+
+        for cv_matrix, _, accumulators in cv_matrix_and_accumulators_list:
+            cv_matrix._save_accumulators(accumulators)
+
+    for cv_matrix in cv_matrixes:
+        cv_matrix._evict_cache()
+
+
+_worker_args = None
+
+
+def _init_worker(cv_matrix, shared_arrays_dir_path, indices_to_divide, max_timedelta, max_memory_gb):
+    global _worker_args
+    _worker_args = cv_matrix, shared_arrays_dir_path, indices_to_divide, max_timedelta, max_memory_gb
+
+
+def _make_split_aid_in_worker(i_seperated_aid):
+    cv_matrix, shared_arrays_dir_path, indices_to_divide, max_timedelta, max_memory_gb = _worker_args
+    cv_matrix.total_weight = None
+    if shared_arrays_dir_path is None:
+        for chunk_df in cv_matrix._iter_chunks(cv_matrix.df_list, max_memory_gb):
+            cv_matrix.each_step(chunk_df, i_seperated_aid, max_timedelta)
+    else:
+        arrays = {
+            fn.stem: np.load(fn, mmap_mode="r")
+            for fn in sorted(shared_arrays_dir_path.glob("*.npy"))
+        }
+        n_records = len(next(iter(arrays.values())))
+        for f, l in zip(indices_to_divide, [*indices_to_divide[1:], n_records]):
+            chunk_df = pd.DataFrame({col: array[f:l] for col, array in arrays.items()})
+            cv_matrix.each_step(chunk_df, i_seperated_aid, max_timedelta)
+    total_weight_df = cv_matrix.backend.to_pandas(cv_matrix.total_weight)
+    cv_matrix._save_total_weight(i_seperated_aid, total_weight_df.reset_index())
+    return i_seperated_aid
+
+
+class _MemoryBudget:
+    """The memory shared by _WeightAccumulators, the largest of which spills when their total exceeds max_memory_gb"""
+
+    def __init__(self, max_memory_gb: Union[float, int]):
+        self.max_memory_gb = max_memory_gb
+        self.accumulators = []
+
+    def fit(self):
+        while sum(accumulator.n_bytes for accumulator in self.accumulators) > self.max_memory_gb * 1e9:
+            max(self.accumulators, key=lambda accumulator: accumulator.n_bytes).spill()
+
+
+class _WeightAccumulator:
+    def __init__(self, spill_dir_path: pathlib.Path, budget: _MemoryBudget):
+        self.spill_dir_path = spill_dir_path
+        self.budget = budget
+        self.budget.accumulators.append(self)
+        self.df_list = []
+        self.n_bytes = 0
+        self.n_spilled = 0
+
+    def add(self, total_weight_df):
+        if len(total_weight_df) == 0:
+            return
+        self.df_list.append(total_weight_df)
+        self.n_bytes += total_weight_df.memory_usage(index=False, deep=False).sum()
+        self.budget.fit()
+
+    def spill(self):
+        self.spill_dir_path.mkdir(exist_ok=True, parents=True)
+        self._reduce(self.df_list).reset_index().to_parquet(self.spill_dir_path / f"{self.n_spilled}.parquet")
+        self.n_spilled += 1
+        self.df_list = []
+        self.n_bytes = 0
+
+    def get_total_weight(self):
+        return self._reduce([
+            *(pd.read_parquet(self.spill_dir_path / f"{i}.parquet") for i in range(self.n_spilled)),
+            *self.df_list
+        ])
+
+    @staticmethod
+    def _reduce(df_list):
+        if len(df_list) == 0:
+            return pd.Series(
+                [], index=pd.MultiIndex.from_arrays([[], []], names=["aid_x", "aid_y"]), name="weight", dtype=np.int32
+            )
+        return pd.concat(df_list).groupby(["aid_x", "aid_y"])["weight"].sum().astype(np.int32)
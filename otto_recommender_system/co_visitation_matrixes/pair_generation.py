@@ -0,0 +1,59 @@
+import numpy as np
+
+
+def get_session_starts(sorted_session):
+    return np.flatnonzero(np.r_[True, sorted_session[1:] != sorted_session[:-1]])
+
+
+def get_positions_in_session(sorted_session):
+    starts = get_session_starts(sorted_session)
+    return np.arange(len(sorted_session)) - np.repeat(starts, np.diff(np.r_[starts, len(sorted_session)]))
+
+
+def get_pair_indices(sorted_session, sorted_ts, sorted_aid, aid_x_range, max_timedelta):
+    """
+    Sliding-window alternative to the self-join on session.
+
+    The events must be sorted by session and then by ts (either order). Only the pairs with
+    |ts_x - ts_y| < max_timedelta and aid_x in [aid_x_range[0], aid_x_range[1]) are emitted,
+    so the memory is O(valid pairs) instead of O(sum of n_i^2).
+    Returns the int32 indices (idx_x, idx_y) of the pairs, in no particular order.
+    """
+    n = len(sorted_session)
+    aid_x_min, aid_x_max = aid_x_range
+    is_in_aid_x_range = (aid_x_min <= sorted_aid) & (sorted_aid < aid_x_max)
+
+    # the window only grows with the offset because ts is monotonic within each session,
+    # so a pair that falls out of it can never come back in at a larger offset
+    valid_indices_for_each_offset = []
+    i = np.arange(n - 1, dtype=np.int32)
+    offset = 1
+    while len(i) > 0:
+        j = i + offset
+        i = i[(sorted_session[i] == sorted_session[j]) & (np.abs(sorted_ts[i] - sorted_ts[j]) < max_timedelta)]
+        valid_indices_for_each_offset.append(i)
+        offset += 1
+        i = i[i + offset < n]
+
+    n_pairs = int(np.count_nonzero(is_in_aid_x_range)) + sum(
+        int(np.count_nonzero(is_in_aid_x_range[i])) + int(np.count_nonzero(is_in_aid_x_range[i + offset]))
+        for offset, i in enumerate(valid_indices_for_each_offset, start=1)
+    )
+    idx_x = np.empty(n_pairs, dtype=np.int32)
+    idx_y = np.empty(n_pairs, dtype=np.int32)
+
+    # the pair of each event with itself
+    i = np.flatnonzero(is_in_aid_x_range).astype(np.int32)
+    idx_x[:len(i)] = idx_y[:len(i)] = i
+    n_filled = len(i)
+
+    for offset, i in enumerate(valid_indices_for_each_offset, start=1):
+        j = i + offset
+        for x, y in ((i, j), (j, i)):
+            is_valid = is_in_aid_x_range[x]
+            n_valid = int(np.count_nonzero(is_valid))
+            idx_x[n_filled:n_filled + n_valid] = x[is_valid]
+            idx_y[n_filled:n_filled + n_valid] = y[is_valid]
+            n_filled += n_valid
+    assert n_filled == n_pairs
+    return idx_x, idx_y
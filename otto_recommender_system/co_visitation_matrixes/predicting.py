@@ -1,20 +1,35 @@
 import collections
+import concurrent.futures
+import multiprocessing
 import pathlib
+import shutil
 import tqdm
+import numpy as np
 import pandas as pd
 from .. import data as _data_module
+from .top_k_index import TopKIndex
+from . import pair_generation as _pair_generation
 
 
-def suggest_clicks(df, top_20_clicks_dict, top_20_clicks):
-    unique_aids = set(df["aid"])
+def get_co_visitation_aids(top_20_lookup, aids):
+    """top_20_lookup is either a dict given by CoVisitationMatrix.get_dict or a TopKIndex given by get_index"""
+    if isinstance(top_20_lookup, TopKIndex):
+        neighbors, _ = top_20_lookup.neighbors_many(list(aids))
+        return neighbors.tolist()
 
-    co_visitation_aids = [
+    return [
         co_visitation_aid
-        for aid in unique_aids
-        if aid in top_20_clicks_dict.keys()
-        for co_visitation_aid in top_20_clicks_dict[aid]
+        for aid in aids
+        if aid in top_20_lookup.keys()
+        for co_visitation_aid in top_20_lookup[aid]
     ]
 
+
+def suggest_clicks(df, top_20_clicks_dict, top_20_clicks):
+    unique_aids = set(df["aid"])
+
+    co_visitation_aids = get_co_visitation_aids(top_20_clicks_dict, unique_aids)
+
     top_predicted_without_unique_aids = [
         aid
         for aid, _ in collections.Counter(co_visitation_aids).most_common(20)  # -> (aid, cnt)
@@ -36,19 +51,9 @@ def suggest_buys(df, top_20_buys_dict, top_20_buy2buy_dict, top_20_orders):
     df = df.loc[df["type"].isin([_data_module.all_types.index("carts"), _data_module.all_types.index("orders")])]
     unique_buys_aids = set(df["aid"])
 
-    co_visitation_buys_aids = [
-        co_visitation_aid
-        for aid in unique_aids
-        if aid in top_20_buys_dict.keys()
-        for co_visitation_aid in top_20_buys_dict[aid]
-    ]
+    co_visitation_buys_aids = get_co_visitation_aids(top_20_buys_dict, unique_aids)
 
-    co_visitation_buy2buy_aids = [
-        co_visitation_aid
-        for aid in unique_buys_aids
-        if aid in top_20_buy2buy_dict.keys()
-        for co_visitation_aid in top_20_buy2buy_dict[aid]
-    ]
+    co_visitation_buy2buy_aids = get_co_visitation_aids(top_20_buy2buy_dict, unique_buys_aids)
 
     top_predicted_without_unique_aids = [
         aid
@@ -67,11 +72,335 @@ def suggest_buys(df, top_20_buys_dict, top_20_buy2buy_dict, top_20_orders):
     return top_predicted.union(top_20_orders[:20 - len(top_predicted)])
 
 
+def _get_history_df(target_df):
+    """The unique (session, aid) of target_df, from the most recent to the oldest within each session"""
+    ts = target_df["ts"].to_numpy()
+    if np.issubdtype(ts.dtype, np.datetime64):
+        ts = ts.view(np.int64)
+    order = np.lexsort((-np.arange(len(target_df)), -ts, target_df["session"].to_numpy()))
+    history_df = pd.DataFrame({
+        "session": target_df["session"].to_numpy()[order],
+        "aid": target_df["aid"].to_numpy()[order],
+    })
+    history_df = history_df.drop_duplicates(["session", "aid"], keep="first").reset_index(drop=True)
+    history_df["rank"] = _pair_generation.get_positions_in_session(history_df["session"].to_numpy())
+    return history_df
+
+
+def _get_session_aid_keys(session, aid):
+    return (session.astype(np.int64) << 32) | aid.astype(np.int64)
+
+
+def _is_in_sorted(keys, sorted_keys):
+    indices = np.searchsorted(sorted_keys, keys)
+    indices[indices == len(sorted_keys)] = 0
+    return (len(sorted_keys) > 0) & (sorted_keys[indices] == keys)
+
+
+def _suggest_batch(history_df, candidate_session, candidate_aid, top_20_popular):
+    """
+    Vectorized form of suggest_clicks/suggest_buys over all sessions.
+
+    candidate_session/candidate_aid are the co-visitation aids of each session in the order they are counted,
+    which breaks the ties of the counts like collections.Counter.most_common does.
+    If a session has more than 20 unique aids, the 20 most recent ones are kept.
+    Returns the (session, aid) of the predictions sorted by session.
+    """
+    history_session = history_df["session"].to_numpy()
+    history_aid = history_df["aid"].to_numpy()
+    sorted_history_keys = np.sort(_get_session_aid_keys(history_session, history_aid))
+
+    # most_common(20) within each session
+    keys, first_positions, counts = np.unique(
+        _get_session_aid_keys(candidate_session, candidate_aid), return_index=True, return_counts=True
+    )
+    order = np.lexsort((first_positions, -counts, keys >> 32))
+    keys = keys[order]
+    keys = keys[_pair_generation.get_positions_in_session(keys >> 32) < 20]
+    # if aid not in unique_aids
+    keys = keys[~_is_in_sorted(keys, sorted_history_keys)]
+
+    # unique_aidsを最優先
+    is_kept = history_df["rank"].to_numpy() < 20
+    history_session = history_session[is_kept]
+    history_aid = history_aid[is_kept]
+    sessions, n_predicted = np.unique(history_session, return_counts=True)
+    i_sessions = np.searchsorted(sessions, keys >> 32)
+    keys = keys[_pair_generation.get_positions_in_session(keys >> 32) < 20 - n_predicted[i_sessions]]
+    n_predicted += np.bincount(np.searchsorted(sessions, keys >> 32), minlength=len(sessions))
+
+    # 20に達していないときは、全体で良くクリックされるものを足す
+    top_20_popular = np.asarray(top_20_popular, dtype=np.int64)
+    n_popular = np.clip(20 - n_predicted, 0, len(top_20_popular))
+    popular_keys = _get_session_aid_keys(
+        np.repeat(sessions, n_popular),
+        top_20_popular[np.arange(n_popular.sum()) - np.repeat(np.cumsum(n_popular) - n_popular, n_popular)]
+    )
+    predicted_keys = np.sort(np.concatenate([_get_session_aid_keys(history_session, history_aid), keys]))
+    popular_keys = popular_keys[~_is_in_sorted(popular_keys, predicted_keys)]
+
+    session = np.concatenate([history_session, keys >> 32, popular_keys >> 32])
+    aid = np.concatenate([history_aid, keys & 0xFFFFFFFF, popular_keys & 0xFFFFFFFF])
+    order = np.argsort(session, kind="stable")
+    return pd.DataFrame({
+        "session": session[order].astype(history_df["session"].dtype),
+        "aid": aid[order].astype(history_df["aid"].dtype),
+    })
+
+
+def _as_index(top_20_lookup):
+    return top_20_lookup if isinstance(top_20_lookup, TopKIndex) else TopKIndex.from_dict(top_20_lookup)
+
+
+def suggest_clicks_batch(target_df, top_20_clicks_dict, top_20_clicks):
+    history_df = _get_history_df(target_df)
+    neighbors, n_neighbors = _as_index(top_20_clicks_dict).neighbors_many(history_df["aid"].to_numpy())
+    return _suggest_batch(
+        history_df, np.repeat(history_df["session"].to_numpy(), n_neighbors), neighbors, top_20_clicks
+    )
+
+
+def suggest_buys_batch(target_df, top_20_buys_dict, top_20_buy2buy_dict, top_20_orders):
+    history_df = _get_history_df(target_df)
+    buys_history_df = _get_history_df(target_df.loc[target_df["type"].isin([
+        _data_module.all_types.index("carts"), _data_module.all_types.index("orders")
+    ])])
+
+    buys_neighbors, n_buys_neighbors = _as_index(top_20_buys_dict).neighbors_many(history_df["aid"].to_numpy())
+    buy2buy_neighbors, n_buy2buy_neighbors = _as_index(top_20_buy2buy_dict).neighbors_many(
+        buys_history_df["aid"].to_numpy()
+    )
+
+    # the same order as co_visitation_buys_aids + co_visitation_buy2buy_aids within each session
+    candidate_session = np.concatenate([
+        np.repeat(history_df["session"].to_numpy(), n_buys_neighbors),
+        np.repeat(buys_history_df["session"].to_numpy(), n_buy2buy_neighbors),
+    ])
+    order = np.argsort(candidate_session, kind="stable")
+    return _suggest_batch(
+        history_df, candidate_session[order], np.concatenate([buys_neighbors, buy2buy_neighbors])[order], top_20_orders
+    )
+
+
+def _to_labels_df(predicted_df, suffix):
+    session = predicted_df["session"].to_numpy()
+    aid_str_list = predicted_df["aid"].astype(str).tolist()
+    starts = np.flatnonzero(np.r_[True, session[1:] != session[:-1]])
+    ends = [*starts[1:], len(session)]
+    return pd.DataFrame({
+        "session_type": [f"{s}_{suffix}" for s in session[starts]],
+        "labels": [" ".join(aid_str_list[f:l]) for f, l in zip(starts, ends)],
+    })
+
+
+def _predict(
+        target_df,
+        top_20_clicks_dict, top_20_buys_dict, top_20_buy2buy_dict,
+        top_20_clicks, top_20_orders,
+        predicts_clicks=True, predicts_buys=True, vectorized=False, disable_tqdm=False,
+        session_index=None
+):
+    """
+    Returns (clicks_predicted_df, buys_predicted_df), where the buys session_type is f"{session}_" to be suffixed.
+    session_index is (session_ids, offsets) of target_df as given by data.get_session_index.
+    """
+    clicks_predicted_df = buys_predicted_df = None
+
+    if vectorized:
+        if predicts_clicks:
+            clicks_predicted_df = _to_labels_df(
+                suggest_clicks_batch(target_df, top_20_clicks_dict, top_20_clicks), "clicks"
+            )
+        if predicts_buys:
+            buys_predicted_df = _to_labels_df(
+                suggest_buys_batch(target_df, top_20_buys_dict, top_20_buy2buy_dict, top_20_orders), ""
+            )
+        return clicks_predicted_df, buys_predicted_df
+
+    # a single groupby shared by clicks and buys
+    if session_index is None:
+        session_dfs = target_df.groupby("session")
+    else:
+        session_ids, offsets = session_index
+        session_dfs = (
+            (session, target_df.iloc[first:last])
+            for session, first, last in zip(session_ids.tolist(), offsets[:-1].tolist(), offsets[1:].tolist())
+        )
+
+    clicks_records = []
+    buys_records = []
+    for session, df in tqdm.tqdm(
+            session_dfs, total=None if session_index is None else len(session_index[0]),
+            desc="predicting", disable=disable_tqdm
+    ):
+        if predicts_clicks:
+            clicks_records.append(
+                (f"{session}_clicks", " ".join(map(str, suggest_clicks(df, top_20_clicks_dict, top_20_clicks))))
+            )
+        if predicts_buys:
+            buys_records.append(
+                (f"{session}_", " ".join(map(str, suggest_buys(df, top_20_buys_dict, top_20_buy2buy_dict, top_20_orders))))
+            )
+    if predicts_clicks:
+        clicks_predicted_df = pd.DataFrame(clicks_records, columns=["session_type", "labels"])
+    if predicts_buys:
+        buys_predicted_df = pd.DataFrame(buys_records, columns=["session_type", "labels"])
+    return clicks_predicted_df, buys_predicted_df
+
+
+_worker_args = None
+
+
+def _init_worker(*args):
+    global _worker_args
+    _worker_args = args
+
+
+def _predict_shard_in_worker(i_shard):
+    get_shard, shard_dir_path, lookups_and_kwargs = _worker_args
+    shard_df, shard_session_index = get_shard(i_shard)
+    for predicted_type, predicted_df in zip(
+            ("clicks", "buys"), _predict(shard_df, **lookups_and_kwargs, session_index=shard_session_index)
+    ):
+        if predicted_df is not None:
+            predicted_df.to_parquet(shard_dir_path / f"{predicted_type}_{i_shard}.parquet")
+    return i_shard
+
+
+def _get_shards(target_df, n_shards, session_index=None):
+    """
+    Returns (get_shard, n_shards), where get_shard(i_shard) gives (shard_df, shard_session_index) of a session range.
+    The shards of data.CompactTidyData (or its chunks) are decoded into DataFrames shard by shard.
+    """
+    if isinstance(target_df, _data_module.TidyDataChunks):
+        # the chunks are the shards
+        def get_shard(i_shard):
+            chunk_df = target_df.get_chunk(i_shard)
+            if isinstance(chunk_df, _data_module.CompactTidyData):
+                return chunk_df.to_pandas(), (chunk_df.session_ids, chunk_df.offsets)
+            return chunk_df, _data_module.make_session_index(chunk_df["session"].to_numpy())
+        return get_shard, len(target_df)
+
+    if isinstance(target_df, _data_module.CompactTidyData):
+        session_index = target_df.session_ids, target_df.offsets
+
+    if session_index is None:
+        sessions = np.unique(target_df["session"].to_numpy())
+        n_shards = min(n_shards, len(sessions))
+        session_edges = [
+            *sessions[np.linspace(0, len(sessions), n_shards + 1).astype(int)[:-1]],
+            sessions[-1] + 1
+        ]
+
+        def get_shard(i_shard):
+            session = target_df["session"].to_numpy()
+            return target_df.loc[
+                (session_edges[i_shard] <= session) & (session < session_edges[i_shard + 1])
+            ], None
+        return get_shard, n_shards
+
+    session_ids, offsets = session_index
+    n_shards = min(n_shards, len(session_ids))
+    session_bounds = np.linspace(0, len(session_ids), n_shards + 1).astype(int)
+
+    def get_shard(i_shard):
+        first, last = session_bounds[i_shard], session_bounds[i_shard + 1]
+        if isinstance(target_df, _data_module.CompactTidyData):
+            shard_df = target_df.get_rows(offsets[first], offsets[last]).to_pandas()
+        else:
+            shard_df = target_df.iloc[offsets[first]:offsets[last]]
+        return shard_df, (session_ids[first:last], offsets[first:last + 1] - offsets[first])
+    return get_shard, n_shards
+
+
+def _predict_in_shards(get_shard, n_shards, shard_dir_path, n_jobs, **lookups_and_kwargs):
+    """
+    _predict over the shards in n_jobs worker processes (or in this process if n_jobs is 1).
+    The workers are forked, so target_df and the lookups are shared copy-on-write (or memory-mapped for TopKIndex).
+    Each shard is written under shard_dir_path and then merged in order.
+    """
+    if shard_dir_path.exists():
+        shutil.rmtree(shard_dir_path)
+    shard_dir_path.mkdir(parents=True)
+
+    initargs = (get_shard, shard_dir_path, dict(lookups_and_kwargs, disable_tqdm=True))
+    if n_jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+                n_jobs, mp_context=multiprocessing.get_context("fork"),
+                initializer=_init_worker, initargs=initargs
+        ) as executor:
+            for _ in tqdm.tqdm(
+                    executor.map(_predict_shard_in_worker, range(n_shards)), total=n_shards,
+                    desc=f"predicting with {n_jobs} workers"
+            ):
+                pass
+    else:
+        _init_worker(*initargs)
+        for i_shard in tqdm.trange(n_shards, desc="predicting"):
+            _predict_shard_in_worker(i_shard)
+
+    predicted_dfs = tuple(
+        pd.concat([
+            pd.read_parquet(shard_dir_path / f"{predicted_type}_{i_shard}.parquet")
+            for i_shard in range(n_shards)
+        ], ignore_index=True)
+        if lookups_and_kwargs[f"predicts_{predicted_type}"] else None
+        for predicted_type in ("clicks", "buys")
+    )
+    shutil.rmtree(shard_dir_path)
+    return predicted_dfs
+
+
+def _get_top_20_aids(chunk_dfs, types):
+    """
+    The 20 most frequent aids of each type in the concatenated chunk_dfs as value_counts, with the ties ordered
+    by their first appearance, counted chunk by chunk so that only the counts are kept in memory
+    """
+    counts = {type_: np.zeros(0, dtype=np.int64) for type_ in types}
+    first_positions = {type_: np.zeros(0, dtype=np.int64) for type_ in types}
+    offset = 0
+    for chunk_df in chunk_dfs:
+        aid = chunk_df["aid"].to_numpy()
+        type_of_each_event = chunk_df["type"].to_numpy()
+        for type_ in types:
+            positions = np.flatnonzero(type_of_each_event == _data_module.all_types.index(type_))
+            unique_aids, first_indices, chunk_counts = np.unique(
+                aid[positions], return_index=True, return_counts=True
+            )
+            if len(unique_aids) == 0:
+                continue
+            n_aids = max(len(counts[type_]), int(unique_aids[-1]) + 1)
+            if n_aids > len(counts[type_]):
+                n_new_aids = n_aids - len(counts[type_])
+                counts[type_] = np.r_[counts[type_], np.zeros(n_new_aids, dtype=np.int64)]
+                first_positions[type_] = np.r_[first_positions[type_], np.full(n_new_aids, np.iinfo(np.int64).max)]
+            counts[type_][unique_aids] += chunk_counts
+            first_positions[type_][unique_aids] = np.minimum(
+                first_positions[type_][unique_aids], offset + positions[first_indices]
+            )
+        offset += len(chunk_df)
+
+    top_20_aids = {}
+    for type_ in types:
+        aids = np.flatnonzero(counts[type_])
+        order = np.lexsort((first_positions[type_][aids], -counts[type_][aids]))
+        top_20_aids[type_] = aids[order[:20]].tolist()
+    return top_20_aids
+
+
 def get_predictions_df(
         dataset_type, target_df,
         top_20_clicks_dict, top_20_buys_dict, top_20_buy2buy_dict,
-        cache_dir_path
+        cache_dir_path,
+        vectorized: bool = False,
+        n_jobs: int = 1,
+        session_index=None
 ):
+    """
+    target_df may be data.TidyDataChunks, whose chunks are predicted one by one (in n_jobs workers),
+    or data.CompactTidyData, which is predicted in shards of session ranges decoded one by one.
+    session_index is (session_ids, offsets) of target_df as given by data.get_session_index.
+    """
     if dataset_type in ("validation", "test"):
         pass
     else:
@@ -80,35 +409,44 @@ def get_predictions_df(
     cache_dir_path = pathlib.Path(cache_dir_path)
     (cache_dir_path / dataset_type).mkdir(exist_ok=True)
 
-    target_fn = cache_dir_path / dataset_type / "predicted_clicks.parquet"
-    if target_fn.exists():
-        clicks_predicted_df = pd.read_parquet(target_fn)
-    else:
-        top_20_clicks = target_df.loc[
-                            target_df["type"] == _data_module.all_types.index("clicks"),
-                            "aid"
-                        ].value_counts().index[:20].tolist()
-
-        clicks_predicted_df = pd.DataFrame([
-            (f"{session}_clicks", " ".join(map(str, suggest_clicks(df, top_20_clicks_dict, top_20_clicks))))
-            for session, df in tqdm.tqdm(target_df.groupby("session"), desc="predicting clicks")
-        ], columns=["session_type", "labels"])
-        clicks_predicted_df.to_parquet(target_fn)
-
-    target_fn = cache_dir_path / dataset_type / "predicted_buys.parquet"
-    if target_fn.exists():
-        buys_predicted_df = pd.read_parquet(target_fn)
-    else:
-        top_20_orders = target_df.loc[
-                            target_df["type"] == _data_module.all_types.index("orders"),
-                            "aid"
-                        ].value_counts().index[:20].tolist()
-
-        buys_predicted_df = pd.DataFrame([
-            (f"{session}_", " ".join(map(str, suggest_buys(df, top_20_buys_dict, top_20_buy2buy_dict, top_20_orders))))
-            for session, df in tqdm.tqdm(target_df.groupby("session"), desc="predicting buys")
-        ], columns=["session_type", "labels"])
-        buys_predicted_df.to_parquet(target_fn)
+    clicks_target_fn = cache_dir_path / dataset_type / "predicted_clicks.parquet"
+    buys_target_fn = cache_dir_path / dataset_type / "predicted_buys.parquet"
+
+    if not (clicks_target_fn.exists() and buys_target_fn.exists()):
+        top_20_aids = _get_top_20_aids(
+            target_df if isinstance(target_df, _data_module.TidyDataChunks) else [target_df], ["clicks", "orders"]
+        )
+        top_20_clicks = top_20_aids["clicks"]
+        top_20_orders = top_20_aids["orders"]
+
+        lookups_and_kwargs = dict(
+            top_20_clicks_dict=top_20_clicks_dict,
+            top_20_buys_dict=top_20_buys_dict,
+            top_20_buy2buy_dict=top_20_buy2buy_dict,
+            top_20_clicks=top_20_clicks,
+            top_20_orders=top_20_orders,
+            predicts_clicks=not clicks_target_fn.exists(),
+            predicts_buys=not buys_target_fn.exists(),
+            vectorized=vectorized
+        )
+        if n_jobs > 1 or isinstance(target_df, (_data_module.TidyDataChunks, _data_module.CompactTidyData)):
+            clicks_predicted_df, buys_predicted_df = _predict_in_shards(
+                *_get_shards(target_df, 4 * n_jobs, session_index),
+                cache_dir_path / dataset_type / "shards", n_jobs, **lookups_and_kwargs
+            )
+        else:
+            clicks_predicted_df, buys_predicted_df = _predict(
+                target_df, **lookups_and_kwargs, session_index=session_index
+            )
+
+        if clicks_predicted_df is not None:
+            clicks_predicted_df.to_parquet(clicks_target_fn)
+        if buys_predicted_df is not None:
+            buys_predicted_df.to_parquet(buys_target_fn)
+
+    clicks_predicted_df = pd.read_parquet(clicks_target_fn)
+    buys_predicted_df = pd.read_parquet(buys_target_fn)
+
     orders_predicted_df = buys_predicted_df.copy()
     orders_predicted_df["session_type"] = orders_predicted_df["session_type"] + "orders"
     carts_predicted_df = buys_predicted_df
@@ -0,0 +1,152 @@
+import pathlib
+import numpy as np
+import pandas as pd
+from typing import Dict, Sequence
+
+
+def get_top_k_indices(aid_x, weight, tops: Sequence[int]) -> Dict[int, np.ndarray]:
+    """
+    The row indices of the top-k weights of each aid_x for each k in tops, in the order of
+    sort_values(["aid_x", "weight"], ascending=[True, False]) and with the ties kept in the row order.
+    Only the segments of aid_x longer than max(tops) are partitioned at max(tops) instead of sorting the whole table,
+    and the smaller k are the prefixes of the same selection.
+    """
+    aid_x = np.asarray(aid_x)
+    weight = np.asarray(weight)
+    max_top = max(tops)
+    if len(aid_x) == 0:
+        return {top: np.empty(0, dtype=np.int64) for top in tops}
+
+    order = np.arange(len(aid_x))
+    if np.any(aid_x[1:] < aid_x[:-1]):
+        order = np.argsort(aid_x, kind="stable")
+    sorted_aid_x = aid_x[order]
+    starts = np.flatnonzero(np.r_[True, sorted_aid_x[1:] != sorted_aid_x[:-1]])
+    n_rows = np.diff(np.r_[starts, len(order)])
+
+    is_long = n_rows > max_top
+    candidates = [order[~np.repeat(is_long, n_rows)]]
+    for start, n in zip(starts[is_long], n_rows[is_long]):
+        segment = order[start:start + n]
+        segment_weight = weight[segment]
+        threshold = np.partition(segment_weight, n - max_top)[n - max_top]
+        is_greater = segment_weight > threshold
+        candidates.append(segment[is_greater])
+        candidates.append(segment[segment_weight == threshold][:max_top - np.count_nonzero(is_greater)])
+    candidates = np.concatenate(candidates)
+
+    candidates = candidates[np.lexsort((candidates, -weight[candidates], aid_x[candidates]))]
+    candidate_aid_x = aid_x[candidates]
+    candidate_starts = np.flatnonzero(np.r_[True, candidate_aid_x[1:] != candidate_aid_x[:-1]])
+    ranks = np.arange(len(candidates)) - np.repeat(
+        candidate_starts, np.diff(np.r_[candidate_starts, len(candidates)])
+    )
+    return {top: candidates[ranks < top] for top in tops}
+
+
+class TopKIndex:
+    """
+    CSR-style top-k co-visitation lookup: the neighbors of aid are neighbors[indptr[aid]:indptr[aid + 1]]
+    in descending order of weight.
+    Saved as indptr.npy, neighbors.npy and weights.npy so that it can be opened memory-mapped.
+    """
+    file_names = ("indptr", "neighbors", "weights")
+
+    def __init__(self, indptr: np.ndarray, neighbors: np.ndarray, weights: np.ndarray):
+        assert len(indptr) >= 1
+        assert len(neighbors) == len(weights) == indptr[-1]
+        self.indptr = indptr
+        self.neighbors_array = neighbors
+        self.weights = weights
+
+    @classmethod
+    def from_top_df(cls, top_df: pd.DataFrame, n_aids: int = None):
+        """top_df has the columns aid_x, aid_y and weight as given by CoVisitationMatrix.get_top_df"""
+        aid_x = top_df["aid_x"].to_numpy()
+        weight = top_df["weight"].to_numpy()
+        order = np.lexsort((-weight, aid_x))
+        aid_x = aid_x[order]
+        if n_aids is None:
+            n_aids = int(aid_x[-1]) + 1 if len(aid_x) > 0 else 0
+
+        indptr = np.zeros(n_aids + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(aid_x, minlength=n_aids))
+        return cls(indptr, top_df["aid_y"].to_numpy()[order].astype(np.int32), weight[order])
+
+    @classmethod
+    def from_dict(cls, top_dict: dict):
+        """top_dict is {aid_x: (aid_y, ...)} as given by CoVisitationMatrix.get_dict. The weights are unknown and set to 1."""
+        aid_x = sorted(top_dict.keys())
+        n_aids = aid_x[-1] + 1 if len(aid_x) > 0 else 0
+        n_neighbors = np.zeros(n_aids, dtype=np.int64)
+        n_neighbors[aid_x] = [len(top_dict[aid]) for aid in aid_x]
+
+        indptr = np.zeros(n_aids + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(n_neighbors)
+        neighbors = np.fromiter(
+            (aid_y for aid in aid_x for aid_y in top_dict[aid]), dtype=np.int32, count=indptr[-1]
+        )
+        return cls(indptr, neighbors, np.ones(len(neighbors), dtype=np.int32))
+
+    @classmethod
+    def load(cls, dir_path, mmap_mode="r"):
+        dir_path = pathlib.Path(dir_path)
+        return cls(*(np.load(dir_path / f"{fn}.npy", mmap_mode=mmap_mode) for fn in cls.file_names))
+
+    def save(self, dir_path):
+        dir_path = pathlib.Path(dir_path)
+        dir_path.mkdir(exist_ok=True, parents=True)
+        for fn, array in zip(self.file_names, (self.indptr, self.neighbors_array, self.weights)):
+            np.save(dir_path / f"{fn}.npy", array)
+
+    def replace(self, aids, top_df: pd.DataFrame):
+        """A new index with the neighbors of the given aids replaced by those in top_df (see from_top_df)"""
+        aid_x = np.repeat(np.arange(self.n_aids), np.diff(self.indptr))
+        is_kept = ~np.isin(aid_x, aids)
+        n_aids = max(self.n_aids, int(top_df["aid_x"].max()) + 1 if len(top_df) > 0 else 0)
+        return self.from_top_df(pd.concat([
+            pd.DataFrame({
+                "aid_x": aid_x[is_kept],
+                "aid_y": self.neighbors_array[is_kept],
+                "weight": self.weights[is_kept]
+            }),
+            top_df.loc[top_df["aid_x"].isin(aids), ["aid_x", "aid_y", "weight"]]
+        ], ignore_index=True), n_aids)
+
+    @property
+    def n_aids(self):
+        return len(self.indptr) - 1
+
+    def __len__(self):
+        return int(np.count_nonzero(np.diff(self.indptr)))
+
+    def __contains__(self, aid):
+        return 0 <= aid < self.n_aids and self.indptr[aid] < self.indptr[aid + 1]
+
+    def neighbors(self, aid: int, return_weights=False):
+        if 0 <= aid < self.n_aids:
+            s = slice(self.indptr[aid], self.indptr[aid + 1])
+        else:
+            s = slice(0, 0)
+        if return_weights:
+            return self.neighbors_array[s], self.weights[s]
+        return self.neighbors_array[s]
+
+    def neighbors_many(self, aids, return_weights=False):
+        """
+        Returns the concatenated neighbors of the given aids (in the given order) and the number of neighbors of each aid,
+        so that np.repeat(aids, n_neighbors) gives the aid that each neighbor comes from.
+        """
+        aids = np.asarray(aids, dtype=np.int64)
+        is_valid = (0 <= aids) & (aids < self.n_aids)
+        starts = np.zeros(len(aids), dtype=np.int64)
+        ends = np.zeros(len(aids), dtype=np.int64)
+        starts[is_valid] = self.indptr[aids[is_valid]]
+        ends[is_valid] = self.indptr[aids[is_valid] + 1]
+        n_neighbors = ends - starts
+
+        offsets = np.cumsum(n_neighbors) - n_neighbors
+        indices = np.arange(n_neighbors.sum()) + np.repeat(starts - offsets, n_neighbors)
+        if return_weights:
+            return self.neighbors_array[indices], self.weights[indices], n_neighbors
+        return self.neighbors_array[indices], n_neighbors
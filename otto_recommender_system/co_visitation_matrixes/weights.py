@@ -0,0 +1,120 @@
+"""
+Declarative weights of the pairs to give as weight_func of CoVisitationMatrix.
+They are evaluated as column expressions over the pair DataFrame (pandas or cuDF) with the parameters fixed
+at construction, so the training data is never rescanned per chunk. Weights can be multiplied with each other.
+"""
+import pandas as pd
+from .. import data as _data_module
+
+
+class WeightSpec:
+    uses_position = False
+
+    def __call__(self, pair_xdf):
+        raise NotImplementedError
+
+    def __mul__(self, other):
+        return ProductWeight(self, other)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{k}={v!r}' for k, v in sorted(vars(self).items()))})"
+
+
+class ProductWeight(WeightSpec):
+    def __init__(self, *specs: WeightSpec):
+        self.specs = [
+            sub_spec
+            for spec in specs
+            for sub_spec in (spec.specs if isinstance(spec, ProductWeight) else [spec])
+        ]
+
+    @property
+    def uses_position(self):
+        return any(spec.uses_position for spec in self.specs)
+
+    def __call__(self, pair_xdf):
+        ret = self.specs[0](pair_xdf)
+        for spec in self.specs[1:]:
+            ret = ret * spec(pair_xdf)
+        return ret
+
+
+class TypeWeight(WeightSpec):
+    """The weight of the type of the event y, e.g. TypeWeight({"clicks": 1, "carts": 6, "orders": 3})"""
+
+    def __init__(self, weights: dict):
+        self.weights = {
+            _data_module.all_types.index(type_) if isinstance(type_, str) else int(type_): float(weight)
+            for type_, weight in weights.items()
+        }
+
+    def __call__(self, pair_xdf):
+        return pair_xdf["type_y"].map(self.weights)
+
+
+def _to_datetime64(ts):
+    return pd.Timestamp(ts).to_datetime64().astype("M8[ms]")
+
+
+def _to_timedelta64(timedelta):
+    return pd.Timedelta(timedelta).to_timedelta64().astype("m8[ms]")
+
+
+class RecencyWeight(WeightSpec):
+    """
+    The weight by the time of the event x in the training period [ts_min, ts_max]:
+    1 + scale * (ts_x - ts_min) / (ts_max - ts_min) if kind is "linear",
+    and 0.5 ** ((ts_max - ts_x) / half_life) if kind is "exponential".
+    """
+
+    def __init__(self, ts_min, ts_max, kind: str = "linear", scale: float = 3, half_life=None):
+        if kind == "linear":
+            pass
+        elif kind == "exponential":
+            if half_life is None:
+                raise ValueError("half_life must be given if kind is 'exponential'")
+            half_life = _to_timedelta64(half_life)
+        else:
+            raise ValueError(f"kind must be 'linear' or 'exponential': {kind}")
+        self.ts_min = _to_datetime64(ts_min)
+        self.ts_max = _to_datetime64(ts_max)
+        self.kind = kind
+        self.scale = scale
+        self.half_life = half_life
+
+    @classmethod
+    def from_ts(cls, ts, **kwargs):
+        """Takes the training period from ts (e.g. df["ts"], or data.CompactTidyData whose ts is not decoded) once"""
+        if isinstance(ts, _data_module.CompactTidyData):
+            return cls(*ts.get_ts_range(), **kwargs)
+        return cls(ts.min(), ts.max(), **kwargs)
+
+    def __call__(self, pair_xdf):
+        if self.kind == "linear":
+            return 1 + self.scale * (pair_xdf["ts_x"] - self.ts_min) / (self.ts_max - self.ts_min)
+        else:
+            return 0.5 ** ((self.ts_max - pair_xdf["ts_x"]) / self.half_life)
+
+
+class TimeGapWeight(WeightSpec):
+    """0.5 ** (|ts_x - ts_y| / half_life)"""
+
+    def __init__(self, half_life):
+        self.half_life = _to_timedelta64(half_life)
+
+    def __call__(self, pair_xdf):
+        return 0.5 ** ((pair_xdf["ts_x"] - pair_xdf["ts_y"]).abs() / self.half_life)
+
+
+class PositionWeight(WeightSpec):
+    """
+    0.5 ** (position_y / half_life), where position_y is the position of the event y in the session
+    counted from the most recent event (0)
+    """
+    uses_position = True
+
+    def __init__(self, half_life: float):
+        self.half_life = float(half_life)
+
+    def __call__(self, pair_xdf):
+        return 0.5 ** (pair_xdf["position_y"] / self.half_life)
@@ -3,6 +3,13 @@ import pandas as pd
 import pathlib
 import tqdm
 import logging
+import array
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import shutil
+from typing import Union
 
 
 logging.basicConfig(level=logging.INFO)
@@ -12,7 +19,8 @@ logger = logging.getLogger(__file__)
 project_root_path = pathlib.Path(__file__).resolve().parent.parent.parent
 official_data_path = project_root_path / "data" / "otto-recommender-system"
 if not official_data_path.exists():
-    raise FileNotFoundError(official_data_path)
+    # not fatal on import: modules that only need e.g. all_types must work without the downloaded dataset
+    logger.warning(f"{official_data_path} not found")
 
 
 def get_n_lines(file_path):
@@ -20,31 +28,120 @@ def get_n_lines(file_path):
         return sum(1 for _ in f)
 
 
-
-def event_dict_to_np_array(event_dict: dict):
-    assert tuple(event_dict.keys()) == ("aid", "ts", "type")
-    return event_dict["aid"], event_dict["ts"], all_types.index(event_dict["type"])
-
-
-def labels_dict_to_np_array(labels_dict: dict):
-    return [
-        (aid, np.datetime64("NaT"), all_types.index(type_))
-        for type_ in all_types
-        if type_ in labels_dict.keys()
-        for aid in (
-            labels_dict[type_] if isinstance(labels_dict[type_], list) else [labels_dict[type_]]
-        )
-    ]
-
-
 max_n_events = 500
 all_types = ["clicks", "carts", "orders"]
+type_to_index = {type_: i for i, type_ in enumerate(all_types)}
+tidy_data_dtype = np.dtype([
+    ("session", "i4"),
+    ("aid", "i4"),
+    ("ts", "M8[ms]"),
+    ("type", "i1")
+])
+
+
+# the upper limit of the jsonl bytes parsed at once, which bounds the memory of the column buffers
+max_bytes_per_range = 256 * 2 ** 20
+
+
+def get_line_aligned_byte_ranges(file_path, n_ranges):
+    file_size = pathlib.Path(file_path).stat().st_size
+    edges = [0]
+    with open(file_path, "rb") as f:
+        for i in range(1, n_ranges):
+            pos = file_size * i // n_ranges
+            if pos <= edges[-1]:
+                continue
+            # move to the head of the next line unless pos is already at the head of a line
+            f.seek(pos - 1)
+            f.readline()
+            if edges[-1] < f.tell() < file_size:
+                edges.append(f.tell())
+    edges.append(file_size)
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def _parse_jsonl_byte_range(file_path, start, end, dataset_type, parts_dir_path, i_range):
+    session = array.array("i")
+    aid = array.array("i")
+    ts = array.array("q")
+    type_ = array.array("b")
+    nat = int(np.datetime64("NaT").astype(np.int64))
+
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        pos = start
+        for line in f:
+            if pos >= end:
+                break
+            pos += len(line)
+            record = json.loads(line)
+
+            n_events = len(aid)
+            if dataset_type == "test_labels":
+                labels_dict = record["labels"]
+                for type_index, t in enumerate(all_types):
+                    if t not in labels_dict:
+                        continue
+                    labels = labels_dict[t] if isinstance(labels_dict[t], list) else [labels_dict[t]]
+                    aid.extend(labels)
+                    ts.extend(itertools.repeat(nat, len(labels)))
+                    type_.extend(itertools.repeat(type_index, len(labels)))
+            else:
+                for event in record["events"]:
+                    aid.append(event["aid"])
+                    ts.append(event["ts"])
+                    type_.append(type_to_index[event["type"]])
+            session.extend(itertools.repeat(record["session"], len(aid) - n_events))
+
+    for name, buffer in (("session", session), ("aid", aid), ("ts", ts), ("type", type_)):
+        np.save(parts_dir_path / f"{i_range}-{name}.npy", np.frombuffer(buffer, dtype=buffer.typecode))
+    return len(aid)
+
+
+def read_jsonl(target_fn, dataset_type, dtype, n_jobs: int = 1, parts_dir_path=None):
+    """
+    Parses the jsonl in line-aligned byte ranges (in n_jobs worker processes if n_jobs > 1).
+    Each range is written as the column files under parts_dir_path, which are copied into the preallocated result.
+    """
+    target_fn = pathlib.Path(target_fn)
+    if parts_dir_path is None:
+        parts_dir_path = target_fn.parent / f"{target_fn.stem}-parts"
+    parts_dir_path = pathlib.Path(parts_dir_path)
+    if parts_dir_path.exists():
+        shutil.rmtree(parts_dir_path)
+    parts_dir_path.mkdir(parents=True)
+
+    n_ranges = max(4 * n_jobs, int(np.ceil(target_fn.stat().st_size / max_bytes_per_range)))
+    byte_ranges = get_line_aligned_byte_ranges(target_fn, n_ranges)
+    args = [(target_fn, start, end, dataset_type, parts_dir_path, i) for i, (start, end) in enumerate(byte_ranges)]
+
+    if n_jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(n_jobs, mp_context=multiprocessing.get_context("fork")) as executor:
+            n_events_list = list(tqdm.tqdm(
+                executor.map(_parse_jsonl_byte_range, *zip(*args)), total=len(args), desc=f"parsing {target_fn.name}"
+            ))
+    else:
+        n_events_list = [
+            _parse_jsonl_byte_range(*a) for a in tqdm.tqdm(args, desc=f"parsing {target_fn.name}")
+        ]
+
+    tidy_data = np.empty(sum(n_events_list), dtype=dtype)
+    offsets = np.r_[0, np.cumsum(n_events_list)]
+    for i_range in range(len(args)):
+        for name in ("session", "aid", "ts", "type"):
+            part = np.load(parts_dir_path / f"{i_range}-{name}.npy")
+            if name == "ts":
+                part = part.view(tidy_data.dtype["ts"])
+            tidy_data[name][offsets[i_range]:offsets[i_range + 1]] = part
+    shutil.rmtree(parts_dir_path)
+    return tidy_data
 
 
 def get_np_tidy_data(
         dataset_type: str,
         data_path=official_data_path,
-        tidy_data_path=project_root_path / "data" / "otto-recommender-system-tidy-data"
+        tidy_data_path=project_root_path / "data" / "otto-recommender-system-tidy-data",
+        n_jobs: int = 1
 ):
     if dataset_type not in ("train", "test", "test_labels"):
         raise ValueError("dataset_type must be 'train', 'test' or 'test_labels'")
@@ -59,47 +156,15 @@ def get_np_tidy_data(
 
     logger.info(f"creating {np_tidy_data_cachefile_path}")
 
-    np_tidy_data = np.empty(
-        0,
-        dtype=[
-            ("session", "i4"),
-            ("aid", "i4"),
-            ("ts", "M8[ms]"),
-            ("type", "i1")
-        ]
-    )
-    chunk_size = 100_000
-
     target_fn = data_path / f"{dataset_type}.jsonl"
     if not target_fn.exists():
         target_fn = data_path / f"{dataset_type}_sessions.jsonl"
     if not target_fn.exists():
         raise FileNotFoundError(data_path / f"[{dataset_type}/{dataset_type}_sessions].jsonl")
-    
-    chunks = pd.read_json(target_fn, lines=True, chunksize=chunk_size)
-    n_records = get_n_lines(target_fn)
-
-    for chunk in tqdm.tqdm(chunks, total=int(np.ceil(n_records / chunk_size))):
-        if dataset_type == "test_labels":
-            assert np.all(chunk.columns == ["session", "labels"])
-            np_tidy_data = np.concatenate([
-                np_tidy_data,
-                np.array([
-                    (session, *args)
-                    for session, labels_dict in zip(chunk["session"], chunk["labels"])
-                    for args in labels_dict_to_np_array(labels_dict)
-                ], dtype=np_tidy_data.dtype)
-            ])
-        else:
-            assert np.all(chunk.columns == ["session", "events"])
-            np_tidy_data = np.concatenate([
-                np_tidy_data,
-                np.array([
-                    (session, *event_dict_to_np_array(event))
-                    for session, events in zip(chunk["session"], chunk["events"])
-                    for event in events
-                ], dtype=np_tidy_data.dtype)
-            ])
+
+    np_tidy_data = read_jsonl(
+        target_fn, dataset_type, tidy_data_dtype, n_jobs, np_tidy_data_path / f"{dataset_type}-parts"
+    )
 
     np.savez_compressed(np_tidy_data_cachefile_path, np_tidy_data)
     return np_tidy_data
@@ -108,7 +173,8 @@ def get_np_tidy_data(
 def get_pd_tidy_data(
         dataset_type: str,
         data_path=official_data_path,
-        tidy_data_path=project_root_path / "data" / "otto-recommender-system-tidy-data"
+        tidy_data_path=project_root_path / "data" / "otto-recommender-system-tidy-data",
+        n_jobs: int = 1
 ):
     if dataset_type not in ("train", "test", "test_labels"):
         raise ValueError("dataset_type must be 'train', 'test' or 'test_labels'")
@@ -127,33 +193,418 @@ def get_pd_tidy_data(
         return df
 
     logger.info(f"creating {pd_tidy_data_cachefile_path}")
-    np_tidy_data = get_np_tidy_data(dataset_type, data_path, tidy_data_path)
+    np_tidy_data = get_np_tidy_data(dataset_type, data_path, tidy_data_path, n_jobs)
     df = pd.DataFrame(np_tidy_data)
     df.to_parquet(pd_tidy_data_cachefile_path)
 
     return df
 
 
-def get_datasets(days=7, weeks=4, type_of_tidy_data="npz", return_train=True, return_valid=True, return_test=True, return_valid_labels=False):
-    dirname = f"{days}days-of-{weeks}weeks"
+def get_npy_tidy_data(
+        dataset_type: str,
+        data_path=official_data_path,
+        tidy_data_path=project_root_path / "data" / "otto-recommender-system-tidy-data",
+        n_jobs: int = 1,
+        columns=None,
+        mmap_mode="r",
+        compact: bool = False
+):
+    """
+    One uncompressed .npy per column under tidy_data_path/npy/dataset_type with a manifest.json,
+    loaded memory-mapped as a DataFrame without copying. Only the given columns are opened.
+
+    With compact=True, the columns are stored under tidy_data_path/npy-compact/dataset_type instead:
+    ts as uint32 relative to an epoch, type as uint8, and session as the run-lengths of the session index.
+    They are loaded as CompactTidyData without decoding them, i.e. 9 bytes per event instead of 17,
+    whose to_pandas gives the same DataFrame as without compact.
+    """
+    if dataset_type not in ("train", "test", "test_labels"):
+        raise ValueError("dataset_type must be 'train', 'test' or 'test_labels'")
+
+    npy_tidy_data_path = pathlib.Path(tidy_data_path) / ("npy-compact" if compact else "npy") / dataset_type
+    manifest_path = npy_tidy_data_path / "manifest.json"
+
+    if not manifest_path.exists():
+        logger.info(f"creating {npy_tidy_data_path}")
+        npy_tidy_data_path.mkdir(parents=True, exist_ok=True)
+        np_tidy_data_cachefile_path = pathlib.Path(tidy_data_path) / "npz" / f"{dataset_type}.npz"
+        if compact and (pathlib.Path(tidy_data_path) / "npy" / dataset_type / "manifest.json").exists():
+            np_tidy_data = get_npy_tidy_data(dataset_type, data_path, tidy_data_path)
+        elif np_tidy_data_cachefile_path.exists():
+            np_tidy_data = np.load(np_tidy_data_cachefile_path)["arr_0"]
+        else:
+            target_fn = data_path / f"{dataset_type}.jsonl"
+            if not target_fn.exists():
+                target_fn = data_path / f"{dataset_type}_sessions.jsonl"
+            if not target_fn.exists():
+                raise FileNotFoundError(data_path / f"[{dataset_type}/{dataset_type}_sessions].jsonl")
+            np_tidy_data = read_jsonl(
+                target_fn, dataset_type, tidy_data_dtype, n_jobs, npy_tidy_data_path / "parts"
+            )
+
+        manifest = {
+            "n_events": len(np_tidy_data),
+            "columns": {name: tidy_data_dtype[name].str for name in tidy_data_dtype.names}
+        }
+        _save_session_index(npy_tidy_data_path, np_tidy_data["session"])
+        if compact:
+            manifest.update(_save_compact_columns(npy_tidy_data_path, np_tidy_data))
+        else:
+            for name in tidy_data_dtype.names:
+                np.save(npy_tidy_data_path / f"{name}.npy", np.ascontiguousarray(np_tidy_data[name]))
+        # written at last so that an interrupted conversion is redone
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        del np_tidy_data
+
+    logger.info(f"loading {npy_tidy_data_path}")
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    if columns is None:
+        columns = list(manifest["columns"].keys())
+    for name in columns:
+        if name not in manifest["columns"]:
+            raise ValueError(f"column must be one of {list(manifest['columns'].keys())}: {name}")
+
+    if manifest.get("layout") == "compact":
+        data = _load_compact_tidy_data(npy_tidy_data_path, manifest, columns, mmap_mode)
+        assert len(data) == manifest["n_events"]
+        return data
+
+    arrays = {}
+    for name in columns:
+        arrays[name] = np.load(npy_tidy_data_path / f"{name}.npy", mmap_mode=mmap_mode)
+        assert arrays[name].dtype == np.dtype(manifest["columns"][name])
+        assert len(arrays[name]) == manifest["n_events"]
+    return pd.DataFrame(arrays, copy=False)
+
+
+# NaT in the compact uint32 ts
+_compact_nat = np.iinfo(np.uint32).max
+# the dtypes of the columns stored in the compact layout, where session is the session index instead
+_compact_dtypes = {"aid": np.dtype(np.int32), "ts": np.dtype(np.uint32), "type": np.dtype(np.uint8)}
+
+
+def _save_compact_columns(npy_tidy_data_path, np_tidy_data):
+    """Saves aid, ts and type of the compact layout and returns the manifest entries to decode them"""
+    np.save(npy_tidy_data_path / "aid.npy", np.ascontiguousarray(np_tidy_data["aid"], dtype=_compact_dtypes["aid"]))
+    np.save(npy_tidy_data_path / "type.npy", np.asarray(np_tidy_data["type"]).astype(_compact_dtypes["type"]))
+
+    ts = np.asarray(np_tidy_data["ts"]).astype("M8[ms]").view(np.int64)
+    is_nat = np.isnat(ts.view("M8[ms]"))
+    ts_epoch = int(ts[~is_nat].min()) if np.any(~is_nat) else 0
+    ts_span = int(ts[~is_nat].max()) - ts_epoch if np.any(~is_nat) else 0
+    # milliseconds are kept as they are if the span fits in uint32 (about 49 days), otherwise truncated to seconds
+    if ts_span < _compact_nat:
+        ts_unit = "ms"
+    elif ts_span // 1000 < _compact_nat:
+        ts_unit = "s"
+        if np.any(ts[~is_nat] % 1000 != 0):
+            logger.warning("ts is truncated to seconds in the compact layout")
+    else:
+        raise ValueError(f"ts spans too long for the compact layout: {ts_span} ms")
+
+    scale = 1 if ts_unit == "ms" else 1000
+    compact_ts = np.full(len(ts), _compact_nat, dtype=_compact_dtypes["ts"])
+    compact_ts[~is_nat] = (ts[~is_nat] - ts_epoch) // scale
+    np.save(npy_tidy_data_path / "ts.npy", compact_ts)
+    return {"layout": "compact", "ts_epoch_ms": ts_epoch, "ts_unit": ts_unit}
+
+
+class CompactTidyData:
+    """
+    The tidy data of the compact layout as it is stored: aid as int32, ts as uint32 counted from ts_epoch_ms
+    in ts_unit ("ms" or "s", _compact_nat for NaT) and type as uint8, i.e. 9 bytes per event,
+    with the session given by the session index (session_ids, offsets) of make_session_index instead of a column.
+    data["aid"], data["ts"] and data["type"] are the stored columns as Series, and to_pandas decodes the DataFrame
+    of tidy_data_dtype, which is meant for a chunk of it (see get_rows).
+    It is accepted by CoVisitationMatrix and get_predictions_df in place of the DataFrame.
+    """
+
+    def __init__(self, columns, arrays: dict, session_ids, offsets, ts_epoch_ms: int = 0, ts_unit: str = "ms"):
+        # columns are the logical columns in order including "session", and arrays are the stored ones
+        self.columns = list(columns)
+        self.arrays = arrays
+        self.session_ids = session_ids
+        self.offsets = offsets
+        self.ts_epoch_ms = ts_epoch_ms
+        self.ts_unit = ts_unit
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, key):
+        """The stored column as a Series, or the CompactTidyData of the given list of columns"""
+        if isinstance(key, list):
+            return self._replace(columns=key, arrays={name: self.arrays[name] for name in key if name != "session"})
+        if key == "session":
+            raise KeyError("session is given by session_ids and offsets, or get_session for a chunk")
+        return pd.Series(self.arrays[key], name=key, copy=False)
+
+    def _replace(self, **kwargs) -> "CompactTidyData":
+        attrs = dict(
+            columns=self.columns, arrays=self.arrays, session_ids=self.session_ids, offsets=self.offsets,
+            ts_epoch_ms=self.ts_epoch_ms, ts_unit=self.ts_unit
+        )
+        attrs.update(kwargs)
+        return CompactTidyData(**attrs)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in self.arrays.values()) + self.session_ids.nbytes + self.offsets.nbytes
+
+    def copy(self) -> "CompactTidyData":
+        """Reads the arrays into memory"""
+        return self._replace(
+            arrays={name: np.array(array) for name, array in self.arrays.items()},
+            session_ids=np.array(self.session_ids), offsets=np.array(self.offsets)
+        )
+
+    def get_rows(self, start: int, stop: int) -> "CompactTidyData":
+        """The events [start, stop) as views, where start and stop must be at the boundaries of the sessions"""
+        first, last = np.searchsorted(self.offsets, [start, stop])
+        if self.offsets[first] != start or self.offsets[last] != stop:
+            raise ValueError(f"[{start}, {stop}) splits a session")
+        return self._replace(
+            arrays={name: array[start:stop] for name, array in self.arrays.items()},
+            session_ids=self.session_ids[first:last], offsets=self.offsets[first:last + 1] - start
+        )
 
-    data_path = project_root_path / "data" / "otto-train-and-test-data-for-local-validation" / dirname / "jsonl"
+    def get_events(self, is_kept) -> "CompactTidyData":
+        """The events where is_kept (a boolean array), without the sessions left empty"""
+        is_kept = np.asarray(is_kept, dtype=bool)
+        n_events = np.diff(np.r_[0, np.cumsum(is_kept, dtype=np.int64)][self.offsets])
+        is_left = n_events > 0
+        return self._replace(
+            arrays={name: array[is_kept] for name, array in self.arrays.items()},
+            session_ids=self.session_ids[is_left], offsets=np.r_[0, np.cumsum(n_events[is_left])].astype(np.int64)
+        )
+
+    def get_session(self) -> np.ndarray:
+        """The session of each event, expanded from the session index"""
+        return np.repeat(self.session_ids, np.diff(self.offsets)).astype(tidy_data_dtype["session"], copy=False)
+
+    def decode_ts(self, compact_ts) -> np.ndarray:
+        compact_ts = np.asarray(compact_ts)
+        scale = 1 if self.ts_unit == "ms" else 1000
+        ts = compact_ts.astype(np.int64) * scale + self.ts_epoch_ms
+        ts[compact_ts == _compact_nat] = np.datetime64("NaT").astype(np.int64)
+        return ts.view(tidy_data_dtype["ts"])
+
+    def get_ts_range(self):
+        """(min, max) of ts without NaT as datetime64, without decoding the column"""
+        compact_ts = self.arrays["ts"]
+        is_valid = compact_ts != _compact_nat
+        if not np.any(is_valid):
+            return self.decode_ts(np.array([_compact_nat, _compact_nat], dtype=_compact_dtypes["ts"]))
+        return self.decode_ts(np.array(
+            [compact_ts.min(), np.max(compact_ts, where=is_valid, initial=0)], dtype=_compact_dtypes["ts"]
+        ))
+
+    def get_max_aid(self) -> int:
+        aid = self.arrays["aid"]
+        return int(aid.max()) if len(aid) > 0 else -1
+
+    def to_pandas(self) -> pd.DataFrame:
+        """The DataFrame of tidy_data_dtype as get_npy_tidy_data without compact gives"""
+        arrays = {}
+        for name in self.columns:
+            if name == "session":
+                arrays[name] = self.get_session()
+            elif name == "ts":
+                arrays[name] = self.decode_ts(self.arrays[name])
+            elif name == "type":
+                # the same bytes as i1 since the types are less than 128
+                arrays[name] = np.asarray(self.arrays[name]).view(tidy_data_dtype["type"])
+            else:
+                arrays[name] = np.asarray(self.arrays[name])
+        return pd.DataFrame(arrays, copy=False)
+
+
+def _load_compact_tidy_data(npy_tidy_data_path, manifest, columns, mmap_mode) -> CompactTidyData:
+    return CompactTidyData(
+        columns,
+        {
+            name: np.load(npy_tidy_data_path / f"{name}.npy", mmap_mode=mmap_mode)
+            for name in columns
+            if name != "session"
+        },
+        np.load(npy_tidy_data_path / "session_ids.npy", mmap_mode=mmap_mode),
+        np.load(npy_tidy_data_path / "offsets.npy", mmap_mode=mmap_mode),
+        manifest["ts_epoch_ms"], manifest["ts_unit"]
+    )
+
+
+def make_session_index(sorted_session):
+    """
+    CSR-style index of the events sorted by session (and ts within each session, as in the jsonl files):
+    the events of session_ids[i] are [offsets[i], offsets[i + 1]).
+    """
+    sorted_session = np.asarray(sorted_session)
+    if np.any(sorted_session[1:] < sorted_session[:-1]):
+        raise ValueError("the events must be sorted by session")
+    is_start = np.ones(len(sorted_session), dtype=bool)
+    is_start[1:] = sorted_session[1:] != sorted_session[:-1]
+    starts = np.flatnonzero(is_start)
+    offsets = np.r_[starts, len(sorted_session)].astype(np.int64)
+    return sorted_session[starts], offsets
+
+
+def _save_session_index(npy_tidy_data_path, sorted_session):
+    session_ids, offsets = make_session_index(sorted_session)
+    np.save(npy_tidy_data_path / "session_ids.npy", session_ids)
+    np.save(npy_tidy_data_path / "offsets.npy", offsets)
+
+
+def get_session_index(
+        dataset_type: str,
+        data_path=official_data_path,
+        tidy_data_path=project_root_path / "data" / "otto-recommender-system-tidy-data",
+        n_jobs: int = 1,
+        mmap_mode="r",
+        compact: bool = False
+):
+    """(session_ids, offsets) saved next to the npy tidy data (see make_session_index)"""
+    npy_tidy_data_path = pathlib.Path(tidy_data_path) / ("npy-compact" if compact else "npy") / dataset_type
+    if not (npy_tidy_data_path / "offsets.npy").exists():
+        df = get_npy_tidy_data(dataset_type, data_path, tidy_data_path, n_jobs, columns=["session"], compact=compact)
+        _save_session_index(npy_tidy_data_path, df["session"].to_numpy())
+    return (
+        np.load(npy_tidy_data_path / "session_ids.npy", mmap_mode=mmap_mode),
+        np.load(npy_tidy_data_path / "offsets.npy", mmap_mode=mmap_mode)
+    )
+
+
+class TidyDataChunks:
+    """
+    Session-aligned chunks of the npy tidy data read from the on-disk cache, so that only one chunk is in memory.
+    Each chunk has about max_bytes_per_chunk of the given columns (a session larger than that is kept whole),
+    and only the events of the given types if types is not None.
+    The chunks of the compact layout are CompactTidyData, whose bytes are counted as they are stored.
+    It can be iterated any number of times, and is accepted by CoVisitationMatrix and get_predictions_df in place of the DataFrame.
+    """
+    def __init__(
+            self,
+            dataset_type: str,
+            data_path=official_data_path,
+            tidy_data_path=project_root_path / "data" / "otto-recommender-system-tidy-data",
+            max_bytes_per_chunk: int = 2 ** 30,
+            columns=None,
+            types=None,
+            compact: bool = False,
+            n_jobs: int = 1
+    ):
+        # creates the cache if not yet
+        get_npy_tidy_data(dataset_type, data_path, tidy_data_path, n_jobs, columns=[], compact=compact)
+        self.npy_tidy_data_path = pathlib.Path(tidy_data_path) / ("npy-compact" if compact else "npy") / dataset_type
+        with open(self.npy_tidy_data_path / "manifest.json") as f:
+            self.manifest = json.load(f)
+
+        self.columns = list(self.manifest["columns"].keys()) if columns is None else list(columns)
+        for name in self.columns:
+            if name not in self.manifest["columns"]:
+                raise ValueError(f"column must be one of {list(self.manifest['columns'].keys())}: {name}")
+        self.types = None if types is None else [
+            all_types.index(type_) if isinstance(type_, str) else int(type_) for type_ in types
+        ]
+
+        self.session_ids, self.offsets = get_session_index(
+            dataset_type, data_path, tidy_data_path, n_jobs, compact=compact
+        )
+        if self.manifest.get("layout") == "compact":
+            # session takes no bytes per event in the session index
+            bytes_per_event = sum(
+                _compact_dtypes[name].itemsize for name in self._get_columns_to_load() if name != "session"
+            )
+        else:
+            bytes_per_event = sum(
+                np.dtype(self.manifest["columns"][name]).itemsize for name in self._get_columns_to_load()
+            )
+        max_events_per_chunk = max(1, max_bytes_per_chunk // max(1, bytes_per_event))
+
+        # the positions in session_ids at which the chunks start
+        session_bounds = [0]
+        while session_bounds[-1] < len(self.session_ids):
+            last = np.searchsorted(
+                self.offsets, self.offsets[session_bounds[-1]] + max_events_per_chunk, side="right"
+            ) - 1
+            session_bounds.append(min(max(int(last), session_bounds[-1] + 1), len(self.session_ids)))
+        self.session_bounds = np.array(session_bounds)
+
+    def _get_columns_to_load(self):
+        if self.types is not None and "type" not in self.columns:
+            return [*self.columns, "type"]
+        return self.columns
+
+    def __len__(self):
+        return len(self.session_bounds) - 1
+
+    def __iter__(self):
+        for i_chunk in range(len(self)):
+            yield self.get_chunk(i_chunk)
+
+    def get_chunk(self, i_chunk) -> Union[pd.DataFrame, CompactTidyData]:
+        rows = slice(
+            int(self.offsets[self.session_bounds[i_chunk]]), int(self.offsets[self.session_bounds[i_chunk + 1]])
+        )
+        if self.manifest.get("layout") == "compact":
+            # read into memory so that the pages of the memory-mapped file are not kept after the chunk
+            chunk = _load_compact_tidy_data(
+                self.npy_tidy_data_path, self.manifest, self._get_columns_to_load(), "r"
+            ).get_rows(rows.start, rows.stop).copy()
+            if self.types is not None:
+                chunk = chunk.get_events(np.isin(chunk.arrays["type"], self.types))[self.columns]
+            return chunk
+
+        arrays = {}
+        for name in self._get_columns_to_load():
+            array = np.load(self.npy_tidy_data_path / f"{name}.npy", mmap_mode="r")[rows]
+            # read into memory so that the pages of the memory-mapped file are not kept after the chunk
+            arrays[name] = np.array(array) if isinstance(array, np.memmap) else array
+        df = pd.DataFrame(arrays, copy=False)
+        if self.types is not None:
+            df = df.loc[df["type"].isin(self.types), self.columns].reset_index(drop=True)
+        return df
+
+    def get_max_aid(self) -> int:
+        aid = np.load(self.npy_tidy_data_path / "aid.npy", mmap_mode="r")
+        return int(aid.max()) if len(aid) > 0 else -1
+
+
+def get_local_validation_paths(days=7, weeks=4):
+    """(data_path, tidy_data_path) of the local-validation split"""
+    dirname = f"{days}days-of-{weeks}weeks"
     tidy_data_path = project_root_path / "data" / "otto-train-and-test-data-for-local-validation" / dirname
+    return tidy_data_path / "jsonl", tidy_data_path
+
+
+def get_datasets(days=7, weeks=4, type_of_tidy_data="npz", return_train=True, return_valid=True, return_test=True, return_valid_labels=False, n_jobs: int = 1, columns=None):
+    data_path, tidy_data_path = get_local_validation_paths(days, weeks)
 
     valid_labels_tidy_data = None
 
     if type_of_tidy_data == "npz":
-        train_tidy_data = get_np_tidy_data("train", data_path, tidy_data_path)
-        valid_tidy_data = get_np_tidy_data("test", data_path, tidy_data_path)
-        test_tidy_data = get_np_tidy_data("test")
+        train_tidy_data = get_np_tidy_data("train", data_path, tidy_data_path, n_jobs)
+        valid_tidy_data = get_np_tidy_data("test", data_path, tidy_data_path, n_jobs)
+        test_tidy_data = get_np_tidy_data("test", n_jobs=n_jobs)
         if return_valid_labels:
-            valid_labels_tidy_data = get_np_tidy_data("test_labels", data_path, tidy_data_path)
+            valid_labels_tidy_data = get_np_tidy_data("test_labels", data_path, tidy_data_path, n_jobs)
     elif type_of_tidy_data == "parquet":
-        train_tidy_data = get_pd_tidy_data("train", data_path, tidy_data_path)
-        valid_tidy_data = get_pd_tidy_data("test", data_path, tidy_data_path)
-        test_tidy_data = get_pd_tidy_data("test")
+        train_tidy_data = get_pd_tidy_data("train", data_path, tidy_data_path, n_jobs)
+        valid_tidy_data = get_pd_tidy_data("test", data_path, tidy_data_path, n_jobs)
+        test_tidy_data = get_pd_tidy_data("test", n_jobs=n_jobs)
+        if return_valid_labels:
+            valid_labels_tidy_data =  get_pd_tidy_data("test_labels", data_path, tidy_data_path, n_jobs)
+    elif type_of_tidy_data in ("npy", "npy-compact"):
+        compact = type_of_tidy_data == "npy-compact"
+        train_tidy_data = get_npy_tidy_data("train", data_path, tidy_data_path, n_jobs, columns, compact=compact)
+        valid_tidy_data = get_npy_tidy_data("test", data_path, tidy_data_path, n_jobs, columns, compact=compact)
+        test_tidy_data = get_npy_tidy_data("test", n_jobs=n_jobs, columns=columns, compact=compact)
         if return_valid_labels:
-            valid_labels_tidy_data =  get_pd_tidy_data("test_labels", data_path, tidy_data_path)
+            valid_labels_tidy_data = get_npy_tidy_data(
+                "test_labels", data_path, tidy_data_path, n_jobs, columns, compact=compact
+            )
     else:
         raise ValueError(type_of_tidy_data)
 
@@ -0,0 +1,289 @@
+"""
+Streaming ensemble of submissions, i.e. of the submission csv files or the ranked candidates (parquet).
+Each submission is read in line-aligned byte ranges (or row groups) and its rows are partitioned by session
+into temporary files,
+so that a partition has all the predictions of its sessions from all the submissions.
+The scores of (session_type, aid) are then summed by a sort-based aggregation per partition and the top-k of each
+session_type are written out, so the peak memory is bounded by a partition and the cost is linear in the submissions.
+The scores are either by the ranks in the submissions or, with ensemble_type "score", the scores of the candidates
+normalized within each (session, type), and every submission can have a weight for each type.
+"""
+import concurrent.futures
+import multiprocessing
+import pathlib
+import shutil
+import tempfile
+import numpy as np
+import tqdm
+from typing import Sequence
+from . import data as _data_module
+from . import evaluating as _evaluating
+from . import submitting as _submitting
+
+
+rank_ensemble_types = ("voting", "rank-weighting", "inverse-rank-weighting")
+ensemble_types = rank_ensemble_types + ("score",)
+normalizations = ("min-max", "softmax", "rank")
+
+
+def get_rank_scores(ensemble_type: str, rank, weight, max_count: int) -> np.ndarray:
+    """
+    The score of the label at the 0-based rank in its row:
+    weight if ensemble_type is "voting", (max_count - rank) * weight if "rank-weighting"
+    and weight / (rank + 1) if "inverse-rank-weighting".
+    """
+    rank = np.asarray(rank, dtype=np.float64)
+    weight = np.asarray(weight, dtype=np.float64)
+    if ensemble_type == "voting":
+        return np.broadcast_to(weight, rank.shape).copy()
+    elif ensemble_type == "rank-weighting":
+        return (max_count - rank) * weight
+    elif ensemble_type == "inverse-rank-weighting":
+        return weight / (rank + 1)
+    else:
+        raise ValueError(f"ensemble_type must be one of {rank_ensemble_types}: {ensemble_type}")
+
+
+def normalize_scores(score, indptr, normalization: str) -> np.ndarray:
+    """
+    The scores normalized within each row of the CSR arrays:
+    to [0, 1] if normalization is "min-max" (1 if all the same), the softmax if "softmax",
+    and (n - rank) / n by the descending scores in the row of the n scores if "rank".
+    """
+    score = np.asarray(score, dtype=np.float64)
+    n_aids = np.diff(indptr)
+    n_aids = n_aids[n_aids > 0]
+    starts = np.r_[0, np.cumsum(n_aids)[:-1]].astype(np.int64)
+    row = np.repeat(np.arange(len(n_aids)), n_aids)
+    if len(score) == 0:
+        return score
+    elif normalization == "min-max":
+        row_min = np.minimum.reduceat(score, starts)[row]
+        row_range = np.maximum.reduceat(score, starts)[row] - row_min
+        return np.where(row_range > 0, (score - row_min) / np.where(row_range > 0, row_range, 1), 1.0)
+    elif normalization == "softmax":
+        exp_score = np.exp(score - np.maximum.reduceat(score, starts)[row])
+        return exp_score / np.add.reduceat(exp_score, starts)[row]
+    elif normalization == "rank":
+        rank = np.empty(len(score), dtype=np.int64)
+        rank[np.lexsort((-score, row))] = np.arange(len(score)) - starts[row]
+        return (n_aids[row] - rank) / n_aids[row]
+    else:
+        raise ValueError(f"normalization must be one of {normalizations}: {normalization}")
+
+
+def get_weight_matrix(weights, n_subs: int) -> np.ndarray:
+    """
+    The weights of (submission, type) from the weight of each submission,
+    which is a number, a dict {type: weight} (1 for the other types) or the weights of all the types.
+    """
+    weight_matrix = np.ones((n_subs, len(_data_module.all_types)))
+    if weights is None:
+        return weight_matrix
+    if len(weights) != n_subs:
+        raise ValueError("weights must have the same length as submission_csv_paths")
+    for i_sub, weight in enumerate(weights):
+        if isinstance(weight, dict):
+            for type_, type_weight in weight.items():
+                weight_matrix[i_sub, _data_module.type_to_index.get(type_, type_)] = type_weight
+        else:
+            weight_matrix[i_sub] = weight
+    return weight_matrix
+
+
+def _is_parquet(path) -> bool:
+    return pathlib.Path(path).suffix == ".parquet"
+
+
+def _get_pieces(predictions_path, n_pieces):
+    """The byte ranges of the csv or the row groups of the parquet, and their size in the bytes of the csv"""
+    if _is_parquet(predictions_path):
+        import pyarrow.parquet as pq
+        metadata = pq.ParquetFile(predictions_path).metadata
+        # an aid takes about 8 bytes in the csv
+        return list(range(metadata.num_row_groups)), 8 * metadata.num_rows
+    return (
+        _data_module.get_line_aligned_byte_ranges(predictions_path, n_pieces),
+        pathlib.Path(predictions_path).stat().st_size
+    )
+
+
+def _read_piece(predictions_path, piece) -> "_evaluating.CSRPredictions":
+    if _is_parquet(predictions_path):
+        return _evaluating.CSRPredictions.from_parquet(predictions_path, [piece])
+    return _evaluating.CSRPredictions.from_csv(predictions_path, *piece)
+
+
+def _partition_piece(predictions_path, piece, i_sub, n_top, normalization, n_partitions, parts_dir_path, i_task):
+    """
+    Writes the rows of the piece to parts_dir_path/{partition}/{i_task}.npz and returns the max labels per row.
+    The scores normalized within the rows are also written unless normalization is None.
+    """
+    predictions = _read_piece(predictions_path, piece)
+    if normalization is not None:
+        if predictions.score is None:
+            raise ValueError(f"{predictions_path} has no scores of the candidates")
+        score = normalize_scores(predictions.score, predictions.indptr, normalization)
+    n_aids = np.diff(predictions.indptr)
+    row_key = predictions.session * len(_data_module.all_types) + predictions.type.astype(np.int64)
+
+    row = np.repeat(np.arange(len(row_key)), n_aids)
+    rank = np.arange(len(row)) - predictions.indptr[row]
+    if n_top is not None:
+        is_top = rank < n_top
+        row = row[is_top]
+        rank = rank[is_top]
+        n_aids = np.minimum(n_aids, n_top)
+    aid_indices = predictions.indptr[row] + rank
+    key = (row_key[row] << 32) | predictions.aid[aid_indices]
+    if normalization is not None:
+        score = score[aid_indices]
+
+    row_partition = predictions.session % n_partitions
+    row_order = np.argsort(row_partition, kind="stable")
+    row_edges = np.searchsorted(row_partition[row_order], np.arange(n_partitions + 1))
+    label_partition = row_partition[row]
+    label_order = np.argsort(label_partition, kind="stable")
+    label_edges = np.searchsorted(label_partition[label_order], np.arange(n_partitions + 1))
+    for i_partition in range(n_partitions):
+        labels = label_order[label_edges[i_partition]:label_edges[i_partition + 1]]
+        np.savez(
+            parts_dir_path / f"{i_partition}" / f"{i_task}.npz",
+            i_sub=i_sub,
+            row_key=row_key[row_order[row_edges[i_partition]:row_edges[i_partition + 1]]],
+            key=key[labels],
+            rank=rank[labels].astype(np.int32),
+            **({} if normalization is None else {"score": score[labels]}),
+        )
+    return int(n_aids.max(initial=0))
+
+
+def _merge_partition(partition_dir_path, n_subs, ensemble_type, weights, max_count, k, output_suffix):
+    """
+    Writes the top-k of each session_type in the partition to {partition_dir_path}{output_suffix}
+    and returns the number of rows.
+    The ties of the total score are in the order of the first appearance, i.e. of the submission and then the rank.
+    """
+    parts = [np.load(fn) for fn in sorted(partition_dir_path.glob("*.npz"))]
+    i_subs = np.array([int(part["i_sub"]) for part in parts], dtype=np.int64)
+
+    # the sessions are compared since the ranked candidates have no rows of (session, type) without aids
+    row_keys = [
+        np.unique(np.concatenate([np.empty(0, dtype=np.int64)] + [
+            part["row_key"] for part, i in zip(parts, i_subs) if i == i_sub
+        ]))
+        for i_sub in range(n_subs)
+    ]
+    sessions = [np.unique(row_key // len(_data_module.all_types)) for row_key in row_keys]
+    if not all(np.array_equal(sessions[0], session) for session in sessions[1:]):
+        raise RuntimeError("Inconsistent session_type for the given submissions")
+    row_key = np.unique(np.concatenate(row_keys))
+    del row_keys
+
+    key = np.concatenate([np.empty(0, dtype=np.int64)] + [part["key"] for part in parts])
+    rank = np.concatenate([np.empty(0, dtype=np.int64)] + [part["rank"] for part in parts]).astype(np.int64)
+    sub = np.repeat(i_subs, [len(part["key"]) for part in parts])
+    weight = weights[sub, (key >> 32) % len(_data_module.all_types)]
+    if ensemble_type == "score":
+        score = np.concatenate([np.empty(0)] + [part["score"] for part in parts]) * weight
+    else:
+        score = get_rank_scores(ensemble_type, rank, weight, max_count)
+    del parts, weight
+
+    order = np.argsort(key, kind="stable")
+    key = key[order]
+    starts = np.flatnonzero(np.r_[len(key) > 0, key[1:] != key[:-1]])
+    total_score = np.add.reduceat(score[order], starts)
+    first_appearance = np.minimum.reduceat((sub * (max_count + 1) + rank)[order], starts)
+    key = key[starts]
+    del order, rank, sub, score
+
+    label_row_key = key >> 32
+    top_order = np.lexsort((first_appearance, -total_score, label_row_key))
+    label_row_key = label_row_key[top_order]
+    aid = (key & 0xFFFFFFFF)[top_order]
+    rank = np.arange(len(label_row_key)) - np.searchsorted(label_row_key, label_row_key, side="left")
+    is_top = rank < k
+
+    session, type_ = np.divmod(row_key, len(_data_module.all_types))
+    indptr = np.r_[np.searchsorted(label_row_key[is_top], row_key), np.count_nonzero(is_top)]
+    if output_suffix == ".parquet":
+        with _submitting.CandidateWriter(partition_dir_path.with_suffix(output_suffix), with_score=True) as writer:
+            writer.write(session, type_, indptr, aid[is_top], total_score[top_order][is_top])
+    else:
+        with _submitting.SubmissionWriter(partition_dir_path.with_suffix(output_suffix), writes_header=False) as writer:
+            writer.write(session, type_, indptr, aid[is_top])
+    return writer.n_rows
+
+
+def _map(func, args, n_jobs, desc):
+    if n_jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(n_jobs, mp_context=multiprocessing.get_context("fork")) as executor:
+            return list(tqdm.tqdm(executor.map(func, *zip(*args)), total=len(args), desc=desc))
+    else:
+        return [func(*a) for a in tqdm.tqdm(args, desc=desc)]
+
+
+def ensemble(
+        submission_csv_paths: Sequence, output_path,
+        ensemble_type: str = "rank-weighting", n_top: int = None, weights: Sequence = None, k: int = 20,
+        max_bytes_per_partition: int = _data_module.max_bytes_per_range, n_jobs: int = 1, tmp_dir_path=None,
+        normalization: str = "min-max"
+) -> int:
+    """
+    Writes the top-k aids of each session_type by the total score of the first n_top labels
+    of the given submissions to output_path, and returns the number of the rows.
+    The scores are by get_rank_scores, or the scores of the candidates normalized by normalize_scores
+    if ensemble_type is "score", times the weights of the submissions (see get_weight_matrix).
+    The submissions and output_path are the ranked candidates if the suffixes are .parquet, otherwise the csv,
+    and the output candidates have the total scores.
+    """
+    if ensemble_type not in ensemble_types:
+        raise ValueError(f"ensemble_type must be one of {ensemble_types}: {ensemble_type}")
+    if ensemble_type == "score" and normalization not in normalizations:
+        raise ValueError(f"normalization must be one of {normalizations}: {normalization}")
+    submission_csv_paths = [pathlib.Path(path) for path in submission_csv_paths]
+    weights = get_weight_matrix(weights, len(submission_csv_paths))
+
+    pieces_list, sizes = zip(*(
+        _get_pieces(path, max(n_jobs, int(np.ceil(path.stat().st_size / _data_module.max_bytes_per_range))))
+        for path in submission_csv_paths
+    ))
+    n_partitions = max(1, int(np.ceil(sum(sizes) / max_bytes_per_partition)))
+    output_suffix = ".parquet" if _is_parquet(output_path) else ".csv"
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir_path) as tmp_dir_path:
+        parts_dir_path = pathlib.Path(tmp_dir_path) / "parts"
+        for i_partition in range(n_partitions):
+            (parts_dir_path / f"{i_partition}").mkdir(parents=True)
+
+        args = []
+        for i_sub, (path, pieces) in enumerate(zip(submission_csv_paths, pieces_list)):
+            for piece in pieces:
+                args.append((
+                    path, piece, i_sub, n_top, normalization if ensemble_type == "score" else None,
+                    n_partitions, parts_dir_path, len(args)
+                ))
+        max_count = max(_map(_partition_piece, args, n_jobs, "partitioning the submissions"), default=0)
+
+        args = [
+            (
+                parts_dir_path / f"{i_partition}", len(submission_csv_paths), ensemble_type, weights, max_count, k,
+                output_suffix
+            )
+            for i_partition in range(n_partitions)
+        ]
+        n_rows = sum(_map(_merge_partition, args, n_jobs, "merging the partitions"))
+
+        part_paths = [parts_dir_path / f"{i_partition}{output_suffix}" for i_partition in range(n_partitions)]
+        if output_suffix == ".parquet":
+            with _submitting.CandidateWriter(output_path, with_score=True) as writer:
+                for part_path in part_paths:
+                    writer.write_predictions(_evaluating.CSRPredictions.from_parquet(part_path))
+        else:
+            with open(output_path, "wb") as f:
+                f.write(_submitting.header)
+                for part_path in part_paths:
+                    with open(part_path, "rb") as part_f:
+                        shutil.copyfileobj(part_f, f)
+    return n_rows
@@ -0,0 +1,317 @@
+"""
+Vectorized equivalent of recsys-dataset/src/evaluate.py.
+The labels are loaded as flat (session, type, aid) arrays and the predictions as CSR arrays,
+and the hits are counted by looking up the (session, type, aid) keys of the predictions in the sorted keys of the labels
+instead of per-session sets.
+The labels of a validation split are cached as GroundTruth, which is opened memory-mapped.
+"""
+import argparse
+import pathlib
+import tempfile
+import numpy as np
+import pandas as pd
+from . import data as _data_module
+
+
+default_weights = {"clicks": 0.10, "carts": 0.30, "orders": 0.60}
+
+
+def _to_unique_labels_df(labels_df: pd.DataFrame) -> pd.DataFrame:
+    """As in get_scores, the labels are the sets of aids and the click labels with aid 0 (falsy) are ignored"""
+    labels_df = labels_df.loc[
+        (labels_df["type"] != _data_module.type_to_index["clicks"]) | (labels_df["aid"] != 0),
+        ["session", "type", "aid"]
+    ]
+    return labels_df.drop_duplicates(ignore_index=True)
+
+
+def read_labels(labels_path, n_jobs: int = 1) -> pd.DataFrame:
+    """The labels jsonl as the DataFrame of the unique (session, type, aid)"""
+    with tempfile.TemporaryDirectory() as tmp_dir_path:
+        tidy_data = _data_module.read_jsonl(
+            labels_path, "test_labels", _data_module.tidy_data_dtype, n_jobs, pathlib.Path(tmp_dir_path) / "parts"
+        )
+    return _to_unique_labels_df(pd.DataFrame({col: tidy_data[col] for col in ("session", "type", "aid")}))
+
+
+def _get_keys(session, type_, aid) -> np.ndarray:
+    """The int64 key of (session, type, aid) in the order of them"""
+    session_type = np.asarray(session, dtype=np.int64) * len(_data_module.all_types) + np.asarray(type_, dtype=np.int64)
+    return (session_type << 32) | np.asarray(aid, dtype=np.int64)
+
+
+class GroundTruth:
+    """
+    The unique labels sorted by their keys, and the number of the labels of each (session, type) as the denominators.
+    n_labels_capped is min(n_labels, cap) of the default k of the recall.
+    Saved as .npy files so that it can be opened memory-mapped.
+    """
+    file_names = ("key", "type", "group_session", "group_type", "n_labels", "n_labels_capped")
+    cap = 20
+
+    def __init__(self, key, type_, group_session, group_type, n_labels, n_labels_capped):
+        assert len(key) == len(type_) == n_labels.sum()
+        assert len(group_session) == len(group_type) == len(n_labels) == len(n_labels_capped)
+        self.key = key
+        self.type = type_
+        self.group_session = group_session
+        self.group_type = group_type
+        self.n_labels = n_labels
+        self.n_labels_capped = n_labels_capped
+
+    @classmethod
+    def from_labels_df(cls, labels_df: pd.DataFrame):
+        labels_df = _to_unique_labels_df(labels_df)
+        key = _get_keys(labels_df["session"], labels_df["type"], labels_df["aid"])
+        order = np.argsort(key)
+        key = key[order]
+        type_ = labels_df["type"].to_numpy()[order].astype(np.int8)
+
+        group_starts = np.flatnonzero(np.r_[len(key) > 0, (key[1:] >> 32) != (key[:-1] >> 32)])
+        n_labels = np.diff(np.r_[group_starts, len(key)]).astype(np.int32)
+        return cls(
+            key, type_,
+            (key[group_starts] >> 32) // len(_data_module.all_types),
+            type_[group_starts],
+            n_labels,
+            np.minimum(n_labels, cls.cap)
+        )
+
+    @classmethod
+    def load(cls, dir_path, mmap_mode="r"):
+        dir_path = pathlib.Path(dir_path)
+        return cls(*(np.load(dir_path / f"{fn}.npy", mmap_mode=mmap_mode) for fn in cls.file_names))
+
+    def save(self, dir_path):
+        dir_path = pathlib.Path(dir_path)
+        dir_path.mkdir(exist_ok=True, parents=True)
+        for fn in self.file_names:
+            np.save(dir_path / f"{fn}.npy", getattr(self, fn))
+
+    def get_n_events(self, type_index: int, k: int = 20) -> int:
+        """The denominator of the recall@k of the type"""
+        n_labels = self.n_labels_capped if k == self.cap else np.minimum(self.n_labels, k)
+        return int(n_labels[self.group_type == type_index].sum())
+
+
+def get_ground_truth(data_path, tidy_data_path, n_jobs: int = 1) -> GroundTruth:
+    """
+    The GroundTruth of data_path/test_labels.jsonl, made from data.get_npy_tidy_data("test_labels")
+    and cached under tidy_data_path/ground-truth
+    """
+    ground_truth_path = pathlib.Path(tidy_data_path) / "ground-truth"
+    if not all((ground_truth_path / f"{fn}.npy").exists() for fn in GroundTruth.file_names):
+        labels_df = _data_module.get_npy_tidy_data(
+            "test_labels", pathlib.Path(data_path), pathlib.Path(tidy_data_path), n_jobs,
+            columns=["session", "type", "aid"]
+        )
+        GroundTruth.from_labels_df(labels_df).save(ground_truth_path)
+    return GroundTruth.load(ground_truth_path)
+
+
+class CSRPredictions:
+    """
+    The predicted aids of the i-th (session, type) are aid[indptr[i]:indptr[i + 1]],
+    and score has their scores (e.g. of an ensemble) if not None.
+    """
+
+    def __init__(
+            self, session: np.ndarray, type_: np.ndarray, indptr: np.ndarray, aid: np.ndarray, score: np.ndarray = None
+    ):
+        assert len(session) == len(type_) == len(indptr) - 1
+        assert len(aid) == indptr[-1]
+        assert score is None or len(score) == len(aid)
+        self.session = session
+        self.type = type_
+        self.indptr = indptr
+        self.aid = aid
+        self.score = score
+
+    @classmethod
+    def from_df(cls, predictions_df: pd.DataFrame):
+        """predictions_df has the columns of the submission csv: "{session}_{type}" and "{aid} {aid} ..." """
+        session_type = predictions_df.iloc[:, 0].str.rsplit("_", n=1, expand=True)
+        labels = predictions_df.iloc[:, 1]
+
+        n_aids = np.where(labels == "", 0, labels.str.count(" ") + 1)
+        aid = np.fromstring(" ".join(labels[n_aids > 0]), dtype=np.int64, sep=" ")
+        if len(aid) != n_aids.sum():
+            raise ValueError("malformed predictions")
+        return cls(
+            session_type[0].astype(np.int64).to_numpy(),
+            session_type[1].map(_data_module.type_to_index).fillna(-1).astype(np.int8).to_numpy(),
+            np.r_[0, np.cumsum(n_aids)], aid
+        )
+
+    @classmethod
+    def from_arrays(cls, session, type_, aid, score=None):
+        """
+        From the predicted aids in the ranked order, grouped by consecutive (session, type).
+        type_ may be either the names or the indices of the types.
+        """
+        session = np.asarray(session, dtype=np.int64)
+        type_ = np.asarray(type_)
+        if type_.dtype.kind in "OUS":
+            type_ = pd.Series(type_).map(_data_module.type_to_index).fillna(-1).to_numpy()
+        type_ = type_.astype(np.int8)
+        starts = np.flatnonzero(np.r_[len(session) > 0, (session[1:] != session[:-1]) | (type_[1:] != type_[:-1])])
+        return cls(
+            session[starts], type_[starts], np.r_[starts, len(session)], np.asarray(aid, dtype=np.int64),
+            None if score is None else np.asarray(score)
+        )
+
+    @classmethod
+    def from_parquet(cls, predictions_path, row_groups=None):
+        """
+        Reads the ranked candidates written by submitting.CandidateWriter, only of the given row groups if not None.
+        The rows of (session, type) without aids are not in the file.
+        """
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(predictions_path)
+        table = parquet_file.read() if row_groups is None else parquet_file.read_row_groups(row_groups)
+        columns = {name: table.column(name).to_numpy() for name in table.column_names}
+        predictions = cls.from_arrays(columns["session"], columns["type"], columns["aid"], columns.get("score"))
+        n_aids = np.diff(predictions.indptr)
+        if np.any(columns["rank"] != np.arange(len(predictions.aid)) - np.repeat(predictions.indptr[:-1], n_aids)):
+            raise ValueError(f"malformed candidates in {predictions_path}")
+        return predictions
+
+    @classmethod
+    def from_csv(cls, predictions_path, start: int = 0, end: int = None):
+        """
+        Reads the submission csv ("{session}_{type},{aid} {aid} ...") after its header line.
+        The bytes are tokenized by numpy instead of splitting the strings of each line.
+        Only the bytes [start, end) are read if given, which must be line-aligned, e.g. by get_line_aligned_byte_ranges.
+        """
+        buffer = np.fromfile(
+            predictions_path, dtype=np.uint8, count=-1 if end is None else end - start, offset=start
+        )
+        line_ends = np.flatnonzero(buffer == ord("\n"))
+        if len(buffer) > 0 and buffer[-1] != ord("\n"):
+            line_ends = np.r_[line_ends, len(buffer)]
+        if start == 0:
+            header_end = line_ends[0] if len(line_ends) > 0 else len(buffer)
+            line_ends = line_ends[1:]
+        else:
+            header_end = -1
+
+        # only the lines with "_" are predictions, e.g. not the blank lines
+        underscores = np.flatnonzero(buffer == ord("_"))
+        underscores = underscores[underscores > header_end]
+        line_ends = line_ends[np.unique(np.searchsorted(line_ends, underscores))]
+        if len(underscores) != len(line_ends):
+            raise ValueError(f"malformed predictions in {predictions_path}")
+
+        type_ = np.full(len(underscores), -1, dtype=np.int8)
+        first = buffer[np.minimum(underscores + 1, len(buffer) - 1)]
+        second = buffer[np.minimum(underscores + 2, len(buffer) - 1)]
+        type_[(first == ord("c")) & (second == ord("l"))] = _data_module.type_to_index["clicks"]
+        type_[(first == ord("c")) & (second == ord("a"))] = _data_module.type_to_index["carts"]
+        type_[first == ord("o")] = _data_module.type_to_index["orders"]
+
+        # every number is parsed at once after the other bytes are replaced with spaces
+        is_digit = (ord("0") <= buffer) & (buffer <= ord("9"))
+        is_digit[:header_end + 1] = False
+        token_starts = np.flatnonzero(is_digit[1:] & ~is_digit[:-1]) + 1
+        if len(is_digit) > 0 and is_digit[0]:
+            token_starts = np.r_[0, token_starts]
+        n_tokens = np.bincount(np.searchsorted(line_ends, token_starts), minlength=len(line_ends) + 1)
+        if n_tokens[-1] > 0 or np.any(n_tokens[:-1] == 0):
+            raise ValueError(f"malformed predictions in {predictions_path}")
+        n_tokens = n_tokens[:-1]
+        buffer[~is_digit] = ord(" ")
+        del is_digit
+        values = np.fromstring(buffer.tobytes(), dtype=np.int64, sep=" ")
+        del buffer
+        assert len(values) == n_tokens.sum()
+
+        # the first number of each line is the session
+        token_offsets = np.r_[0, np.cumsum(n_tokens)[:-1]]
+        is_aid = np.ones(len(values), dtype=bool)
+        is_aid[token_offsets] = False
+        return cls(values[token_offsets], type_, np.r_[0, np.cumsum(n_tokens - 1)], values[is_aid])
+
+    def take(self, rows) -> "CSRPredictions":
+        """The predictions of the given rows (the indices or a boolean mask) in the given order"""
+        rows = np.arange(len(self.session))[rows]
+        n_aids = np.diff(self.indptr)[rows]
+        indptr = np.r_[0, np.cumsum(n_aids)]
+        aid_indices = np.arange(indptr[-1]) + np.repeat(self.indptr[rows] - indptr[:-1], n_aids)
+        return type(self)(
+            self.session[rows], self.type[rows], indptr, self.aid[aid_indices],
+            None if self.score is None else self.score[aid_indices]
+        )
+
+    def get_top_k_df(self, k: int) -> pd.DataFrame:
+        """
+        The (session, type, aid) of the first k aids of each row.
+        A (session, type) predicted more than once takes its last row as the dict in get_scores does.
+        """
+        n_aids = np.diff(self.indptr)
+        row = np.repeat(np.arange(len(n_aids)), n_aids)
+        is_in_top_k = np.arange(len(self.aid)) - self.indptr[row] < k
+
+        session_type = self.session * len(_data_module.all_types) + self.type
+        order = np.argsort(session_type, kind="stable")
+        is_last = np.zeros(len(session_type), dtype=bool)
+        is_last[order[np.r_[session_type[order][1:] != session_type[order][:-1], True]]] = True
+        is_last &= self.type >= 0
+
+        mask = is_in_top_k & is_last[row]
+        return pd.DataFrame({"session": self.session[row[mask]], "type": self.type[row[mask]], "aid": self.aid[mask]})
+
+
+def get_n_hits_and_n_events(ground_truth: GroundTruth, predictions: CSRPredictions, k=20) -> dict:
+    """{type: (the number of the hit labels, the denominator of the recall@k)}"""
+    top_k_df = predictions.get_top_k_df(k)
+    prediction_keys = _get_keys(top_k_df["session"], top_k_df["type"], top_k_df["aid"])
+    # the labels are unique and much fewer than the predictions, which are looked up in them
+    positions = np.minimum(np.searchsorted(ground_truth.key, prediction_keys), len(ground_truth.key) - 1)
+    is_hit = np.zeros(len(ground_truth.key), dtype=bool)
+    is_hit[positions[ground_truth.key[positions] == prediction_keys]] = True
+    n_hits = np.bincount(ground_truth.type[is_hit], minlength=len(_data_module.all_types))
+    return {
+        type_: (int(n_hits[type_index]), ground_truth.get_n_events(type_index, k))
+        for type_, type_index in _data_module.type_to_index.items()
+    }
+
+
+def get_scores(ground_truth: GroundTruth, predictions: CSRPredictions, k=20, weights=None) -> dict:
+    """
+    The same recalls as get_scores of recsys-dataset/src/evaluate.py.
+    ground_truth may also be the DataFrame of the labels (session, type, aid).
+    """
+    if weights is None:
+        weights = default_weights
+    if isinstance(ground_truth, pd.DataFrame):
+        ground_truth = GroundTruth.from_labels_df(ground_truth)
+
+    recalls = {}
+    for type_, (n_hits, n_events) in get_n_hits_and_n_events(ground_truth, predictions, k).items():
+        recalls[type_] = n_hits / n_events
+
+    recalls["total"] = 0.0
+    for type_ in _data_module.all_types:
+        recalls["total"] += recalls[type_] * weights[type_]
+    return recalls
+
+
+def read_predictions(predictions_path) -> CSRPredictions:
+    """The ranked candidates if the suffix is .parquet, otherwise the submission csv"""
+    if pathlib.Path(predictions_path).suffix == ".parquet":
+        return CSRPredictions.from_parquet(predictions_path)
+    return CSRPredictions.from_csv(predictions_path)
+
+
+def evaluate(labels_path, predictions_path, k=20, weights=None, n_jobs: int = 1) -> dict:
+    return get_scores(read_labels(labels_path, n_jobs), read_predictions(predictions_path), k, weights)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--test-labels", required=True)
+    parser.add_argument("--predictions", required=True)
+    parser.add_argument("-k", default=20, type=int)
+    parser.add_argument("--n-jobs", default=1, type=int)
+    args = parser.parse_args()
+    print(f"Scores: {evaluate(args.test_labels, args.predictions, args.k, n_jobs=args.n_jobs)}")
@@ -0,0 +1,224 @@
+"""
+Writers of the submission csv ("{session}_{type},{aid} {aid} ...") and of the ranked candidates (parquet).
+The csv rows are formatted from the CSR arrays (session, type, indptr, aid) as in evaluating.CSRPredictions by numpy,
+i.e. the digits of all the numbers are put into one byte buffer at once instead of joining the strings of each row,
+and the buffers are written chunk by chunk.
+The ranked candidates are the binary format between the stages, read by evaluating.CSRPredictions.from_parquet,
+so that the csv is written only for the final submission.
+"""
+import pathlib
+import numpy as np
+import pandas as pd
+from . import data as _data_module
+from . import evaluating as _evaluating
+
+
+header = b"session_type,labels\n"
+candidate_dtypes = {"session": np.int32, "type": np.uint8, "rank": np.uint8, "aid": np.uint32, "score": np.float32}
+
+_powers_of_ten = 10 ** np.arange(1, 19, dtype=np.int64)
+_suffixes = [f"_{type_},".encode() for type_ in _data_module.all_types]
+# the 4 bytes of the decimal digits of 0000-9999 as uint32
+_four_digits = np.array([list(f"{i:04d}".encode()) for i in range(10000)], dtype=np.uint8).view(np.uint32).reshape(-1)
+
+
+def _get_n_digits(values) -> np.ndarray:
+    return 1 + np.searchsorted(_powers_of_ten, values, side="right")
+
+
+def _put_digits(buffer, ends, values, n_digits):
+    """Writes the decimal values to buffer[ends - n_digits:ends]"""
+    values = values.copy()
+    for i in range(int(n_digits.max(initial=0))):
+        is_active = i < n_digits
+        buffer[ends[is_active] - 1 - i] = ord("0") + values[is_active] % 10
+        values //= 10
+
+
+def _to_digit_bytes(values, n_digits, separator: bytes) -> np.ndarray:
+    """The concatenated decimal values each followed by separator, formatted 4 digits at a time as fixed-width rows"""
+    n_groups = (int(n_digits.max(initial=1)) + 3) // 4
+    digits = np.empty((len(values), n_groups + 1), dtype=np.uint32)
+    values = values.copy()
+    for i in range(n_groups - 1, -1, -1):
+        digits[:, i] = _four_digits[values % 10000]
+        values //= 10000
+    digits[:, n_groups] = ord(separator)
+    is_kept = np.arange(4 * n_groups + 4) >= (4 * n_groups - n_digits)[:, np.newaxis]
+    is_kept[:, 4 * n_groups + 1:] = False
+    return digits.view(np.uint8)[is_kept]
+
+
+def _to_type_indices(type_, n_rows) -> np.ndarray:
+    type_ = np.asarray(type_)
+    if type_.dtype.kind in "OUS":
+        type_ = pd.Series(type_.reshape(-1)).map(_data_module.type_to_index).fillna(-1).to_numpy().reshape(type_.shape)
+    type_ = np.broadcast_to(type_.astype(np.int64), (n_rows,))
+    if np.any((type_ < 0) | (type_ >= len(_data_module.all_types))):
+        raise ValueError(f"type_ must be in {_data_module.all_types}")
+    return type_
+
+
+def get_submission_bytes(session, type_, indptr, aid) -> bytes:
+    """
+    The rows of the submission csv without the header, where the aids of the i-th row are aid[indptr[i]:indptr[i + 1]].
+    type_ may be a single type for all the rows, and either the names or the indices of the types.
+    """
+    session = np.asarray(session, dtype=np.int64)
+    type_ = _to_type_indices(type_, len(session))
+    indptr = np.asarray(indptr, dtype=np.int64)
+    aid = np.asarray(aid, dtype=np.int64)
+    assert len(indptr) == len(session) + 1
+    assert len(aid) == indptr[-1] - indptr[0]
+    indptr = indptr - indptr[0]
+    n_aids = np.diff(indptr)
+
+    # each aid is followed by " ", and the last one of each row by "\n"
+    session_n_digits = _get_n_digits(session)
+    suffix_lengths = np.array([len(suffix) for suffix in _suffixes])[type_]
+    aid_n_digits = _get_n_digits(aid)
+    labels_lengths = np.diff(np.r_[0, np.cumsum(aid_n_digits + 1)][indptr])
+    row_ends = np.cumsum(session_n_digits + suffix_lengths + labels_lengths + (n_aids == 0))
+    labels_starts = row_ends - labels_lengths - (n_aids == 0)
+
+    buffer = np.empty(row_ends[-1] if len(row_ends) > 0 else 0, dtype=np.uint8)
+    _put_digits(buffer, labels_starts - suffix_lengths, session, session_n_digits)
+    for type_index, suffix in enumerate(_suffixes):
+        suffix_starts = (labels_starts - suffix_lengths)[type_ == type_index]
+        for i, c in enumerate(suffix):
+            buffer[suffix_starts + i] = c
+
+    # the labels of the rows fill the rest of the buffer in order
+    is_labels = np.zeros(len(buffer) + 1, dtype=np.int8)
+    is_labels[labels_starts[n_aids > 0]] = 1
+    is_labels[row_ends[n_aids > 0]] = -1
+    buffer[np.cumsum(is_labels[:-1], dtype=np.int8).view(bool)] = _to_digit_bytes(aid, aid_n_digits, " ")
+    buffer[row_ends - 1] = ord("\n")
+    return buffer.tobytes()
+
+
+class SubmissionWriter:
+    """
+    Streams the submission csv to path, e.g.
+    with SubmissionWriter(path) as writer:
+        writer.write(session, "clicks", indptr, aid)
+    The rows are formatted rows_per_chunk at a time.
+    """
+
+    def __init__(self, path, rows_per_chunk: int = 2 ** 17, buffer_size: int = 2 ** 24, writes_header: bool = True):
+        self.path = pathlib.Path(path)
+        self.rows_per_chunk = rows_per_chunk
+        self.n_rows = 0
+        self._f = open(self.path, "wb", buffering=buffer_size)
+        if writes_header:
+            self._f.write(header)
+
+    def write(self, session, type_, indptr, aid):
+        """The rows as get_submission_bytes"""
+        session = np.asarray(session)
+        type_ = _to_type_indices(type_, len(session))
+        indptr = np.asarray(indptr)
+        aid = np.asarray(aid)
+        for start in range(0, len(session), self.rows_per_chunk):
+            end = min(start + self.rows_per_chunk, len(session))
+            self._f.write(get_submission_bytes(
+                session[start:end], type_[start:end], indptr[start:end + 1],
+                aid[indptr[start] - indptr[0]:indptr[end] - indptr[0]]
+            ))
+        self.n_rows += len(session)
+
+    def write_predictions(self, predictions):
+        """predictions is evaluating.CSRPredictions or a DataFrame of the submission (session_type, labels)"""
+        if isinstance(predictions, _evaluating.CSRPredictions):
+            self.write(predictions.session, predictions.type, predictions.indptr, predictions.aid)
+            return
+        for start in range(0, len(predictions), self.rows_per_chunk):
+            chunk_df = predictions.iloc[start:start + self.rows_per_chunk]
+            lines = chunk_df.iloc[:, 0].astype(str) + "," + chunk_df.iloc[:, 1].astype(str) + "\n"
+            self._f.write("".join(lines.tolist()).encode())
+        self.n_rows += len(predictions)
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def write_submission(path, predictions, **kwargs) -> int:
+    """Writes predictions (see SubmissionWriter.write_predictions) to path and returns the number of the rows"""
+    with SubmissionWriter(path, **kwargs) as writer:
+        writer.write_predictions(predictions)
+    return writer.n_rows
+
+
+class CandidateWriter:
+    """
+    Streams the ranked candidates to the parquet at path, with the columns of candidate_dtypes,
+    i.e. one row per aid with its rank in the (session, type), and the score only if with_score.
+    Each row group has up to rows_per_chunk whole (session, type), so that they can be read one by one.
+    """
+
+    def __init__(self, path, rows_per_chunk: int = 2 ** 17, with_score: bool = False):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self._pa = pa
+        self.path = pathlib.Path(path)
+        self.rows_per_chunk = rows_per_chunk
+        self.with_score = with_score
+        self.n_rows = 0
+        self.schema = pa.schema([
+            (name, pa.from_numpy_dtype(dtype)) for name, dtype in candidate_dtypes.items()
+            if with_score or name != "score"
+        ])
+        self._writer = pq.ParquetWriter(self.path, self.schema)
+
+    def write(self, session, type_, indptr, aid, score=None):
+        session = np.asarray(session)
+        type_ = _to_type_indices(type_, len(session))
+        indptr = np.asarray(indptr, dtype=np.int64)
+        n_aids = np.diff(indptr)
+        if np.any(n_aids > np.iinfo(candidate_dtypes["rank"]).max + 1):
+            raise ValueError(f"the candidates of a (session, type) must be at most {np.iinfo(np.uint8).max + 1}")
+        if self.with_score and score is None:
+            raise ValueError("score must be given if with_score")
+
+        for start in range(0, len(session), self.rows_per_chunk):
+            end = min(start + self.rows_per_chunk, len(session))
+            row = np.repeat(np.arange(start, end), n_aids[start:end])
+            aid_slice = slice(indptr[start] - indptr[0], indptr[end] - indptr[0])
+            columns = {
+                "session": session[row],
+                "type": type_[row],
+                "rank": np.arange(aid_slice.start, aid_slice.stop) - (indptr[row] - indptr[0]),
+                "aid": np.asarray(aid)[aid_slice],
+                "score": None if score is None else np.asarray(score)[aid_slice],
+            }
+            self._writer.write_table(self._pa.Table.from_arrays(
+                [columns[field.name].astype(candidate_dtypes[field.name]) for field in self.schema],
+                schema=self.schema
+            ))
+        self.n_rows += len(session)
+
+    def write_predictions(self, predictions):
+        """predictions is evaluating.CSRPredictions"""
+        self.write(predictions.session, predictions.type, predictions.indptr, predictions.aid, predictions.score)
+
+    def close(self):
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def get_writer(path, **kwargs):
+    """CandidateWriter if the suffix of path is .parquet, otherwise SubmissionWriter"""
+    if pathlib.Path(path).suffix == ".parquet":
+        return CandidateWriter(path, **kwargs)
+    return SubmissionWriter(path, **kwargs)
@@ -1,54 +1,115 @@
+"""
+Scores the predictions for the local validation data in process by evaluating.get_scores.
+The labels of each split are parsed once into the memory-mapped evaluating.GroundTruth under {days}days/ground-truth,
+which is also kept open across the calls.
+"""
+import argparse
+import concurrent.futures
+import multiprocessing
 import pathlib
-import sys
-import asyncio
+from typing import Union, Sequence
+import pandas as pd
+import tqdm
+from . import evaluating as _evaluating
 
 
 project_root_path = pathlib.Path(__file__).resolve().parent.parent
 competition_host_git_repos_path = project_root_path / "recsys-dataset"
 train_test_local_validation_data_path = project_root_path / "data" / "otto-train-and-test-data-for-local-validation"
-if not train_test_local_validation_data_path.exists():
-    raise FileNotFoundError(train_test_local_validation_data_path)
 
+# the GroundTruth of each days, kept across the calls of validate
+_ground_truths = {}
 
-async def _validate_coroutine(prediction_csv_path, days):
-    prediction_csv_path = pathlib.Path(prediction_csv_path)
-    assert prediction_csv_path.exists()
-    prediction_csv_path = prediction_csv_path.resolve()
 
-    test_labels_path = train_test_local_validation_data_path / f"{days}days" / "jsonl" / "test_labels.jsonl"
+def get_labels_path(days: int) -> pathlib.Path:
+    if not train_test_local_validation_data_path.exists():
+        raise FileNotFoundError(train_test_local_validation_data_path)
+    return train_test_local_validation_data_path / f"{days}days" / "jsonl" / "test_labels.jsonl"
 
-    await asyncio.create_subprocess_exec(
-        *[
-            "python", "-m", "pipenv", "sync"
-        ],
-        cwd=competition_host_git_repos_path
-    )
 
-    proc = await asyncio.create_subprocess_exec(
-        *[
-            "python", "-m", "pipenv", "run", "python", "-m", "src.evaluate",
-            "--test-labels", f"{test_labels_path}",
-            "--predictions", f"{prediction_csv_path}"
-        ],
-        cwd=competition_host_git_repos_path,
-        stderr=asyncio.subprocess.PIPE,
-    )
+def get_ground_truth(days: int, n_jobs: int = 1) -> "_evaluating.GroundTruth":
+    if days not in _ground_truths:
+        labels_path = get_labels_path(days)
+        _ground_truths[days] = _evaluating.get_ground_truth(labels_path.parent, labels_path.parent.parent, n_jobs)
+    return _ground_truths[days]
 
-    total_output = b""
-    while not proc.stderr.at_eof():
-        buffer = await proc.stderr.read(64)
-        total_output += buffer
-        print(buffer.decode(errors="ignore"), end="", flush=True, file=sys.stderr)
-        # await asyncio.sleep(1)
 
-    await proc.communicate()
+def to_csr_predictions(predictions) -> _evaluating.CSRPredictions:
+    """
+    predictions is evaluating.CSRPredictions, a DataFrame of the submission (session_type, labels)
+    or of the ranked (session, type, aid) rows,
+    or the path of the submission csv or of the ranked candidates (.parquet).
+    """
+    if isinstance(predictions, _evaluating.CSRPredictions):
+        return predictions
+    elif isinstance(predictions, pd.DataFrame):
+        if {"session", "type", "aid"} <= set(predictions.columns):
+            return _evaluating.CSRPredictions.from_arrays(
+                predictions["session"].to_numpy(), predictions["type"].to_numpy(), predictions["aid"].to_numpy()
+            )
+        return _evaluating.CSRPredictions.from_df(predictions)
+    else:
+        predictions_path = pathlib.Path(predictions)
+        if not predictions_path.exists():
+            raise FileNotFoundError(predictions_path)
+        return _evaluating.read_predictions(predictions_path)
 
-    if proc.returncode != 0:
-        raise RuntimeError(proc.returncode)
 
-    line = total_output.splitlines()[-1]
-    return eval(line.split(maxsplit=1)[1])
+def validate(
+        predictions: Union["_evaluating.CSRPredictions", pd.DataFrame, str, pathlib.Path], days: int = 7,
+        k: int = 20, weights=None, n_jobs: int = 1
+) -> dict:
+    return _evaluating.get_scores(get_ground_truth(days, n_jobs), to_csr_predictions(predictions), k, weights)
 
 
-def validate(prediction_csv_path, days: int):
-    return asyncio.run(_validate_coroutine(prediction_csv_path, days))
+_worker_args = None
+
+
+def _init_worker(*args):
+    global _worker_args
+    _worker_args = args
+
+
+def _validate_in_worker(i):
+    ground_truth, predictions_list, k, weights = _worker_args
+    return _evaluating.get_scores(ground_truth, to_csr_predictions(predictions_list[i]), k, weights)
+
+
+def validate_many(
+        predictions_list: Sequence[Union["_evaluating.CSRPredictions", pd.DataFrame, str, pathlib.Path]],
+        days: int = 7, k: int = 20, weights=None, n_jobs: int = 1
+) -> pd.DataFrame:
+    """
+    validate for each of predictions_list against the ground truth loaded once.
+    The predictions are parsed and scored in n_jobs worker processes if n_jobs > 1, which are forked
+    so that the DataFrames are shared copy-on-write and the ground truth memory-mapped.
+    Returns the recalls of each type and the total, indexed by the paths (or the positions of the others).
+    """
+    initargs = (get_ground_truth(days, n_jobs), predictions_list, k, weights)
+    if n_jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+                n_jobs, mp_context=multiprocessing.get_context("fork"),
+                initializer=_init_worker, initargs=initargs
+        ) as executor:
+            scores_list = list(tqdm.tqdm(
+                executor.map(_validate_in_worker, range(len(predictions_list))), total=len(predictions_list),
+                desc=f"validating with {n_jobs} workers"
+            ))
+    else:
+        _init_worker(*initargs)
+        scores_list = [_validate_in_worker(i) for i in tqdm.trange(len(predictions_list), desc="validating")]
+
+    return pd.DataFrame(scores_list, index=[
+        str(predictions) if isinstance(predictions, (str, pathlib.Path)) else i
+        for i, predictions in enumerate(predictions_list)
+    ])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("predictions_csv_paths", nargs="+")
+    parser.add_argument("--days", default=7, type=int)
+    parser.add_argument("-k", default=20, type=int)
+    parser.add_argument("--n-jobs", default=1, type=int)
+    args = parser.parse_args()
+    print(validate_many(args.predictions_csv_paths, args.days, args.k, n_jobs=args.n_jobs).to_string())
@@ -1,13 +1,16 @@
 import otto_recommender_system as ors
 import otto_recommender_system.data
-import cudf
-import tqdm
-import pandas as pd
+import otto_recommender_system.evaluating
+import otto_recommender_system.submitting
 import otto_recommender_system.validating
+import cudf
+import numpy as np
 
 
 if __name__ == "__main__":
-    train_df, valid_df, test_df = ors.data.get_datasets(type_of_tidy_data="parquet")
+    train_df, valid_df, test_df = ors.data.get_datasets(type_of_tidy_data="npy")
+    valid_session_ids, _ = ors.data.get_session_index("test", *ors.data.get_local_validation_paths())
+    test_session_ids, _ = ors.data.get_session_index("test")
 
     # train_df["type"] = train_df["type"].str.decode("utf-8")
     train_cudf = cudf.from_pandas(train_df)
@@ -27,29 +30,27 @@ if __name__ == "__main__":
         for type_, series in count_cudf_series_dict.items()
     }
 
-    def get_submission_df(target_df):
-        records = []
-        for session in tqdm.tqdm(target_df["session"].unique(), desc="making submission df"):
-            records.extend([
-                {
-                    "session_type": f"{session}_{type_}",
-                    "labels": " ".join(map(str, aid_top20_dict[type_]))
-                }
-                for type_ in unique_types
-            ])
-
-        return pd.DataFrame(records)
+    def get_predictions(session_ids):
+        # the same top-20 aids of each type for every session
+        type_indices = np.array([int(type_) for type_ in unique_types])
+        top20_aids = [np.asarray(aid_top20_dict[type_]) for type_ in unique_types]
+        n_aids = np.tile([len(aids) for aids in top20_aids], len(session_ids))
+        return ors.evaluating.CSRPredictions(
+            np.repeat(np.asarray(session_ids, dtype=np.int64), len(unique_types)),
+            np.tile(type_indices, len(session_ids)).astype(np.int8),
+            np.r_[0, np.cumsum(n_aids)],
+            np.tile(np.concatenate(top20_aids), len(session_ids)).astype(np.int64)
+        )
 
 
-    submission_df = get_submission_df(valid_df)
-    submission_df.to_csv("validation_predictions.csv", index=False)
+    predictions = get_predictions(valid_session_ids)
+    ors.submitting.write_submission("validation_predictions.csv", predictions)
 
-    cv_score_dict = ors.validating.validate("validation_predictions.csv", days=7)
+    cv_score_dict = ors.validating.validate(predictions, days=7)
     total_cv = cv_score_dict.pop("total")
     print(f"CV: {total_cv:.4f} ({{{', '.join(f'{k}: {v:.4f}' for k, v in cv_score_dict.items())}}})")
 
-    submission_df = get_submission_df(test_df)
-    submission_df.to_csv("test_predictions.csv", index=False)
+    ors.submitting.write_submission("test_predictions.csv", get_predictions(test_session_ids))
 
     # count_cudf_series = train_cudf.groupby("session")["session"].count()
     # matched_train_cudf = train_cudf[
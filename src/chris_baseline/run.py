@@ -1,6 +1,7 @@
 import pathlib
 import otto_recommender_system as ors
 import otto_recommender_system.data
+import otto_recommender_system.submitting
 import otto_recommender_system.validating
 import otto_recommender_system.co_visitation_matrixes
 import numpy as np
@@ -10,42 +11,54 @@ import argparse
 this_dir_path = pathlib.Path(__file__).resolve().parent
 
 
-def main(target, df_to_train, n_seperated_aid, max_memory_gb_for_each_split_aid):
+def main(target, df_to_train, n_seperated_aid, max_memory_gb_for_each_split_aid, backend="cudf", single_pass=False, n_jobs=1, share_pairs=False, session_offsets=None):
     saved_dir_path = this_dir_path / "data" / "co-visitation-matrix" / target
     saved_dir_path.mkdir(exist_ok=True, parents=True)
 
-    def past_time_weight(df):
-        return 1 + 3 * (df["ts_x"] - df_to_train["ts"].min()) / (df_to_train["ts"].max() - df_to_train["ts"].min())
-
     clicks_cv_matrix = ors.co_visitation_matrixes.CoVisitationMatrix(
         df_to_train, "clicks", saved_dir_path,
-        weight_func=past_time_weight,
+        weight_func=ors.co_visitation_matrixes.RecencyWeight.from_ts(
+            df_to_train if isinstance(df_to_train, ors.data.CompactTidyData) else df_to_train["ts"],
+            kind="linear", scale=3
+        ),
         n_seperated_aid=n_seperated_aid,
-        max_memory_gb_for_each_split_aid=max_memory_gb_for_each_split_aid
+        max_memory_gb_for_each_split_aid=max_memory_gb_for_each_split_aid,
+        backend=backend,
+        session_offsets=session_offsets
     )
-    clicks_cv_matrix.make(max_timedelta=np.timedelta64(1, "D"))
-    top_20_clicks_dict = clicks_cv_matrix.get_dict()
 
     carts_orders_cv_matrix = ors.co_visitation_matrixes.CoVisitationMatrix(
         df_to_train, "carts_orders", saved_dir_path,
-        weight_func=lambda _: {0: 1, 1: 6, 2: 3},
+        weight_func=ors.co_visitation_matrixes.TypeWeight({"clicks": 1, "carts": 6, "orders": 3}),
         n_seperated_aid=n_seperated_aid,
-        max_memory_gb_for_each_split_aid=max_memory_gb_for_each_split_aid
+        max_memory_gb_for_each_split_aid=max_memory_gb_for_each_split_aid,
+        backend=backend,
+        session_offsets=session_offsets
     )
-    carts_orders_cv_matrix.make(max_timedelta=np.timedelta64(1, "D"))
-    top_20_buys_dict = carts_orders_cv_matrix.get_dict()
 
     buy2buy_cv_matrix = ors.co_visitation_matrixes.CoVisitationMatrix(
         df_to_train, "buy2buy", saved_dir_path,
         types_to_use=["carts", "orders"],
         n_seperated_aid=n_seperated_aid,
-        max_memory_gb_for_each_split_aid=max_memory_gb_for_each_split_aid
+        max_memory_gb_for_each_split_aid=max_memory_gb_for_each_split_aid,
+        backend=backend,
+        session_offsets=session_offsets
     )
-    buy2buy_cv_matrix.make(max_timedelta=np.timedelta64(14, "D"))
-    top_20_buy2buy_dict = buy2buy_cv_matrix.get_dict()
+
+    cv_matrixes = [clicks_cv_matrix, carts_orders_cv_matrix, buy2buy_cv_matrix]
+    max_timedeltas = [np.timedelta64(1, "D"), np.timedelta64(1, "D"), np.timedelta64(14, "D")]
+    if share_pairs:
+        ors.co_visitation_matrixes.make_co_visitation_matrixes(cv_matrixes, max_timedeltas, tops=[20])
+    else:
+        for cv_matrix, max_timedelta in zip(cv_matrixes, max_timedeltas):
+            cv_matrix.make(max_timedelta=max_timedelta, single_pass=single_pass, n_jobs=n_jobs, tops=[20])
+
+    top_20_clicks_index = clicks_cv_matrix.get_index()
+    top_20_buys_index = carts_orders_cv_matrix.get_index()
+    top_20_buy2buy_index = buy2buy_cv_matrix.get_index()
 
     return (
-        top_20_clicks_dict, top_20_buys_dict, top_20_buy2buy_dict,
+        top_20_clicks_index, top_20_buys_index, top_20_buy2buy_index,
         saved_dir_path
     )
 
@@ -54,19 +67,38 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--n-seperated-aid", default=8, type=int)
     parser.add_argument("--max-memory-gb-for-each-split-aid", default=1, type=int)
+    parser.add_argument("--backend", choices=["cudf", "pandas", "numpy"], default="cudf")
+    parser.add_argument("--single-pass", action="store_true")
+    parser.add_argument("--n-jobs", default=1, type=int, help="the number of worker processes to build the matrixes and to predict")
+    parser.add_argument("--share-pairs", action="store_true", help="--single-pass, but sharing the pairs among the matrixes")
+    parser.add_argument("--vectorized", action="store_true", help="predict all the sessions at once")
+    parser.add_argument("--type-of-tidy-data", default="parquet", choices=["parquet", "npy", "npy-compact"])
     args = parser.parse_args()
 
-    all_train_df = ors.data.get_pd_tidy_data("train")
-    test_df = ors.data.get_pd_tidy_data("test")
+    if args.type_of_tidy_data in ("npy", "npy-compact"):
+        compact = args.type_of_tidy_data == "npy-compact"
+        all_train_df = ors.data.get_npy_tidy_data("train", n_jobs=args.n_jobs, compact=compact)
+        test_df = ors.data.get_npy_tidy_data("test", n_jobs=args.n_jobs, compact=compact)
+        all_train_session_index = ors.data.get_session_index("train", n_jobs=args.n_jobs, compact=compact)
+        test_session_index = ors.data.get_session_index("test", n_jobs=args.n_jobs, compact=compact)
+    else:
+        all_train_df = ors.data.get_pd_tidy_data("train", n_jobs=args.n_jobs)
+        test_df = ors.data.get_pd_tidy_data("test", n_jobs=args.n_jobs)
+        all_train_session_index = test_session_index = None
 
     (
-        top_20_clicks_dict, top_20_buys_dict, top_20_buy2buy_dict,
+        top_20_clicks_index, top_20_buys_index, top_20_buy2buy_index,
         saved_dir_path
-    ) = main("all-train", all_train_df, args.n_seperated_aid, args.max_memory_gb_for_each_split_aid)
+    ) = main("all-train", all_train_df, args.n_seperated_aid, args.max_memory_gb_for_each_split_aid, args.backend, args.single_pass, args.n_jobs, args.share_pairs,
+        session_offsets=None if all_train_session_index is None else all_train_session_index[1]
+    )
 
     test_predictions_df = ors.co_visitation_matrixes.get_predictions_df(
         "test", test_df,
-        top_20_clicks_dict, top_20_buys_dict, top_20_buy2buy_dict,
-        saved_dir_path
+        top_20_clicks_index, top_20_buys_index, top_20_buy2buy_index,
+        saved_dir_path,
+        vectorized=args.vectorized,
+        n_jobs=args.n_jobs,
+        session_index=test_session_index
     )
-    test_predictions_df.to_csv(this_dir_path / f"test_predictions.csv", index=False)
+    ors.submitting.write_submission(this_dir_path / "test_predictions.csv", test_predictions_df)
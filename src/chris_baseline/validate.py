@@ -1,9 +1,9 @@
 import pathlib
 import otto_recommender_system as ors
 import otto_recommender_system.data
+import otto_recommender_system.submitting
 import otto_recommender_system.validating
 import otto_recommender_system.co_visitation_matrixes
-import numpy as np
 import argparse
 from src.chris_baseline.run import main
 
@@ -15,23 +15,41 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--n-seperated-aid", default=8, type=int)
     parser.add_argument("--max-memory-gb-for-each-split-aid", default=1, type=int)
+    parser.add_argument("--backend", choices=["cudf", "pandas", "numpy"], default="cudf")
+    parser.add_argument("--single-pass", action="store_true")
+    parser.add_argument("--n-jobs", default=1, type=int)
+    parser.add_argument("--share-pairs", action="store_true", help="--single-pass, but sharing the pairs among the matrixes")
+    parser.add_argument("--vectorized", action="store_true", help="predict all the sessions at once")
+    parser.add_argument("--type-of-tidy-data", default="parquet", choices=["parquet", "npy", "npy-compact"])
     args = parser.parse_args()
 
     train_df, valid_df, test_df, valid_labels_df = ors.data.get_datasets(
-        type_of_tidy_data="parquet", return_valid_labels=True
+        type_of_tidy_data=args.type_of_tidy_data, return_valid_labels=True, n_jobs=args.n_jobs
     )
+    if args.type_of_tidy_data in ("npy", "npy-compact"):
+        compact = args.type_of_tidy_data == "npy-compact"
+        data_path, tidy_data_path = ors.data.get_local_validation_paths()
+        train_session_index = ors.data.get_session_index("train", data_path, tidy_data_path, args.n_jobs, compact=compact)
+        valid_session_index = ors.data.get_session_index("test", data_path, tidy_data_path, args.n_jobs, compact=compact)
+    else:
+        train_session_index = valid_session_index = None
 
     (
-        top_20_clicks_dict, top_20_buys_dict, top_20_buy2buy_dict,
+        top_20_clicks_index, top_20_buys_index, top_20_buy2buy_index,
         saved_dir_path
-    ) = main("all-train", train_df, args.n_seperated_aid, args.max_memory_gb_for_each_split_aid)
+    ) = main("all-train", train_df, args.n_seperated_aid, args.max_memory_gb_for_each_split_aid, args.backend, args.single_pass, args.n_jobs, args.share_pairs,
+        session_offsets=None if train_session_index is None else train_session_index[1]
+    )
 
     valid_predictions_df = ors.co_visitation_matrixes.get_predictions_df(
         "validation", valid_df,
-        top_20_clicks_dict, top_20_buys_dict, top_20_buy2buy_dict,
-        saved_dir_path
+        top_20_clicks_index, top_20_buys_index, top_20_buy2buy_index,
+        saved_dir_path,
+        vectorized=args.vectorized,
+        n_jobs=args.n_jobs,
+        session_index=valid_session_index
     )
-    valid_predictions_df.to_csv(this_dir_path / f"validation_predictions.csv", index=False)
-    cv_score_dict = ors.validating.validate(this_dir_path / "validation_predictions.csv", days=7)
+    ors.submitting.write_submission(this_dir_path / "validation_predictions.csv", valid_predictions_df)
+    cv_score_dict = ors.validating.validate(valid_predictions_df, days=7)
     total_cv = cv_score_dict.pop("total")
     print(f"CV: {total_cv:.4f} ({{{', '.join(f'{k}: {v:.4f}' for k, v in cv_score_dict.items())}}})")
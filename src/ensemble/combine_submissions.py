@@ -1,8 +1,12 @@
 import argparse
-
-import pandas as pd
-import polars as pl
 import pathlib
+import sys
+import numpy as np
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent.parent))
+import otto_recommender_system.data
+import otto_recommender_system.evaluating
+import otto_recommender_system.submitting
 
 
 if __name__ == "__main__":
@@ -12,24 +16,22 @@ if __name__ == "__main__":
     parser.add_argument("type", choices=["clicks", "carts", "orders"])
     args = parser.parse_args()
 
-    base_df = pl.read_csv(args.base_submission_csv)
-    n_original_base_records = len(base_df)
-
-    concat_df = pd.DataFrame()
-
-    # assert len(args.submission_csv_to_add) == len(args.type)
-    for submission_csv_to_add, event_type in zip([args.submission_csv_to_add], [args.type]):
-        to_add_df = pl.read_csv(submission_csv_to_add)
-
-        to_add_df = to_add_df.filter(to_add_df["session_type"].str.ends_with(f"_{event_type}"))
-        filtered_base_df = base_df.filter(~base_df["session_type"].str.ends_with(f"_{event_type}"))
-        assert len(to_add_df) + len(filtered_base_df) == n_original_base_records
-
-        concat_df = pl.concat([filtered_base_df, to_add_df])
-        assert len(concat_df) == n_original_base_records
-        assert len(concat_df) == len(concat_df["session_type"].unique())
-        base_df = concat_df
-
-    fn = f"concat_{args.base_submission_csv.stem}_on_{'_'.join([args.type])}.csv"
+    base = otto_recommender_system.evaluating.read_predictions(args.base_submission_csv)
+    type_index = otto_recommender_system.data.type_to_index[args.type]
+    to_add = otto_recommender_system.evaluating.read_predictions(args.submission_csv_to_add)
+    to_add = to_add.take(to_add.type == type_index)
+    filtered_base = base.take(base.type != type_index)
+    session_type = np.concatenate([
+        predictions.session * len(otto_recommender_system.data.all_types) + predictions.type
+        for predictions in (filtered_base, to_add)
+    ])
+    assert len(session_type) == len(np.unique(session_type))
+    # not the number of the rows, since the ranked candidates have no rows without aids
+    session = session_type // len(otto_recommender_system.data.all_types)
+    assert np.array_equal(np.unique(session), np.unique(base.session))
+
+    fn = f"concat_{args.base_submission_csv.stem}_on_{'_'.join([args.type])}{args.base_submission_csv.suffix}"
     print(f"* Saving as {fn}")
-    concat_df.to_pandas().to_csv(fn, index=False)
+    with otto_recommender_system.submitting.get_writer(fn) as writer:
+        writer.write_predictions(filtered_base)
+        writer.write_predictions(to_add)
@@ -1,14 +1,17 @@
-import polars as pl
-import numpy as np
-import tqdm
+import pathlib
+import sys
 import argparse
-from predict import read_sub
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent.parent))
+import otto_recommender_system.evaluating
+import otto_recommender_system.validating
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("predicted_file")
     parser.add_argument("type", nargs="*", choices=[[], "clicks", "carts", "orders"])
+    parser.add_argument("--days", default=7, type=int, help="the split of the local validation")
     args = parser.parse_args()
 
     event_type = args.type
@@ -17,42 +20,18 @@ if __name__ == "__main__":
 
     print("* Given Parameters:")
     print("{:<25}  =  {:<}".format("type", str(event_type)))
+    print("{:<25}  =  {:<}".format("days", str(args.days)))
     print()
 
     print(f"* Reading {args.predicted_file}")
-    df = read_sub(args.predicted_file)
-    df = (
-        df
-        .with_column(pl.col("session_type").str.split(by="_"))
-        .select([
-            pl.col("session_type").arr.get(0).alias("session").cast(pl.Int64),
-            pl.col("session_type").arr.get(1).alias("type"),
-            pl.col("aid")
-        ])
-    )
+    predictions = otto_recommender_system.evaluating.read_predictions(args.predicted_file)
 
-    df = df.groupby(["session", "type"]).head(20)
-    df = df.unique(subset=["session", "aid"])
+    print(f"* Loading the ground truth of {args.days}days")
+    ground_truth = otto_recommender_system.validating.get_ground_truth(args.days)
+    n_hits_and_n_events = otto_recommender_system.evaluating.get_n_hits_and_n_events(ground_truth, predictions, k=20)
 
-    print("* Reading test_labels.parquet")
-    test_labels_df = pl.read_parquet("../../shaoroon/01_Data/add/local-validation_chris/test_labels.parquet")
-    test_labels_df = (
-        test_labels_df
-        .explode("ground_truth")
-        .with_column(pl.col("ground_truth").cast(pl.UInt32))
+    recall = (
+        sum(n_hits_and_n_events[type_][0] for type_ in event_type)
+        / sum(n_hits_and_n_events[type_][1] for type_ in event_type)
     )
-
-    assert (df["session"].is_in(test_labels_df["session"])).to_numpy().all()
-    test_labels_df = test_labels_df.filter(test_labels_df["type"].is_in(event_type))
-    df = df.join(test_labels_df, on=["session", "type"], how="semi")
-
-    inner_joined_df = (
-        test_labels_df
-        .join(df, left_on=["session", "type", "ground_truth"], right_on=["session", "type", "aid"], how="inner")
-    )
-
-    hits_df = inner_joined_df.groupby(["session", "type"]).count()
-    gt_count_df = test_labels_df.groupby(["session", "type"]).agg(pl.count().clip(0, 20))
-
-    recall = hits_df["count"].sum() / gt_count_df["count"].sum()
-    print(f"orders recall = {recall:}")
+    print(f"{' + '.join(event_type)} recall = {recall:}")
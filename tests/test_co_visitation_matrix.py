@@ -0,0 +1,458 @@
+import collections
+import functools
+import numpy as np
+import pandas as pd
+import pytest
+from otto_recommender_system.co_visitation_matrixes import (
+    CoVisitationMatrix, WeightSpec, RecencyWeight, TimeGapWeight, make_co_visitation_matrixes, caching,
+    co_visitation_matrix
+)
+from otto_recommender_system.data import (
+    make_session_index, get_npy_tidy_data, CompactTidyData, TidyDataChunks, tidy_data_dtype
+)
+
+
+def make_sessions_df(n_sessions=40, n_aids=50, max_n_events=45, seed=0):
+    rng = np.random.default_rng(seed)
+    records = []
+    for session in range(n_sessions):
+        n_events = rng.integers(1, max_n_events)
+        ts = 1659304800000 + np.cumsum(rng.integers(1, 12 * 60 * 60 * 1000, n_events))
+        for aid, t, type_ in zip(rng.integers(0, n_aids, n_events), ts, rng.integers(0, 3, n_events)):
+            records.append((session, aid, t, type_))
+    # make sure every aid appears so that aid buckets are the same as on the real data
+    records.extend((n_sessions, aid, 1659304800000 + aid, 0) for aid in range(n_aids))
+
+    df = pd.DataFrame(records, columns=["session", "aid", "ts", "type"])
+    return df.astype({"session": "i4", "aid": "i4", "ts": "M8[ms]", "type": "i1"})
+
+
+def get_reference_total_weight(df, max_timedelta, types_to_use=None, type_weight=None):
+    total_weight = collections.Counter()
+    for _, session_df in df.groupby("session"):
+        if types_to_use is not None:
+            session_df = session_df.loc[session_df["type"].isin(types_to_use)]
+        events = sorted(session_df.itertuples(index=False), key=lambda e: e.ts, reverse=True)[:30]
+        seen = set()
+        for x in events:
+            for y in events:
+                if not abs(x.ts - y.ts) < max_timedelta or (x.aid, y.aid) in seen:
+                    continue
+                seen.add((x.aid, y.aid))
+                total_weight[(x.aid, y.aid)] += 1 if type_weight is None else type_weight[y.type]
+    return dict(total_weight)
+
+
+def read_total_weight(cv_matrix):
+    df = pd.concat([cv_matrix.get_df(i) for i in range(cv_matrix.n_seperated_aid)])
+    assert not df.duplicated(["aid_x", "aid_y"]).any()
+    return {(aid_x, aid_y): weight for aid_x, aid_y, weight in df[["aid_x", "aid_y", "weight"]].itertuples(index=False)}
+
+
+@pytest.mark.parametrize("single_pass", [False, True])
+@pytest.mark.parametrize("backend", ["pandas", "numpy"])
+@pytest.mark.parametrize("types_to_use, type_weight, max_timedelta", [
+    (None, None, np.timedelta64(1, "D")),
+    (None, {0: 1, 1: 6, 2: 3}, np.timedelta64(1, "D")),
+    (["carts", "orders"], None, np.timedelta64(14, "D")),
+])
+def test_cpu_backends(tmp_path, backend, single_pass, types_to_use, type_weight, max_timedelta):
+    df = make_sessions_df()
+    cv_matrix = CoVisitationMatrix(
+        df, "test", tmp_path,
+        max_memory_gb_for_each_split_aid=1e-6,
+        n_seperated_aid=4,
+        types_to_use=types_to_use,
+        weight_func=None if type_weight is None else lambda _: type_weight,
+        backend=backend
+    )
+    assert len(cv_matrix.df_list) > 1
+    cv_matrix.make(max_timedelta, single_pass=single_pass)
+
+    expected = get_reference_total_weight(
+        df, max_timedelta, None if types_to_use is None else [1, 2], type_weight
+    )
+    assert read_total_weight(cv_matrix) == expected
+
+
+@pytest.mark.parametrize("max_timedelta", [np.timedelta64(1, "h"), np.timedelta64(14, "D")])
+def test_numpy_backend_pair_df(max_timedelta):
+    from otto_recommender_system.co_visitation_matrixes import backends
+
+    df = make_sessions_df(seed=1)
+    columns = ["session", "aid_x", "ts_x", "type_x", "aid_y", "ts_y", "type_y"]
+    expected = backends.PandasBackend().get_pair_df(df, None, (10, 30), max_timedelta)
+    actual = backends.NumpyBackend().get_pair_df(df, None, (10, 30), max_timedelta)
+    assert list(actual.columns) == columns
+    pd.testing.assert_frame_equal(
+        actual.sort_values(columns).reset_index(drop=True),
+        expected.sort_values(columns).reset_index(drop=True),
+        check_dtype=False
+    )
+
+
+def test_n_jobs(tmp_path):
+    df = make_sessions_df(seed=2)
+    type_weight = {0: 1, 1: 6, 2: 3}
+    cv_matrix = CoVisitationMatrix(
+        df, "test", tmp_path,
+        max_memory_gb_for_each_split_aid=1e-6,
+        n_seperated_aid=4,
+        weight_func=lambda _: type_weight,
+        backend="numpy",
+        session_offsets=make_session_index(df["session"].to_numpy())[1]
+    )
+    assert cv_matrix.indices_in_all_sessions.tolist() == np.unique(df["session"], return_index=True)[1].tolist()
+    cv_matrix.make(np.timedelta64(1, "D"), n_jobs=2)
+    assert read_total_weight(cv_matrix) == get_reference_total_weight(df, np.timedelta64(1, "D"), None, type_weight)
+    assert not (cv_matrix.dirname / "shared-arrays").exists()
+
+    def failing_weight_func(_):
+        raise ValueError("failing_weight_func")
+
+    failing_cv_matrix = CoVisitationMatrix(
+        df, "failing", tmp_path, n_seperated_aid=4, weight_func=failing_weight_func, backend="numpy"
+    )
+    with pytest.raises(ValueError, match="failing_weight_func"):
+        failing_cv_matrix.make(np.timedelta64(1, "D"), n_jobs=2)
+    # the copy of the training data for the workers is removed even on the failure
+    assert not (failing_cv_matrix.dirname / "shared-arrays").exists()
+
+
+def test_weight_accumulators_share_memory_budget(tmp_path):
+    rng = np.random.default_rng(3)
+    # 1000 bytes shared by 4 accumulators, each of which gets 360 bytes at a time
+    budget = co_visitation_matrix._MemoryBudget(1e-6)
+    accumulators = [co_visitation_matrix._WeightAccumulator(tmp_path / f"{i}", budget) for i in range(4)]
+    added_dfs = []
+    for _ in range(10):
+        for accumulator in accumulators:
+            added_df = pd.DataFrame({
+                "aid_x": rng.integers(0, 5, 30), "aid_y": rng.integers(0, 5, 30), "weight": rng.integers(1, 4, 30)
+            }).astype(np.int32)
+            accumulator.add(added_df)
+            added_dfs.append(added_df)
+            assert sum(accumulator.n_bytes for accumulator in accumulators) <= 1000
+    assert all(accumulator.n_spilled > 0 for accumulator in accumulators)
+
+    expected = pd.concat(added_dfs).groupby(["aid_x", "aid_y"])["weight"].sum()
+    actual = pd.concat([accumulator.get_total_weight() for accumulator in accumulators])
+    pd.testing.assert_series_equal(actual.groupby(level=["aid_x", "aid_y"]).sum(), expected, check_dtype=False)
+
+
+@pytest.mark.parametrize("backend", ["pandas", "numpy"])
+def test_make_co_visitation_matrixes(tmp_path, backend):
+    df = make_sessions_df(seed=3)
+    params_list = [
+        dict(dirname="clicks", types_to_use=None, type_weight=None, max_timedelta=np.timedelta64(1, "D")),
+        dict(dirname="carts_orders", types_to_use=None, type_weight={0: 1, 1: 6, 2: 3}, max_timedelta=np.timedelta64(1, "D")),
+        dict(dirname="buy2buy", types_to_use=[1, 2], type_weight=None, max_timedelta=np.timedelta64(14, "D")),
+        dict(dirname="clicks_3h", types_to_use=None, type_weight=None, max_timedelta=np.timedelta64(3, "h")),
+    ]
+    cv_matrixes = [
+        CoVisitationMatrix(
+            df, params["dirname"], tmp_path,
+            max_memory_gb_for_each_split_aid=1e-6,
+            n_seperated_aid=4,
+            types_to_use=params["types_to_use"],
+            weight_func=None if params["type_weight"] is None else (lambda type_weight: lambda _: type_weight)(params["type_weight"]),
+            backend=backend
+        )
+        for params in params_list
+    ]
+    make_co_visitation_matrixes(cv_matrixes, [params["max_timedelta"] for params in params_list])
+
+    for cv_matrix, params in zip(cv_matrixes, params_list):
+        assert read_total_weight(cv_matrix) == get_reference_total_weight(
+            df, params["max_timedelta"], params["types_to_use"], params["type_weight"]
+        )
+
+
+def save_npz_tidy_data(df, tmp_path):
+    """Saves df as the npz cache, from which the npy tidy data is converted"""
+    if (tmp_path / "npz" / "train.npz").exists():
+        return
+    (tmp_path / "npz").mkdir()
+    np_tidy_data = np.empty(len(df), dtype=tidy_data_dtype)
+    for name in tidy_data_dtype.names:
+        np_tidy_data[name] = df[name].to_numpy()
+    np.savez_compressed(tmp_path / "npz" / "train.npz", np_tidy_data)
+
+
+def make_tidy_data_chunks(df, tmp_path, **kwargs):
+    """TidyDataChunks over df, converted from the npz cache"""
+    save_npz_tidy_data(df, tmp_path)
+    return TidyDataChunks("train", tmp_path, tmp_path, **kwargs)
+
+
+def make_compact_tidy_data(df, tmp_path):
+    """CompactTidyData of df, converted from the npz cache"""
+    save_npz_tidy_data(df, tmp_path)
+    return get_npy_tidy_data("train", tmp_path, tmp_path, compact=True)
+
+
+@pytest.mark.parametrize("compact", [False, True])
+@pytest.mark.parametrize("single_pass, n_jobs", [(False, 1), (True, 1), (False, 2)])
+def test_tidy_data_chunks(tmp_path, single_pass, n_jobs, compact):
+    df = make_sessions_df(seed=4)
+    chunks = make_tidy_data_chunks(df, tmp_path, max_bytes_per_chunk=17 * 100, compact=compact)
+    assert len(chunks) > 1
+    type_weight = {0: 1, 1: 6, 2: 3}
+    cv_matrix = CoVisitationMatrix(
+        chunks, "test", tmp_path,
+        n_seperated_aid=4,
+        weight_func=lambda _: type_weight,
+        backend="numpy"
+    )
+    cv_matrix.make(np.timedelta64(1, "D"), single_pass=single_pass, n_jobs=n_jobs)
+    assert read_total_weight(cv_matrix) == get_reference_total_weight(df, np.timedelta64(1, "D"), None, type_weight)
+
+
+@pytest.mark.parametrize("single_pass", [False, True])
+def test_tidy_data_chunks_memory_budget(tmp_path, monkeypatch, single_pass):
+    df = make_sessions_df(seed=4)
+    chunks = make_tidy_data_chunks(df, tmp_path)
+    assert len(chunks) == 1
+    type_weight = {0: 1, 1: 6, 2: 3}
+    max_memory_gb = 1e-5
+    cv_matrix = CoVisitationMatrix(
+        chunks, "test", tmp_path,
+        max_memory_gb_for_each_split_aid=max_memory_gb,
+        n_seperated_aid=4,
+        weight_func=lambda _: type_weight,
+        backend="numpy"
+    )
+
+    paired_dfs = []
+    get_chunk_total_weight = CoVisitationMatrix._get_chunk_total_weight
+
+    def _get_chunk_total_weight(self, chunk_df, *args):
+        paired_dfs.append(chunk_df)
+        return get_chunk_total_weight(self, chunk_df, *args)
+
+    monkeypatch.setattr(CoVisitationMatrix, "_get_chunk_total_weight", _get_chunk_total_weight)
+    cv_matrix.make(np.timedelta64(1, "D"), single_pass=single_pass)
+    assert read_total_weight(cv_matrix) == get_reference_total_weight(df, np.timedelta64(1, "D"), None, type_weight)
+
+    # the chunk is divided by the estimate of the pair memory, sum(n_events ** 2) * itemsize per piece,
+    # where the first session of a piece is the one exceeding the budget of the previous piece
+    assert len(paired_dfs) > (1 if single_pass else cv_matrix.n_seperated_aid)
+    for paired_df in paired_dfs:
+        n_events = paired_df.groupby("session").size().to_numpy()
+        itemsize = sum(dtype.itemsize for dtype in paired_df.dtypes)
+        assert itemsize * np.sum(n_events[1:] ** 2) <= max_memory_gb * 1e9
+
+
+@pytest.mark.parametrize("backend, single_pass, n_jobs", [
+    ("pandas", False, 1), ("numpy", False, 1), ("numpy", True, 1), ("numpy", False, 2)
+])
+def test_compact_tidy_data(tmp_path, backend, single_pass, n_jobs):
+    df = make_sessions_df(seed=7)
+    compact_data = make_compact_tidy_data(df, tmp_path)
+    type_weight = {0: 1, 1: 6, 2: 3}
+    cv_matrix = CoVisitationMatrix(
+        compact_data, "test", tmp_path,
+        max_memory_gb_for_each_split_aid=1e-5,
+        n_seperated_aid=4,
+        weight_func=lambda _: type_weight,
+        backend=backend
+    )
+    # divided by the session index without decoding
+    assert len(cv_matrix.df_list) > 1
+    assert all(isinstance(chunk, CompactTidyData) for chunk in cv_matrix.df_list)
+    cv_matrix.make(np.timedelta64(1, "D"), single_pass=single_pass, n_jobs=n_jobs)
+    assert read_total_weight(cv_matrix) == get_reference_total_weight(df, np.timedelta64(1, "D"), None, type_weight)
+
+
+def test_compact_tidy_data_with_shared_pairs(tmp_path):
+    df = make_sessions_df(seed=8)
+    compact_data = make_compact_tidy_data(df, tmp_path)
+
+    total_weights = []
+    for data, ts in ((df, df["ts"]), (compact_data, compact_data)):
+        cv_matrixes = [
+            CoVisitationMatrix(
+                data, "clicks", tmp_path, n_seperated_aid=2,
+                weight_func=RecencyWeight.from_ts(ts) * TimeGapWeight("6h"), backend="numpy"
+            ),
+            CoVisitationMatrix(data, "buy2buy", tmp_path, n_seperated_aid=2, types_to_use=[1, 2], backend="numpy"),
+        ]
+        make_co_visitation_matrixes(cv_matrixes, [np.timedelta64(1, "D"), np.timedelta64(14, "D")])
+        total_weights.append([read_total_weight(cv_matrix) for cv_matrix in cv_matrixes])
+    assert total_weights[0] == total_weights[1]
+    assert total_weights[1][1] == get_reference_total_weight(df, np.timedelta64(14, "D"), [1, 2])
+
+
+@pytest.mark.parametrize("decay", [None, 0.5])
+def test_update(tmp_path, decay):
+    df = make_sessions_df(seed=5)
+    new_df = make_sessions_df(n_sessions=10, seed=6)
+    new_df["session"] += df["session"].max() + 1
+    type_weight = {0: 1, 1: 6, 2: 3}
+
+    def make_cv_matrix(df, dirname):
+        return CoVisitationMatrix(
+            df, dirname, tmp_path, n_seperated_aid=4, weight_func=lambda _: type_weight, backend="numpy"
+        )
+
+    cv_matrix = make_cv_matrix(df, "updated")
+    cv_matrix.make(np.timedelta64(1, "D"))
+    cv_matrix.get_dict(top=1000)
+    cv_matrix.get_index(top=1000)
+    cv_matrix.get_top_df(0, top=3)
+    cv_matrix.update(new_df, np.timedelta64(1, "D"), decay=decay)
+
+    expected_total_weight = collections.Counter({
+        pair: round(weight * (1 if decay is None else decay))
+        for pair, weight in get_reference_total_weight(df, np.timedelta64(1, "D"), None, type_weight).items()
+    })
+    expected_total_weight.update(get_reference_total_weight(new_df, np.timedelta64(1, "D"), None, type_weight))
+    assert read_total_weight(cv_matrix) == dict(expected_total_weight)
+
+    # the refreshed caches are the same as the ones made from the updated buckets
+    rebuilt_cv_matrix = make_cv_matrix(df, "rebuilt")
+    rebuilt_cv_matrix.dirname.mkdir(parents=True)
+    for i in range(cv_matrix.n_seperated_aid):
+        cv_matrix.get_df(i).to_parquet(rebuilt_cv_matrix.dirname / f"{i}.parquet")
+    for i in range(cv_matrix.n_seperated_aid):
+        pd.testing.assert_frame_equal(
+            cv_matrix.get_top_df(i, top=1000).sort_values(["aid_x", "aid_y"], ignore_index=True),
+            rebuilt_cv_matrix.get_top_df(i, top=1000).sort_values(["aid_x", "aid_y"], ignore_index=True)
+        )
+    assert {
+        aid_x: set(aid_ys) for aid_x, aid_ys in cv_matrix.get_dict(top=1000).items()
+    } == {
+        aid_x: set(aid_ys) for aid_x, aid_ys in rebuilt_cv_matrix.get_dict(top=1000).items()
+    }
+    index = cv_matrix.get_index(top=1000)
+    rebuilt_index = rebuilt_cv_matrix.get_index(top=1000)
+    np.testing.assert_array_equal(index.indptr, rebuilt_index.indptr)
+    np.testing.assert_array_equal(index.weights, rebuilt_index.weights)
+    top_3_df = cv_matrix.get_top_df(0, top=3)
+    assert top_3_df.groupby("aid_x").size().max() <= 3
+    assert set(top_3_df["aid_x"]) == set(rebuilt_cv_matrix.get_top_df(0, top=3)["aid_x"])
+
+
+def test_cache_key(tmp_path):
+    df = make_sessions_df(seed=7)
+
+    def make_cv_matrix(df, dirname, type_weight, **kwargs):
+        return CoVisitationMatrix(
+            df, dirname, tmp_path, n_seperated_aid=2, weight_func=lambda _: type_weight, backend="numpy", **kwargs
+        )
+
+    cv_matrix = make_cv_matrix(df, "a", {0: 1, 1: 6, 2: 3})
+    # nothing is read from the legacy location before make
+    for read in (lambda: cv_matrix.get_df(0), lambda: cv_matrix.get_top_df(0), cv_matrix.get_dict, cv_matrix.get_index):
+        with pytest.raises(FileNotFoundError, match="call make first"):
+            read()
+    cv_matrix.make(np.timedelta64(1, "D"))
+    total_weight = read_total_weight(cv_matrix)
+
+    # the same build under another name reuses the entry
+    reused_cv_matrix = make_cv_matrix(df.copy(), "b", {0: 1, 1: 6, 2: 3})
+    reused_cv_matrix.make(np.timedelta64(1, "D"))
+    assert reused_cv_matrix.dirname == cv_matrix.dirname
+
+    # a different weight_func, data, types_to_use or max_timedelta is another entry
+    dirnames = {cv_matrix.dirname}
+    for other_cv_matrix, max_timedelta in [
+        (make_cv_matrix(df, "a", {0: 1, 1: 6, 2: 4}), np.timedelta64(1, "D")),
+        (make_cv_matrix(df.iloc[1:], "a", {0: 1, 1: 6, 2: 3}), np.timedelta64(1, "D")),
+        (make_cv_matrix(df, "a", {0: 1, 1: 6, 2: 3}, types_to_use=["carts", "orders"]), np.timedelta64(1, "D")),
+        (make_cv_matrix(df, "a", {0: 1, 1: 6, 2: 3}), np.timedelta64(2, "D")),
+    ]:
+        other_cv_matrix.make(max_timedelta)
+        assert other_cv_matrix.dirname not in dirnames
+        dirnames.add(other_cv_matrix.dirname)
+    assert read_total_weight(cv_matrix) == total_weight
+
+    # the least recently used entries are evicted except the one just made
+    evicting_cv_matrix = make_cv_matrix(df, "a", {0: 1, 1: 1, 2: 1}, max_cache_gb=0)
+    evicting_cv_matrix.make(np.timedelta64(1, "D"))
+    assert [p for p in (tmp_path / "store").iterdir()] == [evicting_cv_matrix.dirname]
+
+
+_global_type_weight = {0: 1, 1: 6, 2: 3}
+
+
+def _get_global_type_weight(_):
+    return _global_type_weight
+
+
+def test_function_fingerprint(monkeypatch):
+    fingerprint = caching.get_function_fingerprint
+
+    # the globals are hashed by their values
+    global_fingerprint = fingerprint(_get_global_type_weight)
+    assert fingerprint(_get_global_type_weight) == global_fingerprint
+    monkeypatch.setitem(globals(), "_global_type_weight", {0: 1, 1: 6, 2: 4})
+    assert fingerprint(_get_global_type_weight) != global_fingerprint
+
+    def scaled_weight(_, scale):
+        return scale
+
+    partial_fingerprint = fingerprint(functools.partial(scaled_weight, scale=1))
+    assert fingerprint(functools.partial(scaled_weight, scale=1)) == partial_fingerprint
+    assert fingerprint(functools.partial(scaled_weight, scale=2)) != partial_fingerprint
+
+    def make_weight_func(weights):
+        return lambda pair_df: weights[pair_df["type_y"]]
+
+    for make_weights in (np.array, pd.Series, lambda values: pd.DataFrame({"weight": values})):
+        # the arrays in the closure are hashed by their contents
+        closure_fingerprint = fingerprint(make_weight_func(make_weights([1, 6, 3])))
+        assert fingerprint(make_weight_func(make_weights([1, 6, 3]))) == closure_fingerprint
+        assert fingerprint(make_weight_func(make_weights([1, 6, 4]))) != closure_fingerprint
+
+    # a WeightSpec is hashed by its parameters, not by repr which abbreviates large arrays
+    class ArrayWeight(WeightSpec):
+        def __init__(self, values):
+            self.values = values
+
+    values = np.arange(10000)
+    changed_values = values.copy()
+    changed_values[5000] = -1
+    assert repr(ArrayWeight(values)) == repr(ArrayWeight(changed_values))
+    assert fingerprint(ArrayWeight(values)) == fingerprint(ArrayWeight(values.copy()))
+    assert fingerprint(ArrayWeight(values)) != fingerprint(ArrayWeight(changed_values))
+
+    # a DataFrame modified in place is hashed again
+    df = make_sessions_df(seed=7)
+    data_fingerprint = caching.get_data_fingerprint(df)
+    df.loc[0, "aid"] += 1
+    assert caching.get_data_fingerprint(df) != data_fingerprint
+
+    # an arbitrary callable is never reused
+    class Weight:
+        def __call__(self, _):
+            return 1
+
+    assert fingerprint(Weight()) != fingerprint(Weight())
+
+
+@pytest.mark.parametrize("n_jobs, single_pass", [(1, False), (1, True), (2, False)])
+@pytest.mark.parametrize("keep_full_weight", [True, False])
+def test_tops(tmp_path, n_jobs, single_pass, keep_full_weight):
+    df = make_sessions_df(seed=8)
+    type_weight = {0: 1, 1: 6, 2: 3}
+    cv_matrix = CoVisitationMatrix(
+        df, "tops", tmp_path, n_seperated_aid=3, weight_func=lambda _: type_weight, backend="numpy"
+    )
+    cv_matrix.make(
+        np.timedelta64(1, "D"), single_pass=single_pass, n_jobs=n_jobs, tops=[3, 10], keep_full_weight=keep_full_weight
+    )
+    assert all((cv_matrix.dirname / f"{i}.parquet").exists() == keep_full_weight for i in range(3))
+
+    total_weight_df = pd.DataFrame(
+        [(aid_x, aid_y, weight) for (aid_x, aid_y), weight in get_reference_total_weight(
+            df, np.timedelta64(1, "D"), None, type_weight
+        ).items()],
+        columns=["aid_x", "aid_y", "weight"]
+    )
+    for top in (3, 10):
+        top_df = pd.concat([cv_matrix.get_top_df(i, top) for i in range(3)])
+        # the ties at the k-th weight may be cut differently
+        for aid_x, weights in top_df.groupby("aid_x")["weight"]:
+            expected = total_weight_df.loc[total_weight_df["aid_x"] == aid_x, "weight"].nlargest(top)
+            assert weights.tolist() == expected.tolist()
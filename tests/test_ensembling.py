@@ -0,0 +1,197 @@
+import numpy as np
+import pandas as pd
+import pytest
+from otto_recommender_system import data, ensembling, evaluating, submitting
+
+
+def write_submission(path, sessions, rng):
+    lines = ["session_type,labels"]
+    for session in rng.permutation(sessions):
+        for type_ in ("clicks", "carts", "orders"):
+            aids = rng.choice(60, rng.integers(0, 30), replace=False)
+            lines.append(f"{session}_{type_},{' '.join(map(str, aids))}")
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def get_expected_df(paths, ensemble_type, n_top, weight_matrix, k):
+    """weight_matrix is the weights of (submission, type)"""
+    weight_matrix = np.asarray(weight_matrix, dtype=np.float64)
+    flat_dfs = []
+    for i_sub, path in enumerate(paths):
+        sub_df = pd.read_csv(path, dtype=str, keep_default_na=False)
+        flat_df = sub_df.assign(aid=sub_df["labels"].str.split(" ")).explode("aid")
+        flat_df = flat_df.loc[flat_df["aid"] != ""].astype({"aid": int})
+        flat_df["rank"] = flat_df.groupby("session_type").cumcount()
+        flat_df["type"] = flat_df["session_type"].str.split("_").str[1].map(data.type_to_index)
+        flat_df["sub"] = i_sub
+        if n_top is not None:
+            flat_df = flat_df.loc[flat_df["rank"] < n_top]
+        flat_dfs.append(flat_df[["session_type", "type", "aid", "rank", "sub"]])
+    flat_df = pd.concat(flat_dfs, ignore_index=True)
+    max_count = flat_df.groupby(["sub", "session_type"]).size().max()
+    weight = weight_matrix[flat_df["sub"], flat_df["type"]]
+    flat_df["score"] = {
+        "voting": weight,
+        "rank-weighting": (max_count - flat_df["rank"]) * weight,
+        "inverse-rank-weighting": weight / (flat_df["rank"] + 1),
+    }[ensemble_type]
+    flat_df["first"] = flat_df["sub"] * (max_count + 1) + flat_df["rank"]
+    total_df = flat_df.groupby(["session_type", "aid"]).agg(
+        score=("score", "sum"), first=("first", "min")
+    ).reset_index()
+    total_df = total_df.sort_values(["session_type", "score", "first"], ascending=[True, False, True])
+    labels = total_df.groupby("session_type").head(k).groupby("session_type")["aid"].agg(
+        lambda aids: " ".join(map(str, aids))
+    )
+    session_types = pd.read_csv(paths[0], dtype=str)["session_type"]
+    return pd.DataFrame({"session_type": session_types, "labels": labels.reindex(session_types).fillna("").to_numpy()})
+
+
+@pytest.mark.parametrize("ensemble_type", ensembling.rank_ensemble_types)
+@pytest.mark.parametrize("n_top, n_jobs, weights, weight_matrix", [
+    (None, 1, [1, 0.5, 2], [[1, 1, 1], [0.5, 0.5, 0.5], [2, 2, 2]]),
+    (10, 1, [1, 0.5, 2], [[1, 1, 1], [0.5, 0.5, 0.5], [2, 2, 2]]),
+    (10, 2, [1, 0.5, 2], [[1, 1, 1], [0.5, 0.5, 0.5], [2, 2, 2]]),
+    (10, 1, [{"clicks": 2}, [1, 0.5, 3], 1], [[2, 1, 1], [1, 0.5, 3], [1, 1, 1]]),
+])
+def test_ensemble(tmp_path, monkeypatch, ensemble_type, n_top, n_jobs, weights, weight_matrix):
+    # a few byte ranges per submission and a few partitions
+    monkeypatch.setattr(data, "max_bytes_per_range", 2000)
+    rng = np.random.default_rng(0)
+    paths = [tmp_path / f"submission{i}.csv" for i in range(3)]
+    for path in paths:
+        write_submission(path, np.arange(100) * 7, rng)
+
+    output_path = tmp_path / "ensemble.csv"
+    n_rows = ensembling.ensemble(
+        paths, output_path, ensemble_type, n_top, weights, max_bytes_per_partition=5000, n_jobs=n_jobs
+    )
+    assert n_rows == 300
+    ensemble_df = pd.read_csv(output_path, dtype=str, keep_default_na=False)
+    expected_df = get_expected_df(paths, ensemble_type, n_top, weight_matrix, 20)
+    pd.testing.assert_frame_equal(
+        ensemble_df.sort_values("session_type", ignore_index=True),
+        expected_df.sort_values("session_type", ignore_index=True)
+    )
+
+
+def test_ensemble_candidates(tmp_path, monkeypatch):
+    monkeypatch.setattr(data, "max_bytes_per_range", 2000)
+    rng = np.random.default_rng(1)
+    paths = [tmp_path / f"submission{i}.csv" for i in range(3)]
+    candidates_paths = [path.with_suffix(".parquet") for path in paths]
+    for path, candidates_path in zip(paths, candidates_paths):
+        write_submission(path, np.arange(100) * 7, rng)
+        with submitting.CandidateWriter(candidates_path, rows_per_chunk=50) as writer:
+            writer.write_predictions(evaluating.CSRPredictions.from_csv(path))
+    weights = [1, 0.5, 2]
+
+    ensembling.ensemble(paths, tmp_path / "expected.csv", "rank-weighting", 10, weights, max_bytes_per_partition=5000)
+    expected = evaluating.CSRPredictions.from_csv(tmp_path / "expected.csv")
+    expected = expected.take(np.diff(expected.indptr) > 0)
+
+    ensembling.ensemble(
+        candidates_paths, tmp_path / "ensemble.parquet", "rank-weighting", 10, weights, max_bytes_per_partition=5000
+    )
+    ensemble = evaluating.CSRPredictions.from_parquet(tmp_path / "ensemble.parquet")
+    order = np.lexsort((ensemble.type, ensemble.session))
+    ensemble = ensemble.take(order)
+    order = np.lexsort((expected.type, expected.session))
+    expected = expected.take(order)
+    for name in ("session", "type", "indptr", "aid"):
+        assert np.array_equal(getattr(ensemble, name), getattr(expected, name))
+    row = np.repeat(np.arange(len(ensemble.session)), np.diff(ensemble.indptr))
+    assert np.all((np.diff(ensemble.score) <= 0) | (row[1:] != row[:-1]))
+
+
+def get_expected_normalized_scores(flat_df, normalization):
+    groups = flat_df.groupby("row")["score"]
+    if normalization == "min-max":
+        score_range = groups.transform("max") - groups.transform("min")
+        return ((flat_df["score"] - groups.transform("min")) / score_range).where(score_range > 0, 1.0)
+    elif normalization == "softmax":
+        exp_score = np.exp(flat_df["score"] - groups.transform("max"))
+        return exp_score / exp_score.groupby(flat_df["row"]).transform("sum")
+    else:
+        n = groups.transform("size")
+        return (n - groups.rank(method="first", ascending=False) + 1) / n
+
+
+@pytest.mark.parametrize("normalization", ensembling.normalizations)
+def test_normalize_scores(normalization):
+    rng = np.random.default_rng(0)
+    n_aids = rng.integers(0, 10, 100)
+    indptr = np.r_[0, np.cumsum(n_aids)]
+    score = rng.normal(size=indptr[-1])
+    score[:5] = 1
+    flat_df = pd.DataFrame({"row": np.repeat(np.arange(100), n_aids), "score": score})
+    np.testing.assert_allclose(
+        ensembling.normalize_scores(score, indptr, normalization),
+        get_expected_normalized_scores(flat_df, normalization)
+    )
+    with pytest.raises(ValueError):
+        ensembling.normalize_scores(score, indptr, "z-score")
+
+
+@pytest.mark.parametrize("normalization", ensembling.normalizations)
+@pytest.mark.parametrize("n_top", [None, 10])
+def test_ensemble_scores(tmp_path, normalization, n_top):
+    rng = np.random.default_rng(2)
+    paths = [tmp_path / f"candidates{i}.parquet" for i in range(3)]
+    flat_dfs = []
+    for i_sub, path in enumerate(paths):
+        write_submission(tmp_path / "submission.csv", np.arange(100) * 7, rng)
+        predictions = evaluating.CSRPredictions.from_csv(tmp_path / "submission.csv")
+        predictions.score = rng.normal(size=len(predictions.aid)).astype(np.float32)
+        with submitting.CandidateWriter(path, rows_per_chunk=50, with_score=True) as writer:
+            writer.write_predictions(predictions)
+
+        n_aids = np.diff(predictions.indptr)
+        flat_df = pd.DataFrame({
+            "row": np.repeat(np.arange(len(n_aids)), n_aids),
+            "session": np.repeat(predictions.session, n_aids),
+            "type": np.repeat(predictions.type, n_aids),
+            "aid": predictions.aid,
+            "score": predictions.score.astype(np.float64),
+            "sub": i_sub,
+        })
+        flat_df["score"] = get_expected_normalized_scores(flat_df, normalization)
+        flat_df["rank"] = flat_df.groupby("row").cumcount()
+        flat_dfs.append(flat_df if n_top is None else flat_df.loc[flat_df["rank"] < n_top])
+    weights = [{"orders": 3}, 0.5, [1, 2, 1]]
+
+    flat_df = pd.concat(flat_dfs, ignore_index=True)
+    flat_df["score"] *= np.array([[1, 1, 3], [0.5, 0.5, 0.5], [1, 2, 1]])[flat_df["sub"], flat_df["type"]]
+    flat_df["first"] = flat_df["sub"] * 1000 + flat_df["rank"]
+    total_df = flat_df.groupby(["session", "type", "aid"]).agg(
+        score=("score", "sum"), first=("first", "min")
+    ).reset_index()
+    total_df = total_df.sort_values(["session", "type", "score", "first"], ascending=[True, True, False, True])
+    total_df = total_df.groupby(["session", "type"]).head(20)
+
+    ensembling.ensemble(
+        paths, tmp_path / "ensemble.parquet", "score", n_top, weights, max_bytes_per_partition=2000,
+        normalization=normalization
+    )
+    ensemble = evaluating.CSRPredictions.from_parquet(tmp_path / "ensemble.parquet")
+    ensemble = ensemble.take(np.lexsort((ensemble.type, ensemble.session)))
+    n_aids = np.diff(ensemble.indptr)
+    assert np.array_equal(np.repeat(ensemble.session, n_aids), total_df["session"])
+    assert np.array_equal(np.repeat(ensemble.type, n_aids), total_df["type"])
+    assert np.array_equal(ensemble.aid, total_df["aid"])
+    np.testing.assert_allclose(ensemble.score, total_df["score"], rtol=1e-6)
+
+    with pytest.raises(ValueError):
+        write_submission(tmp_path / "submission.csv", np.arange(100) * 7, rng)
+        ensembling.ensemble([tmp_path / "submission.csv"], tmp_path / "ensemble.csv", "score")
+
+
+def test_ensemble_inconsistent(tmp_path):
+    rng = np.random.default_rng(0)
+    write_submission(tmp_path / "a.csv", np.arange(10), rng)
+    write_submission(tmp_path / "b.csv", np.arange(11), rng)
+    with pytest.raises(RuntimeError):
+        ensembling.ensemble([tmp_path / "a.csv", tmp_path / "b.csv"], tmp_path / "ensemble.csv")
+    with pytest.raises(ValueError):
+        ensembling.ensemble([tmp_path / "a.csv"], tmp_path / "ensemble.csv", "average")
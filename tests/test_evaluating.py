@@ -0,0 +1,66 @@
+import importlib.util
+import json
+import numpy as np
+import pandas as pd
+import pytest
+from otto_recommender_system import evaluating
+from otto_recommender_system.data import project_root_path
+
+
+def load_reference_evaluate():
+    pytest.importorskip("beartype")
+    spec = importlib.util.spec_from_file_location(
+        "reference_evaluate", project_root_path / "recsys-dataset" / "src" / "evaluate.py"
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # the key type hints of the reference are violated by the reference itself (Dict[str, dict] for int sessions)
+    for name, func in list(vars(module).items()):
+        if callable(func) and hasattr(func, "__wrapped__"):
+            setattr(module, name, func.__wrapped__)
+    return module
+
+
+def write_labels(path, n_sessions, rng):
+    with open(path, "w") as f:
+        for session in range(n_sessions):
+            labels = {}
+            for type_ in rng.permutation(["clicks", "carts", "orders"])[:rng.integers(1, 4)]:
+                # aid 0 of clicks is ignored by the reference as a falsy label
+                aids = rng.integers(0, 5, rng.integers(1, 30)).tolist()
+                labels[str(type_)] = aids[0] if type_ == "clicks" else aids
+            f.write(json.dumps({"session": session, "labels": labels}) + "\n")
+
+
+def write_predictions(path, n_sessions, rng):
+    lines = ["session_type,labels"]
+    for session in rng.permutation(n_sessions + 5):
+        if rng.random() < 0.1:
+            continue
+        # some sessions are predicted twice, where the last ones are used
+        for _ in range(1 + (rng.random() < 0.05)):
+            for type_ in ("clicks", "carts", "orders"):
+                aids = rng.integers(0, 1000, rng.integers(0, 30)) if rng.random() < 0.5 else rng.integers(0, 5, 25)
+                lines.append(f"{session}_{type_},{' '.join(map(str, aids))}")
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+@pytest.mark.parametrize("k", [20, 3])
+def test_get_scores(tmp_path, k):
+    reference_evaluate = load_reference_evaluate()
+    rng = np.random.default_rng(k)
+    labels_path = tmp_path / "test_labels.jsonl"
+    predictions_path = tmp_path / "predictions.csv"
+    write_labels(labels_path, 300, rng)
+    write_predictions(predictions_path, 300, rng)
+
+    with open(labels_path) as f:
+        labels = reference_evaluate.prepare_labels(f.readlines())
+    with open(predictions_path) as f:
+        predictions = reference_evaluate.prepare_predictions(f.readlines()[1:])
+    expected = reference_evaluate.get_scores(labels, predictions, k=k)
+
+    assert evaluating.evaluate(labels_path, predictions_path, k=k) == expected
+    predictions = evaluating.CSRPredictions.from_df(pd.read_csv(predictions_path, dtype=str, keep_default_na=False))
+    assert evaluating.get_scores(evaluating.read_labels(labels_path), predictions, k=k) == expected
@@ -0,0 +1,242 @@
+import json
+import mmap
+import numpy as np
+import pandas as pd
+import pytest
+from otto_recommender_system.data import io
+
+
+dtype = [("session", "i4"), ("aid", "i4"), ("ts", "M8[ms]"), ("type", "i1")]
+
+
+def write_jsonl(path, dataset_type, n_sessions, rng):
+    with open(path, "w") as f:
+        for session in range(n_sessions):
+            if dataset_type == "test_labels":
+                labels = {}
+                for type_ in rng.permutation(io.all_types)[:rng.integers(1, 4)]:
+                    aids = rng.integers(0, 1000, rng.integers(1, 5)).tolist()
+                    labels[str(type_)] = aids[0] if type_ == "clicks" else aids
+                record = {"session": session, "labels": labels}
+            else:
+                n = rng.integers(1, 20)
+                record = {"session": session, "events": [
+                    {"aid": int(aid), "ts": int(ts), "type": str(type_)}
+                    for aid, ts, type_ in zip(
+                        rng.integers(0, 1000, n),
+                        np.sort(rng.integers(1_659_304_800_000, 1_662_328_791_000, n)),
+                        rng.choice(io.all_types, n)
+                    )
+                ]}
+            f.write(json.dumps(record) + "\n")
+
+
+def event_dict_to_record(event_dict):
+    assert tuple(event_dict.keys()) == ("aid", "ts", "type")
+    return event_dict["aid"], event_dict["ts"], io.all_types.index(event_dict["type"])
+
+
+def labels_dict_to_records(labels_dict):
+    return [
+        (aid, np.datetime64("NaT"), io.all_types.index(type_))
+        for type_ in io.all_types
+        if type_ in labels_dict.keys()
+        for aid in (labels_dict[type_] if isinstance(labels_dict[type_], list) else [labels_dict[type_]])
+    ]
+
+
+def read_jsonl_with_pandas(path, dataset_type):
+    df = pd.read_json(path, lines=True)
+    if dataset_type == "test_labels":
+        records = [
+            (session, *args)
+            for session, labels_dict in zip(df["session"], df["labels"])
+            for args in labels_dict_to_records(labels_dict)
+        ]
+    else:
+        records = [
+            (session, *event_dict_to_record(event))
+            for session, events in zip(df["session"], df["events"])
+            for event in events
+        ]
+    return np.array(records, dtype=dtype)
+
+
+@pytest.mark.parametrize("dataset_type", ["train", "test_labels"])
+@pytest.mark.parametrize("n_jobs", [1, 3])
+@pytest.mark.parametrize("max_bytes_per_range", [256 * 2 ** 20, 1000])
+def test_read_jsonl(tmp_path, monkeypatch, dataset_type, n_jobs, max_bytes_per_range):
+    monkeypatch.setattr(io, "max_bytes_per_range", max_bytes_per_range)
+    path = tmp_path / f"{dataset_type}.jsonl"
+    write_jsonl(path, dataset_type, 200, np.random.default_rng(0))
+
+    tidy_data = io.read_jsonl(path, dataset_type, np.dtype(dtype), n_jobs)
+    expected = read_jsonl_with_pandas(path, dataset_type)
+    assert tidy_data.dtype == expected.dtype
+    for name in expected.dtype.names:
+        # compared field by field because NaT != NaT in structured arrays
+        np.testing.assert_array_equal(tidy_data[name], expected[name])
+    assert not (tmp_path / f"{dataset_type}-parts").exists()
+
+
+def test_get_line_aligned_byte_ranges(tmp_path):
+    path = tmp_path / "lines.jsonl"
+    lines = [b"a" * n + b"\n" for n in range(1, 30)]
+    path.write_bytes(b"".join(lines))
+    line_starts = set(np.r_[0, np.cumsum([len(line) for line in lines])].tolist())
+
+    for n_ranges in (1, 2, 7, 1000):
+        byte_ranges = io.get_line_aligned_byte_ranges(path, n_ranges)
+        assert byte_ranges[0][0] == 0 and byte_ranges[-1][1] == path.stat().st_size
+        assert all(end == next_start for (_, end), (next_start, _) in zip(byte_ranges[:-1], byte_ranges[1:]))
+        assert all(start < end and start in line_starts for start, end in byte_ranges)
+
+
+def is_memory_mapped(a):
+    while isinstance(a, np.ndarray):
+        if isinstance(a, np.memmap):
+            return True
+        a = a.base
+    return isinstance(a, mmap.mmap)
+
+
+def test_get_npy_tidy_data(tmp_path):
+    data_path = tmp_path / "jsonl"
+    data_path.mkdir()
+    write_jsonl(data_path / "train.jsonl", "train", 50, np.random.default_rng(0))
+    expected = read_jsonl_with_pandas(data_path / "train.jsonl", "train")
+
+    for _ in range(2):  # creating and loading
+        df = io.get_npy_tidy_data("train", data_path, tmp_path)
+        assert df.columns.tolist() == ["session", "aid", "ts", "type"]
+        for name in expected.dtype.names:
+            assert is_memory_mapped(df[name].to_numpy())
+            np.testing.assert_array_equal(df[name].to_numpy(), expected[name])
+
+    df = io.get_npy_tidy_data("train", data_path, tmp_path, columns=["aid", "type"])
+    assert df.columns.tolist() == ["aid", "type"]
+    with pytest.raises(ValueError):
+        io.get_npy_tidy_data("train", data_path, tmp_path, columns=["label"])
+
+
+def test_session_index(tmp_path):
+    session_ids, offsets = io.make_session_index(np.array([3, 3, 5, 8, 8, 8]))
+    assert session_ids.tolist() == [3, 5, 8]
+    assert offsets.tolist() == [0, 2, 3, 6]
+    session_ids, offsets = io.make_session_index(np.array([], dtype=np.int32))
+    assert session_ids.tolist() == [] and offsets.tolist() == [0]
+    with pytest.raises(ValueError):
+        io.make_session_index(np.array([1, 0]))
+
+    data_path = tmp_path / "jsonl"
+    data_path.mkdir()
+    write_jsonl(data_path / "test.jsonl", "test", 30, np.random.default_rng(0))
+    df = io.get_npy_tidy_data("test", data_path, tmp_path)
+    session_ids, offsets = io.get_session_index("test", data_path, tmp_path)
+    assert session_ids.tolist() == list(range(30))
+    for session, first, last in zip(session_ids, offsets[:-1], offsets[1:]):
+        assert np.all(df["session"].to_numpy()[first:last] == session)
+    assert offsets[-1] == len(df)
+
+
+@pytest.mark.parametrize("dataset_type", ["train", "test_labels"])
+def test_get_npy_tidy_data_compact(tmp_path, dataset_type):
+    data_path = tmp_path / "jsonl"
+    data_path.mkdir()
+    write_jsonl(data_path / f"{dataset_type}.jsonl", dataset_type, 50, np.random.default_rng(0))
+
+    df = io.get_npy_tidy_data(dataset_type, data_path, tmp_path)
+    compact_data = io.get_npy_tidy_data(dataset_type, data_path, tmp_path, compact=True)
+    assert isinstance(compact_data, io.CompactTidyData)
+    # the loaded view is not decoded
+    assert compact_data["aid"].dtype == np.int32
+    assert compact_data["ts"].dtype == np.uint32
+    assert compact_data["type"].dtype == np.uint8
+    assert compact_data.nbytes == 9 * len(df) + compact_data.session_ids.nbytes + compact_data.offsets.nbytes
+    with pytest.raises(KeyError):
+        compact_data["session"]
+    # copied since assert_frame_equal distinguishes memmap from ndarray
+    pd.testing.assert_frame_equal(compact_data.to_pandas().copy(), df.copy())
+    pd.testing.assert_frame_equal(
+        io.get_npy_tidy_data(dataset_type, data_path, tmp_path, columns=["ts", "type"], compact=True).to_pandas(),
+        df[["ts", "type"]].copy()
+    )
+
+    compact_path = tmp_path / "npy-compact" / dataset_type
+    assert not (compact_path / "session.npy").exists()
+    assert np.load(compact_path / "ts.npy").dtype == np.uint32
+    assert np.load(compact_path / "type.npy").dtype == np.uint8
+    for session_index, compact_session_index in zip(
+            io.get_session_index(dataset_type, data_path, tmp_path),
+            io.get_session_index(dataset_type, data_path, tmp_path, compact=True)
+    ):
+        np.testing.assert_array_equal(compact_session_index, session_index)
+
+
+def test_compact_ts_in_seconds(tmp_path):
+    np_tidy_data = np.zeros(3, dtype=io.tidy_data_dtype)
+    np_tidy_data["ts"] = np.array(["2022-01-01T00:00:01", "2022-04-01", "NaT"], dtype="M8[ms]")
+    manifest = io._save_compact_columns(tmp_path, np_tidy_data)
+    assert manifest["ts_unit"] == "s"
+    compact_data = io.CompactTidyData(
+        ["ts"], {"ts": np.load(tmp_path / "ts.npy")}, np.array([0]), np.array([0, 3]),
+        manifest["ts_epoch_ms"], manifest["ts_unit"]
+    )
+    np.testing.assert_array_equal(compact_data.to_pandas()["ts"], np_tidy_data["ts"])
+    np.testing.assert_array_equal(compact_data.get_ts_range(), np_tidy_data["ts"][:2])
+
+
+def test_compact_tidy_data(tmp_path):
+    data_path = tmp_path / "jsonl"
+    data_path.mkdir()
+    write_jsonl(data_path / "train.jsonl", "train", 50, np.random.default_rng(0))
+    df = io.get_npy_tidy_data("train", data_path, tmp_path).copy()
+    compact_data = io.get_npy_tidy_data("train", data_path, tmp_path, compact=True)
+
+    first, last = compact_data.offsets[[10, 20]]
+    pd.testing.assert_frame_equal(
+        compact_data.get_rows(first, last).to_pandas(), df.iloc[first:last].reset_index(drop=True)
+    )
+    with pytest.raises(ValueError):
+        compact_data.get_rows(first + 1, last)
+
+    is_kept = df["type"].to_numpy() == 2
+    kept_data = compact_data.get_events(is_kept)
+    pd.testing.assert_frame_equal(kept_data.to_pandas(), df.loc[is_kept].reset_index(drop=True))
+    # the sessions without orders are dropped from the session index
+    assert kept_data.session_ids.tolist() == df.loc[is_kept, "session"].unique().tolist()
+
+    pd.testing.assert_frame_equal(compact_data[["session", "aid"]].to_pandas(), df[["session", "aid"]])
+    assert compact_data.get_max_aid() == df["aid"].max()
+    assert compact_data.get_ts_range().tolist() == [df["ts"].min(), df["ts"].max()]
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_tidy_data_chunks(tmp_path, compact):
+    data_path = tmp_path / "jsonl"
+    data_path.mkdir()
+    write_jsonl(data_path / "train.jsonl", "train", 50, np.random.default_rng(0))
+    df = io.get_npy_tidy_data("train", data_path, tmp_path).copy()
+
+    # the bytes per event as loaded
+    bytes_per_event = 9 if compact else 17
+    chunks = io.TidyDataChunks(
+        "train", data_path, tmp_path, max_bytes_per_chunk=bytes_per_event * 40, compact=compact
+    )
+    assert len(chunks) > 1
+    chunk_dfs = [chunk.to_pandas() if compact else chunk for chunk in chunks]
+    assert len(chunk_dfs) == len(chunks)
+    assert all(len(chunk_df) <= 40 or chunk_df["session"].nunique() == 1 for chunk_df in chunk_dfs)
+    # the sessions are never split
+    assert sum(chunk_df["session"].nunique() for chunk_df in chunk_dfs) == df["session"].nunique()
+    pd.testing.assert_frame_equal(pd.concat(chunk_dfs, ignore_index=True), df)
+    assert chunks.get_max_aid() == df["aid"].max()
+
+    chunks = io.TidyDataChunks(
+        "train", data_path, tmp_path, max_bytes_per_chunk=100, columns=["session", "aid"], types=["carts", 2],
+        compact=compact
+    )
+    pd.testing.assert_frame_equal(
+        pd.concat([chunk.to_pandas() if compact else chunk for chunk in chunks], ignore_index=True),
+        df.loc[df["type"].isin([1, 2]), ["session", "aid"]].reset_index(drop=True)
+    )
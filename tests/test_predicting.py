@@ -0,0 +1,134 @@
+import numpy as np
+import pandas as pd
+from otto_recommender_system.co_visitation_matrixes import TopKIndex
+from otto_recommender_system.co_visitation_matrixes import predicting
+from otto_recommender_system.data import make_session_index
+from .test_co_visitation_matrix import make_tidy_data_chunks, make_compact_tidy_data
+
+
+def make_random_index(n_aids, k, rng):
+    return TopKIndex.from_dict({
+        aid: tuple(rng.choice(n_aids, k, replace=False).tolist())
+        for aid in range(n_aids)
+        if rng.random() < 0.9
+    })
+
+
+def make_target_df(n_sessions, n_aids, max_n_events, rng):
+    records = [
+        (session, aid, 1661119200000 + 1000 * i, type_)
+        for session in range(n_sessions)
+        for i, (aid, type_) in enumerate(zip(
+            rng.integers(0, n_aids, rng.integers(1, max_n_events + 1)), rng.integers(0, 3, max_n_events)
+        ))
+    ]
+    df = pd.DataFrame(records, columns=["session", "aid", "ts", "type"])
+    return df.astype({"session": "i4", "aid": "i4", "ts": "M8[ms]", "type": "i1"})
+
+
+def to_label_sets(predicted_df):
+    return {
+        session: set(df["aid"].tolist())
+        for session, df in predicted_df.groupby("session")
+    }
+
+
+def test_batch_without_ties():
+    # up to 4 events with 3 (clicks) or 2 + 2 (buys) neighbors each never reach the cutoffs of 20,
+    # so the ties are irrelevant and the results must be exactly the same
+    rng = np.random.default_rng(0)
+    clicks_index = make_random_index(200, 3, rng)
+    buys_index = make_random_index(200, 2, rng)
+    buy2buy_index = make_random_index(200, 2, rng)
+    target_df = make_target_df(300, 200, 4, rng)
+    top_20_popular = rng.choice(200, 20, replace=False).tolist()
+
+    clicks = to_label_sets(predicting.suggest_clicks_batch(target_df, clicks_index, top_20_popular))
+    buys = to_label_sets(predicting.suggest_buys_batch(target_df, buys_index, buy2buy_index, top_20_popular))
+    for session, df in target_df.groupby("session"):
+        assert clicks[session] == predicting.suggest_clicks(df, clicks_index, top_20_popular)
+        assert buys[session] == predicting.suggest_buys(df, buys_index, buy2buy_index, top_20_popular)
+
+
+def test_batch_cutoffs():
+    top_dict = {
+        1: tuple(range(100, 119)) + (2,),
+        2: tuple(range(100, 110)) + (3,),
+        3: tuple(range(100, 105)) + (200, 201),
+    }
+    target_df = pd.DataFrame({
+        "session": [0, 0, 0, 1],
+        "aid": [1, 2, 3, 4],
+        "ts": np.array([0, 1, 2, 0], dtype="M8[ms]"),
+        "type": [0, 0, 0, 0],
+    })
+    top_20_popular = [1, 300, 301]
+
+    predicted = to_label_sets(predicting.suggest_clicks_batch(target_df, top_dict, top_20_popular))
+    # the neighbors are counted from the most recent aid: 3, 2 and then 1.
+    # most_common(20) gives 100-104 (3 times), 105-109 (twice) and 200, 201, 3, 110-116 (once, in order of appearance),
+    # where 3 is in the history, so the 17 slots left are filled by 100-109, 200, 201 and 110-114
+    assert predicted[0] == {1, 2, 3, *range(100, 110), 200, 201, *range(110, 115)}
+    assert predicted[1] == {4, 1, 300, 301}
+
+
+def test_get_predictions_df(tmp_path):
+    rng = np.random.default_rng(1)
+    indexes = [make_random_index(200, 2, rng) for _ in range(3)]
+    target_df = make_target_df(100, 200, 4, rng)
+
+    session_index = make_session_index(target_df["session"].to_numpy())
+
+    predictions_dfs = []
+    for vectorized, n_jobs, uses_session_index in (
+            (False, 1, False), (True, 1, False), (False, 3, False), (True, 2, False), (False, 1, True), (False, 3, True)
+    ):
+        cache_dir_path = tmp_path / f"{vectorized}-{n_jobs}-{uses_session_index}"
+        cache_dir_path.mkdir()
+        predictions_df = predicting.get_predictions_df(
+            "validation", target_df, *indexes, cache_dir_path, vectorized=vectorized, n_jobs=n_jobs,
+            session_index=session_index if uses_session_index else None
+        )
+        assert len(predictions_df) == 3 * 100
+        predictions_df["labels"] = predictions_df["labels"].map(lambda labels: set(labels.split()))
+        predictions_dfs.append(predictions_df.set_index("session_type").sort_index())
+    for predictions_df in predictions_dfs[1:]:
+        pd.testing.assert_frame_equal(predictions_dfs[0], predictions_df)
+
+
+def test_get_predictions_df_with_tidy_data_chunks(tmp_path):
+    rng = np.random.default_rng(2)
+    indexes = [make_random_index(200, 2, rng) for _ in range(3)]
+    target_df = make_target_df(100, 200, 4, rng)
+    chunks = make_tidy_data_chunks(target_df, tmp_path, max_bytes_per_chunk=17 * 50)
+    assert len(chunks) > 1
+    compact_chunks = make_tidy_data_chunks(target_df, tmp_path, max_bytes_per_chunk=9 * 50, compact=True)
+    compact_data = make_compact_tidy_data(target_df, tmp_path)
+
+    predictions_dfs = []
+    for i_target, (target, n_jobs, vectorized) in enumerate((
+            (target_df, 1, False), (chunks, 1, False), (chunks, 2, False),
+            (compact_chunks, 1, True), (compact_data, 1, False), (compact_data, 2, True)
+    )):
+        cache_dir_path = tmp_path / f"{i_target}-{type(target).__name__}-{n_jobs}"
+        cache_dir_path.mkdir()
+        predictions_df = predicting.get_predictions_df(
+            "validation", target, *indexes, cache_dir_path, vectorized=vectorized, n_jobs=n_jobs
+        )
+        predictions_df["labels"] = predictions_df["labels"].map(lambda labels: set(labels.split()))
+        predictions_dfs.append(predictions_df.set_index("session_type").sort_index())
+    for predictions_df in predictions_dfs[1:]:
+        pd.testing.assert_frame_equal(predictions_dfs[0], predictions_df)
+
+
+def test_get_top_20_aids():
+    rng = np.random.default_rng(3)
+    # few aids so that there are many ties
+    target_df = make_target_df(300, 60, 10, rng)
+    edges = [0, 1, 500, 501, 1200, len(target_df)]
+    top_20_aids = predicting._get_top_20_aids(
+        [target_df.iloc[f:l] for f, l in zip(edges[:-1], edges[1:])], ["clicks", "carts", "orders"]
+    )
+    for type_index, type_ in enumerate(["clicks", "carts", "orders"]):
+        expected = target_df.loc[target_df["type"] == type_index, "aid"].value_counts().index[:20].tolist()
+        assert top_20_aids[type_] == expected
@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+import pyarrow.parquet
+import pytest
+from otto_recommender_system import data, evaluating, submitting
+
+
+def get_random_predictions(n_rows, rng):
+    n_aids = rng.integers(0, 25, n_rows)
+    n_aids[rng.random(n_rows) < 0.1] = 0
+    return evaluating.CSRPredictions(
+        rng.integers(0, 10 ** rng.integers(1, 10, n_rows)), rng.integers(0, 3, n_rows).astype(np.int8),
+        np.r_[0, np.cumsum(n_aids)], rng.integers(0, 10 ** rng.integers(1, 8, n_aids.sum()))
+    )
+
+
+def to_submission_df(predictions):
+    return pd.DataFrame({
+        "session_type": [f"{s}_{data.all_types[t]}" for s, t in zip(predictions.session, predictions.type)],
+        "labels": [
+            " ".join(map(str, predictions.aid[f:l])) for f, l in zip(predictions.indptr[:-1], predictions.indptr[1:])
+        ],
+    })
+
+
+@pytest.mark.parametrize("rows_per_chunk", [2 ** 20, 7])
+def test_write_submission(tmp_path, rows_per_chunk):
+    predictions = get_random_predictions(200, np.random.default_rng(0))
+    expected_df = to_submission_df(predictions)
+    expected_df.to_csv(tmp_path / "expected.csv", index=False)
+    expected = (tmp_path / "expected.csv").read_bytes()
+
+    assert submitting.write_submission(tmp_path / "csr.csv", predictions, rows_per_chunk=rows_per_chunk) == 200
+    assert (tmp_path / "csr.csv").read_bytes() == expected
+    assert submitting.write_submission(tmp_path / "df.csv", expected_df, rows_per_chunk=rows_per_chunk) == 200
+    assert (tmp_path / "df.csv").read_bytes() == expected
+
+    parsed = evaluating.CSRPredictions.from_csv(tmp_path / "csr.csv")
+    for name in ("session", "type", "indptr", "aid"):
+        assert np.array_equal(getattr(parsed, name), getattr(predictions, name))
+
+    rows = np.flatnonzero(predictions.type != 1)[::-1]
+    submitting.write_submission(tmp_path / "take.csv", predictions.take(rows), rows_per_chunk=rows_per_chunk)
+    pd.testing.assert_frame_equal(
+        pd.read_csv(tmp_path / "take.csv", dtype=str, keep_default_na=False),
+        expected_df.iloc[rows].reset_index(drop=True)
+    )
+
+
+def test_submission_writer(tmp_path):
+    with submitting.SubmissionWriter(tmp_path / "submission.csv", rows_per_chunk=2) as writer:
+        writer.write([1, 2, 30], "clicks", [10, 12, 12, 13], [4, 5, 6])
+        writer.write([7], 2, [0, 1], [8])
+    assert writer.n_rows == 4
+    assert (tmp_path / "submission.csv").read_text() == (
+        "session_type,labels\n1_clicks,4 5\n2_clicks,\n30_clicks,6\n7_orders,8\n"
+    )
+    with pytest.raises(ValueError):
+        submitting.get_submission_bytes([1], "views", [0, 0], [])
+
+
+@pytest.mark.parametrize("with_score", [False, True])
+def test_candidate_writer(tmp_path, with_score):
+    rng = np.random.default_rng(1)
+    predictions = get_random_predictions(200, rng)
+    predictions.score = rng.random(len(predictions.aid)) if with_score else None
+    path = tmp_path / "candidates.parquet"
+    with submitting.CandidateWriter(path, rows_per_chunk=7, with_score=with_score) as writer:
+        writer.write_predictions(predictions)
+
+    candidates_df = pd.read_parquet(path)
+    assert {col: str(dtype) for col, dtype in candidates_df.dtypes.items()} == {
+        col: np.dtype(dtype).name for col, dtype in submitting.candidate_dtypes.items()
+        if with_score or col != "score"
+    }
+
+    # the rows without aids are not in the candidates
+    expected = predictions.take(np.diff(predictions.indptr) > 0)
+    pieces = [
+        evaluating.CSRPredictions.from_parquet(path, [i])
+        for i in range(pyarrow.parquet.ParquetFile(path).num_row_groups)
+    ]
+    assert len(pieces) > 1
+    for parsed in [
+        evaluating.CSRPredictions.from_parquet(path),
+        evaluating.read_predictions(path),
+        evaluating.CSRPredictions.from_arrays(*(
+            np.concatenate([np.repeat(getattr(piece, name), np.diff(piece.indptr)) for piece in pieces])
+            for name in ("session", "type")
+        ), np.concatenate([piece.aid for piece in pieces]))
+    ]:
+        for name in ("session", "type", "indptr", "aid"):
+            assert np.array_equal(getattr(parsed, name), getattr(expected, name))
+    if with_score:
+        assert np.allclose(evaluating.CSRPredictions.from_parquet(path).score, expected.score.astype(np.float32))
+
+    with pytest.raises(ValueError):
+        submitting.CandidateWriter(tmp_path / "long.parquet").write([1], 0, [0, 300], np.arange(300))
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+from otto_recommender_system.co_visitation_matrixes import CoVisitationMatrix, TopKIndex
+from otto_recommender_system.co_visitation_matrixes import predicting
+from otto_recommender_system.co_visitation_matrixes.top_k_index import get_top_k_indices
+from .test_co_visitation_matrix import make_sessions_df
+
+
+def test_from_top_df():
+    top_df = pd.DataFrame({
+        "aid_x": [3, 1, 3, 3, 1],
+        "aid_y": [10, 11, 12, 13, 14],
+        "weight": [1, 5, 3, 2, 6],
+    })
+    index = TopKIndex.from_top_df(top_df, n_aids=6)
+    assert index.n_aids == 6
+    assert len(index) == 2
+    assert 1 in index and 3 in index and 0 not in index and 100 not in index
+    assert index.neighbors(1).tolist() == [14, 11]
+    assert index.neighbors(3).tolist() == [12, 13, 10]
+    assert index.neighbors(3, return_weights=True)[1].tolist() == [3, 2, 1]
+    assert index.neighbors(0).tolist() == []
+    assert index.neighbors(-1).tolist() == []
+    assert index.neighbors(100).tolist() == []
+
+    neighbors, n_neighbors = index.neighbors_many([3, 0, 100, 1, 3])
+    assert neighbors.tolist() == [12, 13, 10, 14, 11, 12, 13, 10]
+    assert n_neighbors.tolist() == [3, 0, 0, 2, 3]
+
+
+def test_get_top_k_indices():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({"aid_x": rng.integers(0, 30, 2000), "weight": rng.integers(0, 5, 2000)})
+    tops = [1, 3, 20, 100]
+    indices = get_top_k_indices(df["aid_x"], df["weight"], tops)
+    sorted_df = df.sort_values(["aid_x", "weight"], ascending=[True, False])
+    for top in tops:
+        expected = sorted_df.loc[sorted_df.groupby("aid_x").cumcount() < top].index
+        assert indices[top].tolist() == expected.tolist()
+
+
+def test_replace():
+    index = TopKIndex.from_top_df(pd.DataFrame({
+        "aid_x": [3, 1, 3, 3, 1],
+        "aid_y": [10, 11, 12, 13, 14],
+        "weight": [1, 5, 3, 2, 6],
+    }), n_aids=6)
+    index = index.replace([3, 7], pd.DataFrame({
+        "aid_x": [3, 7, 3, 1],
+        "aid_y": [20, 21, 22, 23],
+        "weight": [1, 4, 2, 100],
+    }))
+    assert index.n_aids == 8
+    assert index.neighbors(1).tolist() == [14, 11]
+    assert index.neighbors(3).tolist() == [22, 20]
+    assert index.neighbors(7, return_weights=True)[1].tolist() == [4]
+
+
+def test_save_and_load(tmp_path):
+    index = TopKIndex.from_dict({2: (5, 4), 0: [7]})
+    index.save(tmp_path)
+    loaded_index = TopKIndex.load(tmp_path)
+    assert isinstance(loaded_index.neighbors_array, np.memmap)
+    assert loaded_index.neighbors(0).tolist() == [7]
+    assert loaded_index.neighbors(1).tolist() == []
+    assert loaded_index.neighbors(2).tolist() == [5, 4]
+
+
+def test_get_index(tmp_path):
+    df = make_sessions_df()
+    cv_matrix = CoVisitationMatrix(df, "test", tmp_path, n_seperated_aid=4, backend="numpy")
+    cv_matrix.make(np.timedelta64(1, "D"))
+
+    top_dict = cv_matrix.get_dict(top=5)
+    index = cv_matrix.get_index(top=5)
+    assert len(index) == len(top_dict)
+    for aid, aid_y_list in top_dict.items():
+        assert index.neighbors(aid).tolist() == list(aid_y_list)
+
+    session_df = df.loc[df["session"] == 0]
+    top_clicks = [1, 2, 3]
+    assert (
+        predicting.suggest_clicks(session_df, index, top_clicks)
+        ==
+        predicting.suggest_clicks(session_df, top_dict, top_clicks)
+    )
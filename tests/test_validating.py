@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import pytest
+from otto_recommender_system import evaluating, validating
+from .test_evaluating import write_labels, write_predictions
+
+
+def test_validate(tmp_path, monkeypatch):
+    monkeypatch.setattr(validating, "train_test_local_validation_data_path", tmp_path)
+    monkeypatch.setattr(validating, "_ground_truths", {})
+    labels_path = tmp_path / "7days" / "jsonl" / "test_labels.jsonl"
+    labels_path.parent.mkdir(parents=True)
+    predictions_path = tmp_path / "predictions.csv"
+    rng = np.random.default_rng(0)
+    write_labels(labels_path, 100, rng)
+    write_predictions(predictions_path, 100, rng)
+    expected = evaluating.evaluate(labels_path, predictions_path)
+
+    assert validating.validate(predictions_path, days=7) == expected
+    assert (tmp_path / "7days" / "ground-truth" / "key.npy").exists()
+    # the cached ground truth is used from now on
+    labels_path.unlink()
+    monkeypatch.setattr(validating, "_ground_truths", {})
+    predictions_df = pd.read_csv(predictions_path, dtype=str, keep_default_na=False)
+    assert validating.validate(predictions_df, days=7) == expected
+
+    # the ranked rows of the last prediction of each (session, type)
+    predictions_df = predictions_df.drop_duplicates("session_type", keep="last")
+    flat_df = predictions_df.assign(aid=predictions_df["labels"].str.split(" ")).explode("aid")
+    flat_df = flat_df.loc[flat_df["aid"] != ""]
+    flat_df[["session", "type"]] = flat_df["session_type"].str.split("_", expand=True)
+    assert validating.validate(flat_df[["session", "type", "aid"]].astype({"session": int, "aid": int})) == expected
+
+    with pytest.raises(FileNotFoundError):
+        validating.validate(predictions_path, days=1)
+
+
+def test_ground_truth(tmp_path):
+    labels_path = tmp_path / "test_labels.jsonl"
+    write_labels(labels_path, 100, np.random.default_rng(1))
+    labels_df = evaluating.read_labels(labels_path)
+    ground_truth = evaluating.get_ground_truth(tmp_path, tmp_path)
+    assert isinstance(ground_truth.key, np.memmap)
+    assert np.all(np.diff(ground_truth.key) > 0)
+    assert len(ground_truth.key) == len(labels_df)
+
+    counts = labels_df.groupby(["session", "type"]).size()
+    assert ground_truth.group_session.tolist() == counts.index.get_level_values("session").tolist()
+    assert ground_truth.group_type.tolist() == counts.index.get_level_values("type").tolist()
+    assert ground_truth.n_labels.tolist() == counts.tolist()
+    assert ground_truth.n_labels_capped.tolist() == np.minimum(counts, 20).tolist()
+    for type_index in range(3):
+        assert ground_truth.get_n_events(type_index, k=3) == np.minimum(counts.xs(type_index, level="type"), 3).sum()
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_validate_many(tmp_path, monkeypatch, n_jobs):
+    monkeypatch.setattr(validating, "train_test_local_validation_data_path", tmp_path)
+    monkeypatch.setattr(validating, "_ground_truths", {})
+    labels_path = tmp_path / "7days" / "jsonl" / "test_labels.jsonl"
+    labels_path.parent.mkdir(parents=True)
+    rng = np.random.default_rng(2)
+    write_labels(labels_path, 100, rng)
+    predictions_paths = [tmp_path / f"predictions{i}.csv" for i in range(3)]
+    for predictions_path in predictions_paths:
+        write_predictions(predictions_path, 100, rng)
+    predictions_list = [*predictions_paths[:2], pd.read_csv(predictions_paths[2], dtype=str, keep_default_na=False)]
+
+    scores_df = validating.validate_many(predictions_list, n_jobs=n_jobs)
+    assert scores_df.index.tolist() == [str(predictions_paths[0]), str(predictions_paths[1]), 2]
+    assert scores_df.columns.tolist() == ["clicks", "carts", "orders", "total"]
+    for (_, scores), predictions_path in zip(scores_df.iterrows(), predictions_paths):
+        assert scores.to_dict() == evaluating.evaluate(labels_path, predictions_path)
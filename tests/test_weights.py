@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+import pytest
+from otto_recommender_system.co_visitation_matrixes import (
+    CoVisitationMatrix, TypeWeight, RecencyWeight, TimeGapWeight, PositionWeight, backends, caching
+)
+from .test_co_visitation_matrix import make_sessions_df, read_total_weight
+
+
+def test_weight_specs():
+    df = make_sessions_df(seed=9)
+    pair_df = backends.NumpyBackend().get_pair_df(df, None, (0, 50), np.timedelta64(1, "D"), with_position=True)
+
+    def past_time_weight(df_):
+        return 1 + 3 * (df_["ts_x"] - df["ts"].min()) / (df["ts"].max() - df["ts"].min())
+
+    np.testing.assert_array_equal(RecencyWeight.from_ts(df["ts"])(pair_df), past_time_weight(pair_df))
+
+    weight = (
+        TypeWeight({"clicks": 1, "carts": 6, "orders": 3})
+        * RecencyWeight.from_ts(df["ts"], kind="exponential", half_life="7D")
+        * TimeGapWeight(np.timedelta64(1, "h"))
+        * PositionWeight(10)
+    )
+    assert weight.uses_position
+    ts_x = pair_df["ts_x"].to_numpy().astype(np.int64)
+    ts_y = pair_df["ts_y"].to_numpy().astype(np.int64)
+    expected = (
+        pair_df["type_y"].map({0: 1, 1: 6, 2: 3}).to_numpy()
+        * 0.5 ** ((df["ts"].max().value // 10 ** 6 - ts_x) / (7 * 24 * 60 * 60 * 1000))
+        * 0.5 ** (np.abs(ts_x - ts_y) / (60 * 60 * 1000))
+        * 0.5 ** (pair_df["position_y"].to_numpy() / 10)
+    )
+    np.testing.assert_allclose(weight(pair_df), expected)
+
+    fingerprint = caching.get_function_fingerprint(TimeGapWeight("1h"))
+    assert fingerprint == caching.get_function_fingerprint(TimeGapWeight("60min"))
+    assert fingerprint != caching.get_function_fingerprint(TimeGapWeight("2h"))
+
+    with pytest.raises(ValueError):
+        RecencyWeight.from_ts(df["ts"], kind="exponential")
+
+
+def test_position_of_pair_df():
+    df = make_sessions_df(seed=10)
+    columns = ["session", "aid_x", "ts_x", "type_x", "position_x", "aid_y", "ts_y", "type_y", "position_y"]
+    for method in ("get_pair_df", "get_candidate_pair_df"):
+        expected = getattr(backends.PandasBackend(), method)(df, None, (10, 30), np.timedelta64(1, "D"), True)
+        actual = getattr(backends.NumpyBackend(), method)(df, None, (10, 30), np.timedelta64(1, "D"), True)
+        assert list(actual.columns) == list(expected.columns) == columns
+        pd.testing.assert_frame_equal(
+            actual.sort_values(columns).reset_index(drop=True),
+            expected.sort_values(columns).reset_index(drop=True),
+            check_dtype=False
+        )
+
+
+@pytest.mark.parametrize("backend", ["pandas", "numpy"])
+def test_make_with_weight_spec(tmp_path, backend):
+    df = make_sessions_df(seed=11)
+    weight = TypeWeight({0: 1, 1: 6, 2: 3}) * PositionWeight(5) * TimeGapWeight("6h")
+
+    def weight_func(pair_df):
+        return (
+            pair_df["type_y"].map({0: 1, 1: 6, 2: 3})
+            * 0.5 ** (pair_df["position_y"] / 5)
+            * 0.5 ** ((pair_df["ts_x"] - pair_df["ts_y"]).abs() / np.timedelta64(6, "h"))
+        )
+
+    cv_matrix = CoVisitationMatrix(df, "spec", tmp_path, n_seperated_aid=2, weight_func=weight, backend=backend)
+    cv_matrix.make(np.timedelta64(1, "D"))
+
+    pair_df = backends.PandasBackend().get_pair_df(df, None, (0, 50), np.timedelta64(1, "D"), with_position=True)
+    pair_df["weight"] = weight_func(pair_df)
+    total_weight = pair_df.groupby(["aid_x", "aid_y"])["weight"].sum()
+    # the totals are rounded, not truncated
+    assert np.any(total_weight.round() != np.floor(total_weight))
+    assert read_total_weight(cv_matrix) == total_weight.round().astype(np.int32).to_dict()
+
+    # the float weights of a Python callable are truncated as before
+    def time_gap_weight_func(pair_df):
+        return 0.5 ** ((pair_df["ts_x"] - pair_df["ts_y"]).abs() / np.timedelta64(6, "h"))
+
+    callable_cv_matrix = CoVisitationMatrix(
+        df, "callable", tmp_path, n_seperated_aid=2, weight_func=time_gap_weight_func, backend=backend
+    )
+    callable_cv_matrix.make(np.timedelta64(1, "D"))
+    pair_df["weight"] = time_gap_weight_func(pair_df)
+    total_weight = pair_df.groupby(["aid_x", "aid_y"])["weight"].sum()
+    assert np.any(total_weight.round() != np.floor(total_weight))
+    assert read_total_weight(callable_cv_matrix) == total_weight.astype(np.int32).to_dict()